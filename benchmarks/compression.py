@@ -0,0 +1,91 @@
+'''
+Wall-clock time of compressed against plain uploads and downloads of text
+PLY meshes, by file size and bandwidth of a throttled local API stand-in.
+
+Compression costs CPU time on both ends and saves transfer time in proportion
+to the bandwidth: on a slow link it wins at any size, on a fast one it can
+lose. zstd is included when the zstandard package is installed.
+
+    python benchmarks/compression.py --size-mb 1 8 32 --mbps 2 16 0
+'''
+import argparse
+import os
+import random
+import shutil
+import tempfile
+import time
+
+from bodylabs_api import compression
+from bodylabs_api.client import Client
+from bodylabs_api.mock_server import MockApiServer
+from bodylabs_api.models import File
+
+
+def write_mesh(path, size):
+    '''
+    An ASCII PLY of random vertices, about size bytes long
+    '''
+    rng = random.Random(0)
+    vertex_count = size // 30
+    with open(path, 'wb') as f:
+        f.write('ply\nformat ascii 1.0\nelement vertex {}\n'.format(vertex_count))
+        f.write('property float x\nproperty float y\nproperty float z\nend_header\n')
+        for _ in xrange(vertex_count):
+            f.write('{:.6f} {:.6f} {:.6f}\n'.format(rng.uniform(-1, 1), rng.uniform(-1, 1), rng.uniform(0, 2)))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--size-mb', type=float, nargs='+', default=[1, 8, 32])
+    parser.add_argument('--mbps', type=float, nargs='+', default=[2, 16, 0],
+                        help='per-connection throughput limits in MB/s; 0 for unlimited')
+    parser.add_argument('--encodings', nargs='+', default=['identity', 'gzip', 'zstd'])
+    args = parser.parse_args()
+    encodings = [encoding for encoding in args.encodings
+                 if encoding == 'identity' or compression.available(encoding)]
+
+    work_dir = tempfile.mkdtemp()
+    print '{:>8} {:>6} {:>9} {:>6} {:>10} {:>10}'.format(
+        'size_mb', 'mbps', 'encoding', 'ratio', 'upload_s', 'download_s')
+    try:
+        for size_mb in args.size_mb:
+            path = os.path.join(work_dir, 'mesh.ply')
+            write_mesh(path, int(size_mb * 1024 * 1024))
+            size = os.path.getsize(path)
+            for mbps in args.mbps:
+                server = MockApiServer(
+                    bytes_per_second=mbps * 1024 * 1024 if mbps else None, compress_downloads=True).start()
+                try:
+                    for encoding in encodings:
+                        client = Client(server.base_uri, 'access_key', 'secret', verbose=False,
+                                        accept_encoding=encoding)
+                        try:
+                            start = time.time()
+                            uploaded = File.from_local_path(
+                                path, client, compression=None if encoding == 'identity' else encoding)
+                            upload_seconds = time.time() - start
+
+                            encoded_size = size
+                            if encoding != 'identity':
+                                # The stand-in compresses each download once; not part of the timing
+                                encoded_size = len(server.encoded_content(
+                                    server.objects[uploaded.file_id], encoding))
+
+                            output_path = os.path.join(work_dir, 'download.ply')
+                            start = time.time()
+                            client.download(uploaded.download_uri, output_path)
+                            download_seconds = time.time() - start
+                            os.remove(output_path)
+                        finally:
+                            client.close()
+                        print '{:>8} {:>6} {:>9} {:>6.2f} {:>10.2f} {:>10.2f}'.format(
+                            size_mb, mbps or 'inf', encoding, float(size) / encoded_size,
+                            upload_seconds, download_seconds)
+                finally:
+                    server.stop()
+    finally:
+        shutil.rmtree(work_dir)
+
+
+if __name__ == '__main__':
+    main()
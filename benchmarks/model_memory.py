@@ -0,0 +1,103 @@
+'''
+Memory and filtering time of many artifacts held as models or an ArtifactSet.
+
+Each representation is built in a forked child, so that its peak RSS is
+measured on its own.
+
+    python benchmarks/model_memory.py --count 50000
+'''
+import argparse
+import json
+import os
+import resource
+import time
+
+from bodylabs_api.artifact_set import ArtifactSet
+from bodylabs_api.models import Artifact
+
+STATUSES = ('pending', 'processing', 'ready', 'failed')
+SERVICE_TYPES = ('FootAlignment', 'Measurement', 'Alignment')
+
+
+def raw_jsons(count):
+    for index in range(count):
+        yield {
+            'artifactId': '{:024x}'.format(index),
+            'status': STATUSES[index % len(STATUSES)],
+            'serviceType': SERVICE_TYPES[index % len(SERVICE_TYPES)],
+            'serviceVersion': '1.{}.0'.format(index % 5),
+            'artifactType': 'obj',
+            'createdAt': '2016-05-{:02d}T12:00:00.000Z'.format(index % 28 + 1),
+            'parameters': {'unit': 'cm', 'gender': 'female', 'height': 160 + index % 40},
+            'dependencies': {'scan': '{:024x}'.format(index + 1000000)},
+        }
+
+
+def build_models(count):
+    models = [Artifact(raw_json, None) for raw_json in raw_jsons(count)]
+    started_at = time.time()
+    pending = [model.artifact_id for model in models if model.status in ('pending', 'processing')]
+    filtered = time.time() - started_at
+    by_id = {model.artifact_id: model for model in models}
+    started_at = time.time()
+    for raw_json in raw_jsons(count // 10):
+        raw_json['status'] = 'ready'
+        by_id[raw_json['artifactId']].raw_json = raw_json
+    return len(pending), filtered, time.time() - started_at
+
+
+def build_set(count):
+    artifacts = ArtifactSet(None, raw_jsons(count))
+    started_at = time.time()
+    pending = artifacts.ids(status=('pending', 'processing'))
+    filtered = time.time() - started_at
+
+    def updates():
+        for raw_json in raw_jsons(count // 10):
+            raw_json['status'] = 'ready'
+            yield raw_json
+    started_at = time.time()
+    artifacts.update(updates())
+    return len(pending), filtered, time.time() - started_at
+
+
+def measure(build):
+    '''
+    Run build in a child process, returning its peak RSS growth in bytes and
+    what build returned
+    '''
+    read_fd, write_fd = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        os.close(read_fd)
+        before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        result = build()
+        growth = (resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - before) * 1024
+        os.write(write_fd, json.dumps((growth,) + result))
+        os._exit(0) # pylint: disable=protected-access
+    os.close(write_fd)
+    output = os.read(read_fd, 4096)
+    os.close(read_fd)
+    os.waitpid(pid, 0)
+    return json.loads(output)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--count', type=int, nargs='+', default=[10000, 50000])
+    args = parser.parse_args()
+
+    print '{:>8} {:<14} {:>10} {:>12} {:>12} {:>12}'.format(
+        'count', 'representation', 'MB', 'bytes/each', 'filter ms', 'update ms')
+    for count in args.count:
+        for name, build in [
+                ('models', lambda: build_models(count)),
+                ('ArtifactSet', lambda: build_set(count))]:
+            growth, pending, filtered, updated = measure(build)
+            assert pending == count // 2
+            print '{:>8} {:<14} {:>10.1f} {:>12.0f} {:>12.2f} {:>12.2f}'.format(
+                count, name, growth / 1024.0 / 1024, float(growth) / count, filtered * 1000, updated * 1000)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,52 @@
+'''
+Upload throughput against a bandwidth-limited local S3 stand-in, comparing a
+single streamed PUT with multipart uploads of increasing part counts.
+
+    python benchmarks/multipart_upload.py --size-mb 64 --mbps 8
+'''
+import argparse
+import os
+import tempfile
+import time
+
+from bodylabs_api.client import Client, MULTIPART_MIN_PART_SIZE
+from bodylabs_api.mock_server import MockS3Server
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--size-mb', type=int, default=64)
+    parser.add_argument('--mbps', type=float, default=8.0,
+                        help='per-connection throughput limit, in MB/s')
+    parser.add_argument('--parts', type=int, nargs='+', default=[1, 2, 4, 8])
+    args = parser.parse_args()
+
+    size = args.size_mb * 1024 * 1024
+    handle, path = tempfile.mkstemp(suffix='.ply')
+    with os.fdopen(handle, 'wb') as f:
+        for _ in range(args.size_mb):
+            f.write(os.urandom(1024 * 1024))
+
+    client = Client('http://unused', 'access_key', 'secret', verbose=False,
+                    storage_pool_maxsize=max(args.parts))
+    print '{:>6} {:>10} {:>10}'.format('parts', 'seconds', 'MB/s')
+    try:
+        with MockS3Server(bytes_per_second=args.mbps * 1024 * 1024) as s3:
+            for part_count in args.parts:
+                start = time.time()
+                if part_count == 1:
+                    client.upload(s3.signed_upload_url('scan.ply'), path)
+                else:
+                    part_size = max(MULTIPART_MIN_PART_SIZE, -(-size // part_count))
+                    client.upload_multipart(
+                        s3.create_multipart_upload('scan.ply', part_count), path,
+                        part_size=part_size, max_workers=part_count)
+                elapsed = time.time() - start
+                print '{:>6} {:>10.2f} {:>10.2f}'.format(part_count, elapsed, args.size_mb / elapsed)
+    finally:
+        client.close()
+        os.remove(path)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,50 @@
+'''
+Download throughput against a bandwidth-limited local API stand-in, by read
+chunk size and number of concurrent Range requests.
+
+    python benchmarks/ranged_download.py --size-mb 64 --mbps 16
+'''
+import argparse
+import os
+import tempfile
+import time
+
+from bodylabs_api.client import Client
+from bodylabs_api.mock_server import MockApiServer
+from bodylabs_api.models import Artifact
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--size-mb', type=int, default=64)
+    parser.add_argument('--mbps', type=float, default=16.0,
+                        help='per-connection throughput limit in MB/s; 0 for unlimited')
+    parser.add_argument('--chunk-kb', type=int, nargs='+', default=[1, 64, 1024])
+    parser.add_argument('--ranges', type=int, nargs='+', default=[1, 2, 4, 8])
+    args = parser.parse_args()
+
+    output_dir = tempfile.mkdtemp()
+    server = MockApiServer(
+        download_size=args.size_mb * 1024 * 1024,
+        bytes_per_second=args.mbps * 1024 * 1024 if args.mbps else None
+    ).start()
+    client = Client(server.base_uri, 'access_key', 'secret', verbose=False, pool_maxsize=max(args.ranges))
+    print '{:>9} {:>7} {:>10} {:>10}'.format('chunk_kb', 'ranges', 'seconds', 'MB/s')
+    try:
+        artifact = Artifact({'serviceType': 'Benchmark'}, client).create()
+        output_path = os.path.join(output_dir, 'output.obj')
+        for chunk_kb in args.chunk_kb:
+            for ranges in args.ranges:
+                start = time.time()
+                client.download(artifact.download_uri, output_path, chunk_size=chunk_kb * 1024, ranges=ranges)
+                elapsed = time.time() - start
+                print '{:>9} {:>7} {:>10.2f} {:>10.2f}'.format(chunk_kb, ranges, elapsed, args.size_mb / elapsed)
+                os.remove(output_path)
+    finally:
+        client.close()
+        server.stop()
+        os.rmdir(output_dir)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,208 @@
+'''
+Reproducible end-to-end benchmarks against the in-process API stand-in.
+
+Runs uploads and downloads of several sizes, polling of many concurrent
+artifacts and batch pipelines, each --repeat times, and reports the median.
+Save the results of one release and compare the next against them:
+
+    python benchmarks/suite.py --save benchmarks/results/1.2.0.json
+    python benchmarks/suite.py --compare benchmarks/results/1.2.0.json
+'''
+import argparse
+import json
+import os
+import shutil
+import tempfile
+import time
+
+import bodylabs_api
+from bodylabs_api.batch import Batch
+from bodylabs_api.client import Client
+from bodylabs_api.mock_server import MockApiServer
+from bodylabs_api.models import Artifact, File
+from bodylabs_api.poller import Poller
+
+MB = 1024 * 1024
+
+
+class Scenario(object):
+    '''
+    setup(server, client, scratch) prepares one run and returns a function
+    to time; size is the number of bytes it moves, for throughput.
+    '''
+    def __init__(self, name, setup, size=None, server_options=None):
+        self.name = name
+        self.setup = setup
+        self.size = size
+        self.server_options = server_options or {}
+
+
+def _write_file(scratch, name, size):
+    path = os.path.join(scratch, name)
+    with open(path, 'wb') as f:
+        for start in range(0, size, MB):
+            f.write(os.urandom(min(MB, size - start)))
+    return path
+
+
+def upload(size):
+    def setup(server, client, scratch):
+        path = _write_file(scratch, 'scan.ply', size)
+        return lambda: File.from_local_path(path, client)
+    return Scenario('upload_{}mb'.format(size // MB), setup, size=size)
+
+
+def download(size, in_memory=False):
+    def setup(server, client, scratch):
+        artifact = Artifact({'serviceType': 'Benchmark'}, client).create()
+        if in_memory:
+            return lambda: artifact.download_bytes(blocking=False)
+        return lambda: artifact.download(os.path.join(scratch, 'output.obj'), blocking=False)
+    return Scenario(
+        'download_{}mb{}'.format(size // MB, '_in_memory' if in_memory else ''), setup, size=size,
+        server_options={'download_size': size})
+
+
+def poll(count, processing_delay):
+    def setup(server, client, scratch):
+        def run():
+            artifacts = [Artifact({'serviceType': 'Benchmark'}, client).create() for _ in range(count)]
+            with Poller(client, interval=processing_delay / 4) as poller:
+                for future in [poller.register(artifact) for artifact in artifacts]:
+                    future.result()
+        return run
+    return Scenario('poll_{}'.format(count), setup, server_options={'processing_delay': processing_delay})
+
+
+def batch(count, processing_delay):
+    def setup(server, client, scratch):
+        path = _write_file(scratch, 'scan.ply', MB)
+
+        def run():
+            jobs = Batch(client, max_workers=16, polling_interval=processing_delay / 4)
+            for index in range(count):
+                jobs.add(
+                    {'serviceType': 'Benchmark'},
+                    output_path=os.path.join(scratch, 'output{}.obj'.format(index)),
+                    files={'scan': path})
+            for result in jobs.run():
+                if result.error is not None:
+                    raise result.error
+        return run
+    return Scenario('batch_{}'.format(count), setup, server_options={'processing_delay': processing_delay})
+
+
+def scenarios(args):
+    return (
+        [upload(size * MB) for size in args.sizes_mb] +
+        [download(size * MB) for size in args.sizes_mb] +
+        [download(size * MB, in_memory=True) for size in args.sizes_mb] +
+        [poll(count, args.processing_delay) for count in args.counts] +
+        [batch(count, args.processing_delay) for count in args.counts]
+    )
+
+
+def _request_count(server):
+    # API requests, not double counting downloads or 304s, plus S3 PUTs
+    return (
+        sum(count for (method, _), count in server.request_counts.items()
+            if method not in ('DOWNLOAD', 'NOT_MODIFIED')) +
+        sum(server.requests_by_key.values())
+    )
+
+
+def run_scenario(scenario, args):
+    timings = []
+    requests = None
+    for _ in range(args.repeat):
+        scratch = tempfile.mkdtemp()
+        server = MockApiServer(latency=args.latency_ms / 1000.0, **scenario.server_options).start()
+        client = Client(server.base_uri, 'access_key', 'secret', verbose=False, pool_maxsize=16)
+        try:
+            run = scenario.setup(server, client, scratch)
+            requests_before = _request_count(server)
+            started_at = time.time()
+            run()
+            timings.append(time.time() - started_at)
+            requests = _request_count(server) - requests_before
+        finally:
+            client.close()
+            server.stop()
+            shutil.rmtree(scratch)
+
+    seconds = sorted(timings)[len(timings) // 2]
+    result = {'seconds': seconds, 'requests': requests}
+    if scenario.size:
+        result['mb_per_second'] = scenario.size / MB / seconds
+    return result
+
+
+def compare(results, baseline, threshold):
+    '''
+    Print each scenario's change from baseline, returning the names of those
+    that slowed down by more than threshold (a fraction)
+    '''
+    regressions = []
+    print '\n{:<28} {:>10} {:>10} {:>8}'.format('vs. ' + baseline['version'], 'before', 'after', 'change')
+    for name, result in sorted(results.items()):
+        before = baseline['results'].get(name)
+        if before is None:
+            continue
+        change = result['seconds'] / before['seconds'] - 1
+        regressed = change > threshold
+        if regressed:
+            regressions.append(name)
+        print '{:<28} {:>10.3f} {:>10.3f} {:>+7.0%}{}'.format(
+            name, before['seconds'], result['seconds'], change, '  REGRESSION' if regressed else '')
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--sizes-mb', type=int, nargs='+', default=[1, 16])
+    parser.add_argument('--counts', type=int, nargs='+', default=[10, 100],
+                        help='concurrent artifacts for the polling and batch scenarios')
+    parser.add_argument('--processing-delay', type=float, default=0.5)
+    parser.add_argument('--latency-ms', type=float, default=5.0, help='added to every response')
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--only', nargs='+', help='run only scenarios whose names start with these')
+    parser.add_argument('--save', help='write the results to this JSON file')
+    parser.add_argument('--compare', help='compare with results saved by an earlier --save')
+    parser.add_argument('--threshold', type=float, default=0.1,
+                        help='slowdown, as a fraction, reported as a regression')
+    args = parser.parse_args()
+
+    results = {}
+    print '{:<28} {:>10} {:>10} {:>10}'.format('scenario', 'seconds', 'MB/s', 'requests')
+    for scenario in scenarios(args):
+        if args.only and not any(scenario.name.startswith(prefix) for prefix in args.only):
+            continue
+        result = results[scenario.name] = run_scenario(scenario, args)
+        print '{:<28} {:>10.3f} {:>10} {:>10}'.format(
+            scenario.name, result['seconds'],
+            '{:.1f}'.format(result['mb_per_second']) if 'mb_per_second' in result else '-',
+            result['requests'])
+
+    if args.save:
+        import platform
+        if os.path.dirname(args.save) and not os.path.isdir(os.path.dirname(args.save)):
+            os.makedirs(os.path.dirname(args.save))
+        with open(args.save, 'w') as f:
+            json.dump({
+                'version': bodylabs_api.__version__,
+                'python': platform.python_version(),
+                'platform': platform.platform(),
+                'createdAt': time.time(),
+                'settings': {key: value for key, value in vars(args).items() if key not in ('save', 'compare')},
+                'results': results,
+            }, f, indent=2, sort_keys=True)
+
+    if args.compare:
+        with open(args.compare, 'r') as f:
+            baseline = json.load(f)
+        if compare(results, baseline, args.threshold):
+            raise SystemExit(1)
+
+
+if __name__ == '__main__':
+    main()
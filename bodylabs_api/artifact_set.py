@@ -0,0 +1,230 @@
+'''
+A compact, columnar collection of many artifacts' metadata.
+
+Keeping tens of thousands of Artifact models in memory costs an object, a
+Timeline and a decoded raw_json dict apiece. An ArtifactSet instead keeps ids
+in a list, statuses and service types as small integer codes in arrays, and
+each artifact's JSON as a compact encoded string, decoded only when asked
+for. Filtering by status or service type scans the code arrays, and bulk
+updates from refresh responses only re-encode the rows that changed.
+
+    artifacts = ArtifactSet(client, raw_jsons)
+    changed = artifacts.refresh(bulk_uri='{base_uri}/query')
+    for artifact in artifacts.artifacts(status='ready'):
+        artifact.download(...)
+'''
+import json
+import threading
+from array import array
+
+# Statuses after which an artifact is no longer refreshed
+TERMINAL_STATUSES = ('ready', 'failed')
+
+
+# Reused, since json.dumps builds a new encoder per call given any options
+_encode = json.JSONEncoder(separators=(',', ':')).encode
+
+
+class _Codes(object):
+    '''
+    Interns the distinct values of a column as integer codes
+    '''
+    __slots__ = ['values', '_codes']
+
+    def __init__(self):
+        self.values = []
+        self._codes = {}
+
+    def code(self, value):
+        code = self._codes.get(value)
+        if code is None:
+            code = self._codes[value] = len(self.values)
+            self.values.append(value)
+        return code
+
+    def matching(self, values):
+        '''
+        Codes of values, a single value or a tuple or list of them
+        '''
+        if not isinstance(values, (tuple, list, set, frozenset)):
+            values = (values,)
+        return frozenset(self._codes[value] for value in values if value in self._codes)
+
+
+class ArtifactSet(object):
+    '''
+    Artifacts' metadata by id, built from the raw JSON of API responses.
+    Artifact models are only made on request, by artifact, artifacts or
+    iteration, and are independent copies: update the set from their
+    raw_json to keep it current.
+    '''
+    def __init__(self, client, raw_jsons=(), model_class=None):
+        from bodylabs_api.models import Artifact
+        self.client = client
+        self.model_class = model_class or Artifact
+        self._ids = []
+        self._rows = {}
+        self._json = []
+        self._statuses = _Codes()
+        self._service_types = _Codes()
+        self._status = array('H')
+        self._service_type = array('H')
+        self._lock = threading.Lock()
+        self.update(raw_jsons)
+
+    def __len__(self):
+        return len(self._ids)
+
+    def __contains__(self, artifact_id):
+        return artifact_id in self._rows
+
+    def __iter__(self):
+        return self.artifacts()
+
+    def __repr__(self):
+        return '<{} of {}>'.format(self.__class__.__name__, len(self))
+
+    def update(self, raw_jsons):
+        '''
+        Add or replace the metadata of each artifact in raw_jsons, an iterable
+        of dicts such as refresh responses, returning the ids of those whose
+        status changed or which are new
+        '''
+        id_field = self.model_class.id_field
+        changed = []
+        with self._lock:
+            for raw_json in raw_jsons:
+                artifact_id = raw_json[id_field]
+                status = self._statuses.code(raw_json.get('status'))
+                service_type = self._service_types.code(raw_json.get('serviceType'))
+                encoded = _encode(raw_json)
+                row = self._rows.get(artifact_id)
+                if row is None:
+                    self._rows[artifact_id] = len(self._ids)
+                    self._ids.append(artifact_id)
+                    self._json.append(encoded)
+                    self._status.append(status)
+                    self._service_type.append(service_type)
+                    changed.append(artifact_id)
+                    continue
+                if self._status[row] != status:
+                    changed.append(artifact_id)
+                if self._json[row] != encoded:
+                    self._json[row] = encoded
+                    self._status[row] = status
+                    self._service_type[row] = service_type
+        return changed
+
+    def discard(self, artifact_id):
+        '''
+        Remove an artifact, if present, by moving the last row into its place
+        '''
+        with self._lock:
+            row = self._rows.pop(artifact_id, None)
+            if row is None:
+                return
+            last = len(self._ids) - 1
+            if row != last:
+                self._ids[row] = self._ids[last]
+                self._json[row] = self._json[last]
+                self._status[row] = self._status[last]
+                self._service_type[row] = self._service_type[last]
+                self._rows[self._ids[row]] = row
+            del self._ids[last], self._json[last], self._status[last], self._service_type[last]
+
+    def status(self, artifact_id):
+        return self._statuses.values[self._status[self._rows[artifact_id]]]
+
+    def service_type(self, artifact_id):
+        return self._service_types.values[self._service_type[self._rows[artifact_id]]]
+
+    def raw_json(self, artifact_id):
+        '''
+        A newly decoded copy of the artifact's JSON
+        '''
+        return json.loads(self._json[self._rows[artifact_id]])
+
+    def artifact(self, artifact_id):
+        '''
+        A model_class instance for the artifact, using this set's client
+        '''
+        return self.model_class(self.raw_json(artifact_id), self.client)
+
+    def ids(self, status=None, service_type=None):
+        '''
+        Ids of the artifacts with the given status and service type, each of
+        which may be None (any), a value or a tuple or list of values, e.g.
+        ids(status=('pending', 'processing'))
+        '''
+        with self._lock:
+            rows = range(len(self._ids))
+            if status is not None:
+                codes = self._statuses.matching(status)
+                rows = [row for row, code in enumerate(self._status) if code in codes]
+            if service_type is not None:
+                codes = self._service_types.matching(service_type)
+                column = self._service_type
+                rows = [row for row in rows if column[row] in codes]
+            ids = self._ids
+            return [ids[row] for row in rows]
+
+    def artifacts(self, status=None, service_type=None):
+        '''
+        Like ids, but generating model_class instances
+        '''
+        for artifact_id in self.ids(status=status, service_type=service_type):
+            yield self.artifact(artifact_id)
+
+    def counts(self, by='status'):
+        '''
+        Dict of status (or with by='service_type', service type) to the
+        number of artifacts having it
+        '''
+        from collections import Counter
+        codes, column = {
+            'status': (self._statuses, self._status),
+            'service_type': (self._service_types, self._service_type),
+        }[by]
+        with self._lock:
+            counts = Counter(column)
+        return {codes.values[code]: count for code, count in counts.items()}
+
+    def refresh(self, ids=None, bulk_uri=None, bulk_size=100, max_workers=8):
+        '''
+        Refresh the given artifacts, by default all those not yet ready or
+        failed, and return the ids whose status changed.
+
+        As with bodylabs_api.poller.Poller, a bulk_uri such as
+        '{base_uri}/query' refreshes bulk_size artifacts per request, and any
+        it doesn't cover are refreshed with individual GETs on max_workers
+        threads.
+        '''
+        from concurrent.futures import ThreadPoolExecutor
+        from bodylabs_api.poller import fetch_bulk
+
+        if ids is None:
+            ids = self.ids(status=[status for status in self._statuses.values if status not in TERMINAL_STATUSES])
+        base_uri = self.model_class.base_uri
+        changed = []
+
+        individual = ids
+        if bulk_uri is not None:
+            individual = []
+            for start in range(0, len(ids), bulk_size):
+                chunk = ids[start:start + bulk_size]
+                try:
+                    by_id = fetch_bulk(self.client, bulk_uri, self.model_class, chunk)
+                except Exception: # pylint: disable=broad-except
+                    individual.extend(chunk) # fall back to individual GETs
+                    continue
+                changed.extend(self.update(by_id.values()))
+                individual.extend(artifact_id for artifact_id in chunk if artifact_id not in by_id)
+
+        def fetch(artifact_id):
+            return self.client.get('{}/{}'.format(base_uri, artifact_id), verbose=False)
+
+        if individual:
+            with ThreadPoolExecutor(max_workers=max_workers) as executor:
+                raw_jsons = list(executor.map(fetch, individual))
+            changed.extend(self.update(raw_jsons))
+        return changed
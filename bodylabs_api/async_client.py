@@ -0,0 +1,142 @@
+import heapq
+import threading
+import time
+
+from concurrent.futures import Future, ThreadPoolExecutor
+
+from bodylabs_api.client import Client
+
+
+def then(future, fn):
+    '''
+    Return a Future for fn(future.result()), without blocking. If fn returns
+    a Future, the returned Future resolves with its result instead. Exceptions
+    from future or fn propagate to the returned Future.
+    '''
+    chained = Future()
+
+    def copy_outcome(source):
+        if source.exception() is not None:
+            chained.set_exception(source.exception())
+        else:
+            chained.set_result(source.result())
+
+    def on_done(source):
+        if source.exception() is not None:
+            chained.set_exception(source.exception())
+            return
+        try:
+            value = fn(source.result())
+        except Exception as e: # pylint: disable=broad-except
+            chained.set_exception(e)
+            return
+        if isinstance(value, Future):
+            value.add_done_callback(copy_outcome)
+        else:
+            chained.set_result(value)
+
+    future.add_done_callback(on_done)
+    return chained
+
+
+class _Scheduler(object):
+    '''
+    Single daemon thread running callbacks at given times. Callbacks should
+    return quickly, e.g. by submitting work to an executor.
+    '''
+    def __init__(self):
+        self._queue = []
+        self._counter = 0
+        self._condition = threading.Condition()
+        self._stopped = False
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def call_at(self, when, fn, *args):
+        with self._condition:
+            self._counter += 1 # tie breaker; callbacks aren't comparable
+            heapq.heappush(self._queue, (when, self._counter, fn, args))
+            self._condition.notify()
+
+    def stop(self):
+        with self._condition:
+            self._stopped = True
+            self._condition.notify()
+
+    def _run(self):
+        while True:
+            with self._condition:
+                while not self._stopped and (not self._queue or self._queue[0][0] > time.time()):
+                    self._condition.wait(self._queue[0][0] - time.time() if self._queue else None)
+                if self._stopped:
+                    return
+                _, _, fn, args = heapq.heappop(self._queue)
+            try:
+                fn(*args)
+            except Exception: # pylint: disable=broad-except
+                pass # a failing callback must not stop the ones after it
+
+
+class AsyncClient(Client):
+    '''
+    Client whose *_async methods return concurrent.futures.Future objects
+    instead of blocking, so that one thread can drive many jobs at once.
+
+    Requests run on a pool of max_workers threads, which also sizes the
+    connection pools. Waiting (e.g. between polls in
+    Model.refresh_until_ready_async) is done by a single scheduler thread and
+    holds no worker, so thousands of pending jobs can be in flight at once.
+
+    The blocking Client methods remain available, and models constructed with
+    an AsyncClient support both their blocking and *_async methods.
+    '''
+    def __init__(self, base_uri, access_key, secret, verbose=False, max_workers=16, **kwargs):
+        kwargs.setdefault('pool_maxsize', max_workers)
+        kwargs.setdefault('storage_pool_maxsize', max_workers)
+        super(AsyncClient, self).__init__(base_uri, access_key, secret, verbose=verbose, **kwargs)
+        self.executor = ThreadPoolExecutor(max_workers=max_workers)
+        self._scheduler = _Scheduler()
+
+    def close(self):
+        self._scheduler.stop()
+        self.executor.shutdown(wait=True)
+        super(AsyncClient, self).close()
+
+    def submit(self, fn, *args, **kwargs):
+        '''
+        Run fn(*args, **kwargs) on the worker pool and return its Future
+        '''
+        return self.executor.submit(fn, *args, **kwargs)
+
+    def call_later(self, delay, fn, *args):
+        '''
+        Call fn(*args) on the scheduler thread after delay seconds
+        '''
+        self._scheduler.call_at(time.time() + delay, fn, *args)
+
+    def sleep(self, delay):
+        '''
+        Return a Future that resolves to None after delay seconds
+        '''
+        future = Future()
+        self.call_later(delay, future.set_result, None)
+        return future
+
+    def post_async(self, uri, payload, **kwargs):
+        return self.submit(self.post, uri, payload, **kwargs)
+
+    def patch_async(self, uri, payload, **kwargs):
+        return self.submit(self.patch, uri, payload, **kwargs)
+
+    def get_async(self, uri, **kwargs):
+        return self.submit(self.get, uri, **kwargs)
+
+    def download_async(self, uri, output_path, **kwargs):
+        return self.submit(self.download, uri, output_path, **kwargs)
+
+    def upload_async(self, signed_upload_url, source, **kwargs):
+        return self.submit(self.upload, signed_upload_url, source, **kwargs)
+
+    def verify_account_async(self):
+        return self.submit(self.verify_account)
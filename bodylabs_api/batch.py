@@ -0,0 +1,216 @@
+import time
+from collections import namedtuple
+
+from bodylabs_api.models import Artifact, File
+
+# error is None on success; otherwise the exception that ended the job, e.g.
+# ProcessingFailed, HttpError or harrison.timer.TimeoutError
+BatchResult = namedtuple('BatchResult', ['job', 'artifact', 'error'])
+
+
+class BatchJob(object):
+    '''
+    One unit of work in a Batch: upload any local files, create the artifact
+    and download its output once it is ready.
+
+    files maps dependency names to local paths; each is uploaded with
+    File.from_local_path and referenced as {'fileId': ...} under that name in
+    the payload's dependencies. output_path is a path for an Artifact, or a
+    dict of component name to path for a MultiComponentArtifact. With no
+    output_path the job finishes as soon as the artifact is ready.
+
+    name identifies the job in a journal; by default it's random. resumed is
+    the bodylabs_api.journal.ResumedJob a job picked up by Batch.resume
+    continues from.
+    '''
+    def __init__(self, payload, output_path=None, files=None, artifact_class=Artifact, name=None):
+        import uuid
+        self.payload = payload
+        self.output_path = output_path
+        self.files = files or {}
+        self.artifact_class = artifact_class
+        self.name = name or uuid.uuid4().hex
+        self.resumed = None
+        self.created_at = None
+
+    def __repr__(self):
+        return '<{} {} -> {}>'.format(
+            self.__class__.__name__, self.payload.get('serviceType'), self.output_path)
+
+
+class Batch(object):
+    '''
+    Run many jobs concurrently against one Client.
+
+    Creates and downloads are executed on a pool of max_workers threads; at
+    most max_inflight jobs (by default, all of them) have been submitted and
+    not yet finished at any time. Pending artifacts are all refreshed together
+    every polling_interval seconds by a Poller, which uses bulk_uri when given
+    (see Poller), and each download starts as soon as its artifact is ready.
+
+    Pass a bodylabs_api.cache.UploadCache as upload_cache to upload each
+    distinct file only once, a bodylabs_api.cache.PayloadMemo as payload_memo
+    to reuse artifacts created from identical payloads, and a
+    bodylabs_api.cache.ArtifactStore as artifact_store to reuse earlier
+    downloads.
+
+    With a bodylabs_api.journal.Journal, every job's progress is recorded, so
+    that after a crash a new Batch on the same journal can resume() the jobs
+    that didn't finish rather than starting them over.
+
+    Size the client's pool_maxsize to at least max_workers so that the
+    threads don't contend for connections.
+
+        batch = Batch(client, max_workers=16)
+        for payload, path in work:
+            batch.add(payload, output_path=path)
+        for result in batch.run():
+            ...
+
+    Unlike Model.refresh_until_ready, polling here doesn't rely on SIGALRM,
+    so run() may be called from any thread.
+    '''
+    def __init__(self, client, max_workers=8, max_inflight=None, polling_interval=10, timeout=1200,
+                 bulk_uri=None, upload_cache=None, artifact_store=None, payload_memo=None, journal=None):
+        self.client = client
+        self.max_workers = max_workers
+        self.max_inflight = max_inflight
+        self.polling_interval = polling_interval
+        self.timeout = timeout
+        self.bulk_uri = bulk_uri
+        self.upload_cache = upload_cache
+        self.artifact_store = artifact_store
+        self.payload_memo = payload_memo
+        self.journal = journal
+        self.jobs = []
+
+    def add(self, payload, output_path=None, files=None, artifact_class=Artifact, name=None):
+        job = BatchJob(payload, output_path=output_path, files=files, artifact_class=artifact_class, name=name)
+        self.jobs.append(job)
+        return job
+
+    def resume(self, names=None):
+        '''
+        Add the jobs of earlier runs that the journal hasn't seen finish (or
+        only those of them named in names), returning them. run() continues
+        each from its last recorded transition: polling (or downloading)
+        artifacts already created, repeating an interrupted create with its
+        idempotency key, and reusing finalized uploads.
+        '''
+        from bodylabs_api.journal import load_class
+        if self.journal is None:
+            raise ValueError('Batch needs a journal to resume from')
+        resumed = []
+        for entry in self.journal.unfinished(self.client):
+            details = entry.details
+            if 'payload' not in details:
+                continue # recorded outside a Batch
+            if names is not None and entry.name not in names:
+                continue
+            job = BatchJob(
+                details['payload'], output_path=details['output_path'], files=details['files'],
+                artifact_class=load_class(details['artifact_class']), name=entry.name)
+            job.resumed = entry
+            resumed.append(job)
+        self.jobs.extend(resumed)
+        return resumed
+
+    def _journal(self, job, label):
+        return self.journal.job(job.name, label) if self.journal is not None else None
+
+    def _create(self, job):
+        import copy
+        from bodylabs_api.journal import class_path
+        job.created_at = time.time()
+        recorded = job.resumed.models if job.resumed is not None else {}
+
+        artifact = recorded.get('artifact')
+        if artifact is not None and artifact.transition == 'creating':
+            # The POST may or may not have reached the API; with the same
+            # idempotency key, the API creates the artifact at most once
+            return artifact.model.create(
+                idempotency_key=artifact.details['idempotency_key'], journal=self._journal(job, 'artifact'))
+        elif artifact is not None:
+            return artifact.model.refresh()
+
+        if self.journal is not None and job.resumed is None:
+            self.journal.append(
+                job.name, 'submitted', payload=job.payload, output_path=job.output_path, files=job.files,
+                artifact_class=class_path(job.artifact_class))
+        payload = copy.deepcopy(job.payload)
+        for name, path in job.files.items():
+            label = 'file:' + name
+            if label in recorded and recorded[label].transition == 'finalized':
+                uploaded = recorded[label].model
+            else:
+                uploaded = File.from_local_path(
+                    path, self.client, cache=self.upload_cache, journal=self._journal(job, label))
+            payload.setdefault('dependencies', {})[name] = {'fileId': uploaded.file_id}
+        return job.artifact_class(payload, self.client).create(
+            memo=self.payload_memo, journal=self._journal(job, 'artifact'))
+
+    def _download(self, job, artifact):
+        if isinstance(job.output_path, dict):
+            artifact.download_components(job.output_path, blocking=False, store=self.artifact_store)
+        else:
+            artifact.download(job.output_path, blocking=False, store=self.artifact_store)
+        return artifact
+
+    def run(self):
+        '''
+        Generator yielding a BatchResult for each job as it finishes, in
+        completion order. A failing job is reported through its result's error
+        and does not affect the others.
+        '''
+        from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+        from bodylabs_api.exceptions import ProcessingFailed
+        from bodylabs_api.poller import Poller
+
+        queued = list(reversed(self.jobs))
+        inflight = [0]
+        futures = {}
+        executor = ThreadPoolExecutor(max_workers=self.max_workers)
+        poller = Poller(
+            self.client, interval=self.polling_interval, max_workers=self.max_workers,
+            bulk_uri=self.bulk_uri, timeout=self.timeout)
+
+        def submit(stage, job, fn, *args):
+            futures[executor.submit(fn, *args)] = (stage, job)
+
+        def admit():
+            while queued and (self.max_inflight is None or inflight[0] < self.max_inflight):
+                inflight[0] += 1
+                job = queued.pop()
+                submit('create', job, self._create, job)
+
+        def finish(job, artifact, error=None):
+            if self.journal is not None:
+                self.journal.append(job.name, 'finished', error=repr(error) if error is not None else None)
+            inflight[0] -= 1
+            admit()
+            return BatchResult(job, artifact, error)
+
+        try:
+            admit()
+            while futures:
+                done, _ = wait(futures.keys(), return_when=FIRST_COMPLETED)
+                for future in done:
+                    stage, job = futures.pop(future)
+                    error = future.exception()
+                    artifact = None if error else future.result()
+                    if error:
+                        yield finish(job, None, error)
+                    elif stage == 'download':
+                        yield finish(job, artifact)
+                    elif artifact.status == 'ready':
+                        if job.output_path is None:
+                            yield finish(job, artifact)
+                        else:
+                            submit('download', job, self._download, job, artifact)
+                    elif artifact.status == 'failed':
+                        yield finish(job, artifact, ProcessingFailed('Artifact {} failed'.format(artifact)))
+                    else:
+                        futures[poller.register(artifact)] = ('poll', job)
+        finally:
+            poller.stop()
+            executor.shutdown(wait=False)
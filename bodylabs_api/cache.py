@@ -0,0 +1,519 @@
+'''
+Local caches that let repeated work skip the network.
+
+The on-disk caches' indexes are SQLite databases in WAL mode, opened per
+operation with a busy timeout, so one cache may be shared by several threads
+and by several processes on the same host. MetadataCache lives in memory, in
+a single Client.
+'''
+import threading
+import time
+
+# Hash files this many bytes at a time, so memory stays flat for large scans
+HASH_CHUNK_SIZE = 1024 * 1024
+
+
+def hash_file(path, chunk_size=HASH_CHUNK_SIZE):
+    '''
+    Streamed SHA-256 hex digest of the file at path. hashlib releases the GIL
+    while hashing, so several files may be hashed in parallel on threads.
+    '''
+    import hashlib
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(chunk_size), ''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+class SqliteIndex(object):
+    '''
+    Base class for caches indexed by a SQLite database at path. Subclasses
+    list their CREATE statements in schema.
+    '''
+    schema = []
+
+    def __init__(self, path, timeout=30):
+        self.path = path
+        self.timeout = timeout
+        self.hits = 0
+        self.misses = 0
+        # Guards the counters, which threads sharing the index all update
+        self._lock = threading.Lock()
+        with self._connect() as connection:
+            connection.execute('PRAGMA journal_mode=WAL')
+            for statement in self.schema:
+                connection.execute(statement)
+
+    def _connect(self):
+        import sqlite3
+        # A fresh connection per operation: sqlite3 connections can't be
+        # shared across threads, and opening one is cheap
+        connection = sqlite3.connect(self.path, timeout=self.timeout)
+        connection.isolation_level = 'IMMEDIATE' # take the write lock up front
+        return _ClosingConnection(connection)
+
+    def record(self, hit):
+        with self._lock:
+            if hit:
+                self.hits += 1
+            else:
+                self.misses += 1
+
+    @property
+    def stats(self):
+        with self._lock:
+            return {'hits': self.hits, 'misses': self.misses}
+
+
+class _ClosingConnection(object):
+    '''
+    Context manager committing (or rolling back) and then closing a
+    connection; sqlite3's own only handles the transaction
+    '''
+    def __init__(self, connection):
+        self.connection = connection
+
+    def __enter__(self):
+        return self.connection
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        try:
+            if exc_type is None:
+                self.connection.commit()
+            else:
+                self.connection.rollback()
+        finally:
+            self.connection.close()
+
+
+class UploadCache(SqliteIndex):
+    '''
+    Maps (content hash, file type) to the fileId of an already finalized File,
+    so that File.from_local_path(..., cache=cache) can skip uploading the same
+    bytes again. Entries expire ttl seconds after they were stored; beyond
+    max_entries, the least recently used are evicted.
+    '''
+    schema = [
+        '''CREATE TABLE IF NOT EXISTS uploads (
+            content_hash TEXT NOT NULL,
+            file_type TEXT NOT NULL,
+            file_id TEXT NOT NULL,
+            stored_at REAL NOT NULL,
+            used_at REAL NOT NULL,
+            PRIMARY KEY (content_hash, file_type)
+        )''',
+        'CREATE INDEX IF NOT EXISTS uploads_used_at ON uploads (used_at)',
+    ]
+
+    def __init__(self, path, ttl=7 * 24 * 3600, max_entries=100000, **kwargs):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        super(UploadCache, self).__init__(path, **kwargs)
+
+    def get(self, content_hash, file_type):
+        '''
+        Return the cached fileId, or None
+        '''
+        now = time.time()
+        with self._connect() as connection:
+            connection.execute('DELETE FROM uploads WHERE stored_at < ?', (now - self.ttl,))
+            row = connection.execute(
+                'SELECT file_id FROM uploads WHERE content_hash = ? AND file_type = ?',
+                (content_hash, file_type)
+            ).fetchone()
+            if row is not None:
+                connection.execute(
+                    'UPDATE uploads SET used_at = ? WHERE content_hash = ? AND file_type = ?',
+                    (now, content_hash, file_type))
+        self.record(row is not None)
+        return row[0] if row is not None else None
+
+    def put(self, content_hash, file_type, file_id):
+        now = time.time()
+        with self._connect() as connection:
+            connection.execute(
+                'INSERT OR REPLACE INTO uploads VALUES (?, ?, ?, ?, ?)',
+                (content_hash, file_type, file_id, now, now))
+            connection.execute(
+                '''DELETE FROM uploads WHERE rowid IN (
+                    SELECT rowid FROM uploads ORDER BY used_at DESC LIMIT -1 OFFSET ?
+                )''', (self.max_entries,))
+
+    def invalidate(self, content_hash=None, file_type=None):
+        '''
+        Forget one file's entries (all file types unless file_type is given),
+        or everything when called without arguments
+        '''
+        with self._connect() as connection:
+            if content_hash is None:
+                connection.execute('DELETE FROM uploads')
+            elif file_type is None:
+                connection.execute('DELETE FROM uploads WHERE content_hash = ?', (content_hash,))
+            else:
+                connection.execute(
+                    'DELETE FROM uploads WHERE content_hash = ? AND file_type = ?',
+                    (content_hash, file_type))
+
+
+class ArtifactStore(SqliteIndex):
+    '''
+    Local store of downloaded artifact and component contents, kept in
+    directory and keyed by artifactId, component and serviceVersion. Once an
+    output is stored, Model.download(..., store=store) serves it again without
+    any network I/O, by hard-linking it to the output path when possible and
+    copying it otherwise. Since a hard link shares the stored bytes, don't
+    modify downloaded outputs in place, or pass link=False.
+
+    When max_bytes is exceeded, the least recently used outputs are evicted.
+    Downloading with revalidate=True instead sends the stored ETag in
+    If-None-Match, so unchanged outputs cost a 304 rather than a transfer.
+    An interrupted download leaves its partial file in the directory, named
+    after the key, and the next download of that key resumes it.
+    '''
+    schema = [
+        '''CREATE TABLE IF NOT EXISTS outputs (
+            key TEXT PRIMARY KEY,
+            filename TEXT NOT NULL,
+            size INTEGER NOT NULL,
+            etag TEXT,
+            used_at REAL NOT NULL
+        )''',
+        'CREATE INDEX IF NOT EXISTS outputs_used_at ON outputs (used_at)',
+    ]
+
+    def __init__(self, directory, max_bytes=10 * 1024 ** 3, link=True, **kwargs):
+        import os
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.link = link
+        self.revalidated = 0
+        super(ArtifactStore, self).__init__(os.path.join(directory, 'index.sqlite'), **kwargs)
+
+    @staticmethod
+    def key(model, component=None):
+        return '{}/{}@{}'.format(
+            model.raw_json.get(model.id_field), component or '', model.raw_json.get('serviceVersion'))
+
+    def _stored_path(self, filename):
+        import os
+        return os.path.join(self.directory, filename)
+
+    def _download_path(self, key):
+        import hashlib
+        return self._stored_path(hashlib.sha1(key.encode('utf-8')).hexdigest() + '.download')
+
+    def _discard_partial(self, download_path):
+        import os
+        # The partial file and progress a Download keeps beside its output
+        for path in (download_path + '.part', download_path + '.part.json'):
+            if os.path.exists(path):
+                os.remove(path)
+
+    def _lookup(self, key):
+        with self._connect() as connection:
+            row = connection.execute('SELECT filename, etag FROM outputs WHERE key = ?', (key,)).fetchone()
+            if row is not None:
+                connection.execute('UPDATE outputs SET used_at = ? WHERE key = ?', (time.time(), key))
+        return row
+
+    def _place(self, filename, output_path):
+        '''
+        Put the stored file at output_path, returning False if it has gone
+        missing (e.g. evicted by another process meanwhile)
+        '''
+        import os
+        import shutil
+        stored_path = self._stored_path(filename)
+        if os.path.exists(output_path):
+            os.remove(output_path)
+        if self.link:
+            try:
+                os.link(stored_path, output_path)
+                return True
+            except OSError:
+                pass # e.g. a different filesystem
+        try:
+            shutil.copyfile(stored_path, output_path)
+        except IOError:
+            return False
+        return True
+
+    def get(self, key, output_path):
+        '''
+        Place the stored output for key at output_path, returning whether
+        there was one
+        '''
+        row = self._lookup(key)
+        hit = row is not None and self._place(row[0], output_path)
+        self.record(hit)
+        return hit
+
+    def download(self, client, key, uri, output_path, ranges=1):
+        '''
+        Download uri through the store: revalidate the stored output for key,
+        if any, or download and store it, then place it at output_path
+        '''
+        import os
+        import tempfile
+        row = self._lookup(key)
+        temp_path = self._download_path(key)
+        try:
+            response = client.download(uri, temp_path, etag=row[1] if row is not None else None, ranges=ranges)
+            if response.get('notModified') and self._place(row[0], output_path):
+                with self._lock:
+                    self.revalidated += 1
+                self.record(True)
+                return
+            if response.get('notModified'):
+                # Stored copy vanished; fetch it unconditionally
+                response = client.download(uri, temp_path, ranges=ranges)
+            if row is not None:
+                self.record(False) # a failed revalidation; get counts the other misses
+            # A new name each time, so a replaced output can be evicted
+            handle, stored_path = tempfile.mkstemp(dir=self.directory)
+            os.close(handle)
+            os.rename(temp_path, stored_path)
+            filename = os.path.basename(stored_path)
+            self._insert(key, filename, response.get('etag'))
+            self._place(filename, output_path)
+        finally:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+
+    def _insert(self, key, filename, etag):
+        import os
+        size = os.path.getsize(self._stored_path(filename))
+        with self._connect() as connection:
+            replaced = connection.execute('SELECT filename FROM outputs WHERE key = ?', (key,)).fetchone()
+            connection.execute(
+                'INSERT OR REPLACE INTO outputs VALUES (?, ?, ?, ?, ?)',
+                (key, filename, size, etag, time.time()))
+            evicted = [replaced[0]] if replaced is not None else []
+            total = connection.execute('SELECT COALESCE(SUM(size), 0) FROM outputs').fetchone()[0]
+            for old_key, old_filename, old_size in connection.execute(
+                    'SELECT key, filename, size FROM outputs WHERE key != ? ORDER BY used_at', (key,)).fetchall():
+                if total <= self.max_bytes:
+                    break
+                connection.execute('DELETE FROM outputs WHERE key = ?', (old_key,))
+                evicted.append(old_filename)
+                total -= old_size
+        for old_filename in evicted:
+            try:
+                os.remove(self._stored_path(old_filename))
+            except OSError:
+                pass
+
+    def invalidate(self, key=None):
+        '''
+        Forget one stored output, or all of them
+        '''
+        import os
+        with self._connect() as connection:
+            if key is None:
+                rows = connection.execute('SELECT filename FROM outputs').fetchall()
+                connection.execute('DELETE FROM outputs')
+            else:
+                rows = connection.execute('SELECT filename FROM outputs WHERE key = ?', (key,)).fetchall()
+                connection.execute('DELETE FROM outputs WHERE key = ?', (key,))
+        if key is None:
+            for filename in os.listdir(self.directory):
+                if filename.endswith('.download.part'):
+                    self._discard_partial(self._stored_path(filename[:-len('.part')]))
+        else:
+            self._discard_partial(self._download_path(key))
+        for (filename,) in rows:
+            try:
+                os.remove(self._stored_path(filename))
+            except OSError:
+                pass
+
+
+def canonical_payload_hash(base_uri, payload):
+    '''
+    SHA-256 of a payload serialized with sorted keys and no insignificant
+    whitespace, so equal payloads hash equally regardless of key order
+    '''
+    import hashlib
+    import json
+    canonical = json.dumps([base_uri, payload], sort_keys=True, separators=(',', ':'))
+    return hashlib.sha256(canonical.encode('utf-8')).hexdigest()
+
+
+class PayloadMemo(SqliteIndex):
+    '''
+    Remembers which resource each distinct creation payload produced, so that
+    Model.create(memo=memo) returns the existing (ready or still pending)
+    resource instead of starting an identical backend job. Resources that
+    have failed or disappeared are forgotten and created afresh.
+
+    Entries expire ttl seconds after they were stored (by default, never).
+    Concurrent identical creates may both miss and create a resource each.
+    '''
+    schema = [
+        '''CREATE TABLE IF NOT EXISTS payloads (
+            payload_hash TEXT PRIMARY KEY,
+            resource_id TEXT NOT NULL,
+            stored_at REAL NOT NULL
+        )''',
+    ]
+
+    def __init__(self, path, ttl=None, **kwargs):
+        self.ttl = ttl
+        super(PayloadMemo, self).__init__(path, **kwargs)
+
+    def get(self, payload_hash):
+        '''
+        Return the id of the resource created from the payload, or None
+        '''
+        with self._connect() as connection:
+            if self.ttl is not None:
+                connection.execute('DELETE FROM payloads WHERE stored_at < ?', (time.time() - self.ttl,))
+            row = connection.execute(
+                'SELECT resource_id FROM payloads WHERE payload_hash = ?', (payload_hash,)).fetchone()
+        return row[0] if row is not None else None
+
+    def put(self, payload_hash, resource_id):
+        with self._connect() as connection:
+            connection.execute(
+                'INSERT OR REPLACE INTO payloads VALUES (?, ?, ?)', (payload_hash, resource_id, time.time()))
+
+    def invalidate(self, payload_hash=None, resource_id=None):
+        '''
+        Forget a payload or a resource, or everything when called without
+        arguments
+        '''
+        with self._connect() as connection:
+            if payload_hash is not None:
+                connection.execute('DELETE FROM payloads WHERE payload_hash = ?', (payload_hash,))
+            elif resource_id is not None:
+                connection.execute('DELETE FROM payloads WHERE resource_id = ?', (resource_id,))
+            else:
+                connection.execute('DELETE FROM payloads')
+
+
+class _CachedResponse(object):
+    __slots__ = ['content', 'etag', 'last_modified', 'ttl', 'expires_at']
+
+    def __init__(self, content, etag, last_modified, ttl):
+        self.content = content
+        self.etag = etag
+        self.last_modified = last_modified
+        self.ttl = ttl
+        self.expires_at = None
+        self.renew()
+
+    def renew(self):
+        self.expires_at = None if self.ttl is None else time.time() + self.ttl
+
+    @property
+    def fresh(self):
+        return self.expires_at is None or time.time() < self.expires_at
+
+    def json(self):
+        '''
+        A newly decoded copy, which the caller is free to modify
+        '''
+        import json
+        return json.loads(self.content)
+
+    def conditions(self):
+        '''
+        Headers revalidating this response
+        '''
+        headers = {}
+        if self.etag is not None:
+            headers['If-None-Match'] = self.etag
+        if self.last_modified is not None:
+            headers['If-Modified-Since'] = self.last_modified
+        return headers
+
+
+class MetadataCache(object):
+    '''
+    In-memory cache of API GET responses for Client(..., metadata_cache=...),
+    so that refresh, find_by_id and component validation skip the network
+    while a response is fresh, and otherwise revalidate it with a conditional
+    GET that the API may answer with a bodyless 304.
+
+    How long a response stays fresh depends on the status in its JSON: ttls
+    maps statuses to seconds, or to None for never expiring. Ready and failed
+    resources don't change, while pending and processing ones are only
+    trusted briefly; responses with other or no statuses (default_ttl 0) are
+    always revalidated. POSTs and PATCHes through the client invalidate the
+    resource they change. The least recently used of more than max_entries
+    responses are evicted.
+    '''
+    default_ttls = {'ready': None, 'failed': None, 'pending': 0.5, 'processing': 0.5}
+
+    def __init__(self, max_entries=10000, ttls=None, default_ttl=0):
+        from collections import OrderedDict
+        self.max_entries = max_entries
+        self.ttls = dict(self.default_ttls, **(ttls or {}))
+        self.default_ttl = default_ttl
+        self.hits = 0
+        self.misses = 0
+        self.revalidations = 0
+        self.evictions = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def lookup(self, url):
+        '''
+        The cached response for url, if any, counting a hit if it's fresh
+        '''
+        with self._lock:
+            entry = self._entries.pop(url, None)
+            if entry is None:
+                return None
+            self._entries[url] = entry # most recently used
+            if entry.fresh:
+                self.hits += 1
+        return entry
+
+    def put(self, url, content, raw_json, headers):
+        '''
+        Cache a 200 response to a GET of url, having missed
+        '''
+        status = raw_json.get('status') if isinstance(raw_json, dict) else None
+        entry = _CachedResponse(
+            content, headers.get('ETag'), headers.get('Last-Modified'), self.ttls.get(status, self.default_ttl))
+        with self._lock:
+            self.misses += 1
+            self._entries.pop(url, None)
+            self._entries[url] = entry
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def revalidated(self, entry):
+        '''
+        Note that the API confirmed entry is unchanged
+        '''
+        entry.renew()
+        with self._lock:
+            self.revalidations += 1
+
+    def invalidate(self, url=None):
+        '''
+        Forget the response for url, or everything when called without
+        arguments
+        '''
+        with self._lock:
+            if url is None:
+                self._entries.clear()
+            else:
+                self._entries.pop(url, None)
+
+    @property
+    def stats(self):
+        with self._lock:
+            return {
+                'hits': self.hits, 'misses': self.misses, 'revalidations': self.revalidations,
+                'evictions': self.evictions, 'entries': len(self._entries),
+            }
@@ -1,13 +1,16 @@
+import threading
 import urlparse
 from collections import namedtuple
 
 import requests
 
+from bodylabs_api.transfer import DOWNLOAD_CHUNK_SIZE
+
 # Tuple type allows us to pass status_code to visibility decorator below whose
 # decorated functions want to log the status_code but not return it
 IntermediateResponse = namedtuple('IntermediateResponse', ['status_code', 'json'])
 
-def expect_status(resp, status_code, verbose=True):
+def expect_status(resp, status_code):
     '''
     This is a more informative version of resp.raise_for_status that makes a
     more specific assertion and does not throw away the response in error
@@ -16,10 +19,7 @@ def expect_status(resp, status_code, verbose=True):
     from bodylabs_api.exceptions import HttpError
 
     if resp.status_code != status_code:
-        e = HttpError(resp, expected_status=status_code)
-        if verbose:
-            print 'Got {} {}\n'.format(e.actual_status, e.json)
-        raise e
+        raise HttpError(resp, expected_status=status_code)
 
 def visibility(f):
     '''
@@ -30,38 +30,312 @@ def visibility(f):
     data via IntermediateResponse type; the decorated functions will log both,
     but only return json data. the decorated versions of which will only
 
-    Also adds verbose flag to the method which takes precedence over
-    client.verbose and can be used to turn the print statements on/off. We use
-    this internally to reduce noise while repeatedly polling for an artifact.
+    Calls are reported to the client's hooks, if any; see
+    bodylabs_api.instrumentation. Printing is done by the PrintHook that
+    Client(verbose=True) attaches, so without hooks a call costs nothing
+    extra.
+
+    Also adds a verbose flag to the method; verbose=False keeps the call from
+    being printed. We use this internally to reduce noise while repeatedly
+    polling for an artifact.
     '''
+    action = f.__name__.upper()
+
     def _f(self, uri, *args, **kwargs):
-        resolved_verbose = kwargs.pop('verbose') if 'verbose' in kwargs else self.verbose
+        verbose = kwargs.pop('verbose', True)
+        # kwargs may still contain expected_status
+        if not self.hooks:
+            return f(self, uri, *args, **kwargs).json
+        return self._instrumented(action, uri, lambda: f(self, uri, *args, **kwargs), verbose=verbose).json
 
-        if resolved_verbose:
-            action = f.__name__.upper()
-            print '{} {} with additional args {}, kwargs {}'.format(action, uri, args, kwargs)
+    return _f
 
-        # kwargs may still contain expected_status
-        intermediate_resp = f(self, uri, *args, **kwargs)
 
-        if resolved_verbose:
-            print 'Got {} {}\n'.format(intermediate_resp.status_code, intermediate_resp.json)
-        return intermediate_resp.json
+# Upper bound on the bytes held in memory at once while streaming an upload
+UPLOAD_CHUNK_SIZE = 1024 * 1024
 
-    return _f
+
+class UploadBody(object):
+    '''
+    Read-only, file-like view of an upload source that lets requests stream
+    the body with a known Content-Length instead of loading it into memory.
+
+    source may be a path, a file-like object with read(), or an iterable of
+    byte strings. content_length is required for iterables and defaults to
+    the remaining size of files. No read returns more than chunk_size bytes,
+    so peak memory is bounded by chunk_size regardless of the source size.
+    '''
+    def __init__(self, source, content_length=None, chunk_size=UPLOAD_CHUNK_SIZE):
+        self._owns_file = isinstance(source, basestring)
+        if self._owns_file:
+            source = open(source, 'rb')
+
+        if hasattr(source, 'read'):
+            self._file = source
+            self._iterator = None
+        else:
+            self._file = None
+            self._iterator = iter(source)
+
+        if content_length is None:
+            content_length = self._remaining_file_size()
+        self.content_length = content_length
+        self.chunk_size = chunk_size
+        self._bytes_read = 0
+        self._buffer = ''
+
+    def _remaining_file_size(self):
+        import os
+        if self._file is None:
+            raise ValueError('content_length is required when uploading from an iterator')
+        try:
+            return os.fstat(self._file.fileno()).st_size - self._file.tell()
+        except (AttributeError, IOError, OSError):
+            pass
+        try:
+            position = self._file.tell()
+            self._file.seek(0, os.SEEK_END)
+            size = self._file.tell() - position
+            self._file.seek(position)
+            return size
+        except (AttributeError, IOError, OSError):
+            raise ValueError('content_length is required for unseekable file-like objects')
+
+    def __len__(self):
+        return self.content_length
+
+    def read(self, size=-1):
+        remaining = self.content_length - self._bytes_read
+        if size is None or size < 0 or size > self.chunk_size:
+            size = self.chunk_size
+        size = min(size, remaining)
+        if size <= 0:
+            return ''
+
+        if self._file is not None:
+            block = self._file.read(size)
+        else:
+            while not self._buffer:
+                try:
+                    self._buffer = next(self._iterator)
+                except StopIteration:
+                    break
+            block, self._buffer = self._buffer[:size], self._buffer[size:]
+
+        if not block:
+            raise ValueError('Upload source ended after {} of {} bytes'.format(
+                self._bytes_read, self.content_length))
+        self._bytes_read += len(block)
+        return block
+
+    def __iter__(self):
+        block = self.read()
+        while block:
+            yield block
+            block = self.read()
+
+    def close(self):
+        if self._owns_file:
+            self._file.close()
+
+
+# S3 rejects multipart uploads whose parts, other than the last, are smaller
+MULTIPART_MIN_PART_SIZE = 5 * 1024 * 1024
+# Base delay in seconds before retrying a failed part; doubles on each attempt
+MULTIPART_RETRY_DELAY = 0.5
+
+
+def _s3_version_id(resp):
+    version_field = 'x-amz-version-id'
+    if version_field in resp.headers:
+        return resp.headers[version_field]
+    else:
+        message = 'Header {} not found in {}. Make sure bucket versioning is enabled'.format(
+            version_field, resp.headers)
+        raise ValueError(message)
+
+
+def _pooled_session(pool_connections, pool_maxsize):
+    '''
+    Build a requests.Session whose adapters keep up to pool_maxsize keep-alive
+    connections per host, for up to pool_connections distinct hosts.
+    '''
+    session = requests.Session()
+    for prefix in ('http://', 'https://'):
+        session.mount(prefix, requests.adapters.HTTPAdapter(
+            pool_connections=pool_connections,
+            pool_maxsize=pool_maxsize
+        ))
+    return session
 
 
 class Client(object):
     '''
     Wrapper class around requests library that is injected into the Models for
     easy HTTP.
+
+    Requests go through two pooled, keep-alive sessions: one for the API
+    (base_uri) and one for the S3 signed URLs, so that polling and uploads
+    reuse connections instead of paying a TCP+TLS handshake every time.
+    pool_maxsize and storage_pool_maxsize bound the number of connections kept
+    per host; size them to the number of threads sharing this Client. The
+    underlying connection pools are thread safe, so one Client may be shared
+    across threads.
+
+    Transient failures are retried as retry_policy allows (by default a
+    bodylabs_api.retry.RetryPolicy(); NO_RETRY disables retries), and requests
+    to a host that keeps failing are refused by its circuit breaker, from
+    circuit_breakers (by default this Client's own; pass one
+    bodylabs_api.retry.CircuitBreakers to several Clients to share it). See
+    bodylabs_api.retry.
+
+    rate_limits optionally maps 'metadata', 'upload' and 'download' to a
+    bodylabs_api.ratelimit.RateLimit throttling those requests.
+
+    hooks are bodylabs_api.instrumentation.Hook instances notified of every
+    call, e.g. LoggingHook or MetricsCollector; verbose adds a PrintHook.
+
+    With a bodylabs_api.cache.MetadataCache, GETs are answered from the cache
+    while fresh and revalidated with conditional requests once stale.
+
+    accept_encoding lists the Content-Encodings downloads ask for, e.g.
+    ('zstd', 'gzip'); those unavailable here (see bodylabs_api.compression)
+    are left out. By default requests' own Accept-Encoding is sent.
     '''
-    def __init__(self, base_uri, access_key, secret, verbose=True):
+    def __init__(self, base_uri, access_key, secret, verbose=False,
+                 pool_maxsize=10, storage_pool_maxsize=10, retry_policy=None, circuit_breakers=None,
+                 rate_limits=None, hooks=None, metadata_cache=None, accept_encoding=None):
+        from bodylabs_api import retry
         self.base_uri = base_uri
         self.access_key = access_key
         self.secret = secret
         self.verbose = verbose
         self.headers = {'X-Requested-API-Version': 'v1'}
+        # Only the API host is ever contacted through session, so one pool
+        # suffices; signed URLs may point at a few regional S3 endpoints
+        self.session = _pooled_session(1, pool_maxsize)
+        self.storage_session = _pooled_session(4, storage_pool_maxsize)
+        self._local = threading.local()
+        self.retry_policy = retry_policy or retry.RetryPolicy()
+        self.circuit_breakers = circuit_breakers or retry.CircuitBreakers()
+        self.rate_limits = rate_limits or {}
+        self.hooks = list(hooks or [])
+        if verbose:
+            from bodylabs_api.instrumentation import PrintHook
+            self.hooks.append(PrintHook())
+        self.metadata_cache = metadata_cache
+        self.accept_encoding = accept_encoding
+
+    @property
+    def last_response_headers(self):
+        '''
+        Headers of the last API response received by the calling thread
+        '''
+        return getattr(self._local, 'headers', {})
+
+    def close(self):
+        '''
+        Release all pooled connections
+        '''
+        self.session.close()
+        self.storage_session.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def _instrumented(self, action, uri, call, verbose=True):
+        '''
+        Return call(), reporting it to the hooks as a RequestEvent which the
+        request methods fill in through _event while it runs
+        '''
+        import time
+        from bodylabs_api.instrumentation import RequestEvent, uri_template
+
+        if not isinstance(uri, basestring) or (urlparse.urlparse(uri).netloc and
+                                               not uri.startswith(self.base_uri)):
+            template = '{storage}' # signed S3 URLs, or a multipart upload
+        else:
+            template = uri_template(uri)
+        event = RequestEvent(action, uri, template, verbose=verbose)
+        for hook in self.hooks:
+            hook.before_request(event)
+
+        outer_event = self._event()
+        self._local.event = event
+        started_at = time.time()
+        try:
+            intermediate_resp = call()
+            event.status = intermediate_resp.status_code
+            event.result = intermediate_resp.json
+            return intermediate_resp
+        except Exception as e:
+            event.error = e
+            event.status = getattr(e, 'actual_status', None)
+            raise
+        finally:
+            event.latency = time.time() - started_at
+            self._local.event = outer_event
+            for hook in self.hooks:
+                hook.after_response(event)
+
+    def _event(self):
+        '''
+        The RequestEvent of the instrumented call in progress on this thread,
+        if any
+        '''
+        return getattr(self._local, 'event', None)
+
+    def _rate_limit(self, kind):
+        from bodylabs_api.ratelimit import UNLIMITED
+        return self.rate_limits.get(kind, UNLIMITED)
+
+    def _with_retries(self, method, url, send, idempotency_key=None, replayable=True, kind='metadata'):
+        '''
+        Return the response of send(), a function making one request, retrying
+        it while it fails transiently and it's safe to repeat. Each attempt
+        waits for the rate limit of kind.
+        '''
+        import time
+        from bodylabs_api.retry import RETRYABLE_ERRORS
+
+        policy = self.retry_policy
+        retryable = replayable and policy.is_idempotent(method, idempotency_key)
+        breaker = self.circuit_breakers.for_url(url)
+        limit = self._rate_limit(kind)
+        attempt = 1
+        while True:
+            breaker.before_request(url)
+            limit.wait()
+            try:
+                resp = send()
+            except RETRYABLE_ERRORS:
+                breaker.record(success=False)
+                if not retryable or attempt >= policy.max_attempts:
+                    raise
+                delay = policy.delay(attempt)
+            else:
+                failed = resp.status_code in policy.statuses
+                breaker.record(success=not failed)
+                if not failed or not retryable or attempt >= policy.max_attempts:
+                    return resp
+                delay = policy.delay(attempt, resp)
+                # Release the connection rather than hold it while sleeping
+                resp.close()
+            event = self._event()
+            if event is not None:
+                event.retries += 1
+                for hook in self.hooks:
+                    hook.retrying(event, delay)
+            time.sleep(delay)
+            attempt += 1
+
+    def _headers(self, idempotency_key=None):
+        if idempotency_key is None:
+            return self.headers
+        return dict(self.headers, **{'Idempotency-Key': idempotency_key})
 
     # Note that methods decorated with @visibility have their return values
     # changed from IntermediateResponse to just the json
@@ -69,81 +343,359 @@ class Client(object):
     # Standard HTTP verbs
 
     @visibility
-    def post(self, uri, payload, expected_status=202):
-        resp = requests.post(
-            urlparse.urljoin(self.base_uri, uri),
-            json=payload,
-            auth=(self.access_key, self.secret),
-            headers=self.headers
-        )
-        expect_status(resp, expected_status, verbose=self.verbose)
+    def post(self, uri, payload, expected_status=202, idempotency_key=None):
+        '''
+        Only retried on failure when sent with an idempotency_key, which the
+        API uses to recognize repeats of the same request
+        '''
+        url = urlparse.urljoin(self.base_uri, uri)
+        with self._rate_limit('metadata').inflight():
+            resp = self._with_retries('POST', url, lambda: self.session.post(
+                url,
+                json=payload,
+                auth=(self.access_key, self.secret),
+                headers=self._headers(idempotency_key)
+            ), idempotency_key=idempotency_key)
+        self._invalidate_cached(url)
+        self._count_bytes(resp)
+        expect_status(resp, expected_status)
+        self._local.headers = resp.headers
         return IntermediateResponse(resp.status_code, resp.json())
 
     @visibility
-    def patch(self, uri, payload, expected_status=202):
-        resp = requests.patch(
-            urlparse.urljoin(self.base_uri, uri),
-            json=payload,
-            auth=(self.access_key, self.secret),
-            headers=self.headers
-        )
-        expect_status(resp, expected_status, verbose=self.verbose)
+    def patch(self, uri, payload, expected_status=202, idempotency_key=None):
+        '''
+        Only retried on failure when sent with an idempotency_key, which the
+        API uses to recognize repeats of the same request
+        '''
+        url = urlparse.urljoin(self.base_uri, uri)
+        with self._rate_limit('metadata').inflight():
+            resp = self._with_retries('PATCH', url, lambda: self.session.patch(
+                url,
+                json=payload,
+                auth=(self.access_key, self.secret),
+                headers=self._headers(idempotency_key)
+            ), idempotency_key=idempotency_key)
+        self._invalidate_cached(url)
+        self._count_bytes(resp)
+        expect_status(resp, expected_status)
+        self._local.headers = resp.headers
         return IntermediateResponse(resp.status_code, resp.json())
 
     @visibility
     def get(self, uri, expected_status=200):
-        resp = requests.get(
-            urlparse.urljoin(self.base_uri, uri),
-            auth=(self.access_key, self.secret),
-            headers=self.headers
-        )
-        expect_status(resp, expected_status, verbose=self.verbose)
-        return IntermediateResponse(resp.status_code, resp.json())
+        url = urlparse.urljoin(self.base_uri, uri)
+        cache = self.metadata_cache
+        cached = cache.lookup(url) if cache is not None else None
+        if cached is not None and cached.fresh:
+            self._local.headers = {}
+            return IntermediateResponse(expected_status, cached.json())
+
+        headers = self.headers if cached is None else dict(self.headers, **cached.conditions())
+        with self._rate_limit('metadata').inflight():
+            resp = self._with_retries('GET', url, lambda: self.session.get(
+                url,
+                auth=(self.access_key, self.secret),
+                headers=headers
+            ))
+        self._count_bytes(resp)
+        if cached is not None and resp.status_code == 304:
+            cache.revalidated(cached)
+            self._local.headers = resp.headers
+            return IntermediateResponse(resp.status_code, cached.json())
+        expect_status(resp, expected_status)
+        self._local.headers = resp.headers
+        raw_json = resp.json()
+        if cache is not None:
+            cache.put(url, resp.content, raw_json, resp.headers)
+        return IntermediateResponse(resp.status_code, raw_json)
+
+    def _invalidate_cached(self, url):
+        '''
+        Drop the cached metadata of the resource a POST or PATCH to url
+        changes
+        '''
+        if self.metadata_cache is not None:
+            self.metadata_cache.invalidate(url)
+
+    def _count_bytes(self, resp):
+        event = self._event()
+        if event is not None:
+            event.bytes_sent += len(resp.request.body or '') if resp.request is not None else 0
+            event.bytes_received += len(resp.content)
 
     # Other operations, not quite standard HTTP verbs
 
+    def _download_request(self, uri, etag=None):
+        '''
+        Returns a function performing the streaming GET of uri, adding its
+        extra_headers argument (e.g. Range) to the usual ones
+        '''
+        headers = self.headers
+        if etag is not None:
+            headers = dict(self.headers, **{'If-None-Match': etag})
+        if self.accept_encoding is not None:
+            from bodylabs_api.compression import accept_encoding
+            headers = dict(headers, **{'Accept-Encoding': accept_encoding(self.accept_encoding)})
+
+        url = urlparse.urljoin(self.base_uri, uri)
+
+        def request(extra_headers):
+            return self._with_retries('GET', url, lambda: self.session.get(
+                url,
+                auth=(self.access_key, self.secret),
+                headers=dict(headers, **extra_headers) if extra_headers else headers,
+                stream=True
+            ), kind='download')
+        return request
+
     @visibility
-    def download(self, uri, output_path, expected_status=200):
-        resp = requests.get(
-            urlparse.urljoin(self.base_uri, uri),
-            auth=(self.access_key, self.secret),
-            headers=self.headers,
-            stream=True
-        )
-        expect_status(resp, expected_status, verbose=self.verbose)
-        with open(output_path, 'wb') as f:
-            for block in resp.iter_content(1024):
-                f.write(block)
-        return IntermediateResponse(resp.status_code, {})
+    def download(self, uri, output_path, expected_status=200, etag=None,
+                 chunk_size=DOWNLOAD_CHUNK_SIZE, ranges=1, max_resumes=3):
+        '''
+        Download uri to output_path, returning {'etag': ...} from the
+        response. When etag is given the request is conditional, and if the
+        content still matches, output_path is left untouched and
+        {'notModified': True} is returned.
+
+        The content is verified and atomically renamed into place, and an
+        interrupted download resumes from its partial file; with ranges > 1,
+        large files are fetched as that many concurrent Range requests. See
+        bodylabs_api.transfer for details.
+        '''
+        from bodylabs_api.transfer import Download
+        request = self._download_request(uri, etag=etag)
+        download = Download(request, output_path, chunk_size=chunk_size, ranges=ranges, max_resumes=max_resumes)
+        with self._rate_limit('download').inflight():
+            resp = download.run(lambda resp: expect_status(resp, expected_status))
+        if resp.status_code == 304:
+            if etag is None:
+                expect_status(resp, expected_status)
+            return IntermediateResponse(resp.status_code, {'notModified': True})
+        if self._event() is not None:
+            import os
+            self._event().bytes_received = os.path.getsize(output_path)
+        return IntermediateResponse(resp.status_code, {'etag': resp.headers.get('ETag')})
+
+    def _stream(self, uri, expected_status, chunk_size, max_resumes):
+        from bodylabs_api.transfer import Stream
+        return Stream(
+            self._download_request(uri), lambda resp: expect_status(resp, expected_status),
+            chunk_size=chunk_size, max_resumes=max_resumes)
 
     @visibility
-    def upload(self, signed_upload_url, filepath, expected_status=200):
-        with open(filepath, 'rb') as f:
-            # This request goes directly to S3 and so the request looks a
-            # little different (e.g. no auth, no version header)
-            resp = requests.put(
-                signed_upload_url,
-                data=f.read(),
-                headers={'Content-Type': 'application/octet-stream'}
-            )
-        expect_status(resp, expected_status, verbose=self.verbose)
-
-        version_field = 'x-amz-version-id'
-        if version_field in resp.headers:
-            return IntermediateResponse(
-                resp.status_code,
-                {'s3VersionId': resp.headers['x-amz-version-id']}
-            )
-        else:
-            message = 'Header {} not found in {}. Make sure bucket versioning is enabled'.format(
-                version_field, resp.headers)
-            raise ValueError(message)
+    def stream_download(self, uri, expected_status=200, chunk_size=DOWNLOAD_CHUNK_SIZE, max_resumes=3):
+        '''
+        Start downloading uri without writing it to disk, returning a
+        bodylabs_api.transfer.Stream: iterate over it for the content's
+        chunks, or use its write_into or read_all. Its requests are rate
+        limited, but as the caller decides how long it lasts, it doesn't take
+        a max_inflight slot. Hooks see the call end once the response's
+        headers have arrived.
+        '''
+        stream = self._stream(uri, expected_status, chunk_size, max_resumes)
+        return IntermediateResponse(stream.response.status_code, stream)
+
+    @visibility
+    def download_to(self, uri, target, expected_status=200, chunk_size=DOWNLOAD_CHUNK_SIZE, max_resumes=3):
+        '''
+        Download uri into target, a file-like object or writable buffer (see
+        bodylabs_api.transfer.Stream.write_into), returning the ETag and size
+        '''
+        with self._rate_limit('download').inflight():
+            stream = self._stream(uri, expected_status, chunk_size, max_resumes)
+            size = stream.write_into(target)
+        if self._event() is not None:
+            self._event().bytes_received = size
+        return IntermediateResponse(stream.response.status_code, {'etag': stream.etag, 'size': size})
+
+    @visibility
+    def upload(self, signed_upload_url, source, content_length=None, expected_status=200,
+               compression=None, compression_level=None):
+        '''
+        Stream source (a path, file-like object or iterable of byte strings)
+        to signed_upload_url. See UploadBody for the constraints on source.
+
+        With compression ('gzip' or 'zstd'), source is compressed, at
+        compression_level if given, into a temporary file that's sent with a
+        Content-Encoding. Only use it when the signed URL doesn't fix
+        another Content-Encoding and the backend decodes what it's sent.
+        '''
+        compressed = None
+        if compression is not None:
+            from bodylabs_api.compression import compress_to_file
+            body = UploadBody(source, content_length=content_length)
+            try:
+                compressed, content_length = compress_to_file(body, compression, level=compression_level)
+            finally:
+                body.close()
+            source = compressed
+
+        # Retrying means reading source again: paths are reopened and
+        # seekable files rewound, but iterables can only be sent once
+        start = None
+        if hasattr(source, 'read'):
+            try:
+                start = source.tell()
+            except (AttributeError, IOError):
+                pass
+
+        event = self._event()
+        headers = {'Content-Type': 'application/octet-stream'}
+        if compression is not None:
+            headers['Content-Encoding'] = compression
+
+        def send():
+            if start is not None:
+                source.seek(start)
+            body = UploadBody(source, content_length=content_length)
+            if event is not None:
+                event.bytes_sent += len(body)
+            try:
+                # This request goes directly to S3 and so the request looks a
+                # little different (e.g. no auth, no version header)
+                return self.storage_session.put(
+                    signed_upload_url,
+                    # requests falls back to chunked encoding for empty
+                    # streams, which S3 rejects
+                    data=body if len(body) else '',
+                    headers=dict(headers, **{'Content-Length': str(len(body))})
+                )
+            finally:
+                body.close()
+
+        try:
+            with self._rate_limit('upload').inflight():
+                resp = self._with_retries(
+                    'PUT', signed_upload_url, send, replayable=isinstance(source, basestring) or start is not None,
+                    kind='upload')
+        finally:
+            if compressed is not None:
+                compressed.close()
+        expect_status(resp, expected_status)
+
+        return IntermediateResponse(resp.status_code, {'s3VersionId': _s3_version_id(resp)})
+
+    @visibility
+    def upload_multipart(self, multipart_upload, path, part_size=None, max_workers=4,
+                         max_part_retries=3, expected_status=200):
+        '''
+        Upload the file at path in parallel parts using the signed URLs in
+        multipart_upload, as returned by POST /files when a partCount is
+        requested:
+
+            {'uploadId': ..., 'signedPartUrls': [...], 'signedCompleteUrl': ...,
+             'signedAbortUrl': ...}
+
+        The file is split into consecutive parts of part_size bytes (by default
+        len(signedPartUrls) equal parts), which are streamed on a pool of max_workers threads. A part
+        that fails with a connection error or 5xx is retried on its own up to
+        max_part_retries times before the whole upload is abandoned: parts not
+        yet started are cancelled, those in progress are waited for, and the
+        upload is aborted through signedAbortUrl, when given, so that its
+        parts aren't left in storage.
+        '''
+        import os
+        from concurrent.futures import ThreadPoolExecutor
+
+        part_urls = multipart_upload['signedPartUrls']
+        file_size = os.path.getsize(path)
+        part_size = part_size or -(-file_size // len(part_urls)) # ceiling division
+        if part_size * len(part_urls) < file_size:
+            raise ValueError('{} parts of {} bytes cannot hold {} bytes'.format(
+                len(part_urls), part_size, file_size))
+        if len(part_urls) > 1 and part_size < MULTIPART_MIN_PART_SIZE:
+            raise ValueError('Parts of {} bytes are below the S3 minimum of {}; request fewer parts'.format(
+                part_size, MULTIPART_MIN_PART_SIZE))
+
+        executor = ThreadPoolExecutor(max_workers=max_workers)
+        etag_futures = []
+        failed = True
+        try:
+            for part_index, part_url in enumerate(part_urls):
+                etag_futures.append(executor.submit(
+                    self._upload_part, part_url, path,
+                    offset=part_index * part_size,
+                    length=max(0, min(part_size, file_size - part_index * part_size)),
+                    max_retries=max_part_retries
+                ))
+            etags, retries = zip(*[future.result() for future in etag_futures])
+            failed = False
+        finally:
+            if failed:
+                for future in etag_futures:
+                    future.cancel()
+            executor.shutdown(wait=True)
+            if failed:
+                self._abort_multipart(multipart_upload)
+
+        parts_xml = ''.join(
+            '<Part><PartNumber>{}</PartNumber><ETag>{}</ETag></Part>'.format(part_number, etag)
+            for part_number, etag in enumerate(etags, start=1)
+        )
+        event = self._event()
+        if event is not None:
+            event.bytes_sent = file_size
+            event.retries = sum(retries)
+
+        resp = self.storage_session.post(
+            multipart_upload['signedCompleteUrl'],
+            data='<CompleteMultipartUpload>{}</CompleteMultipartUpload>'.format(parts_xml),
+            headers={'Content-Type': 'application/xml'}
+        )
+        expect_status(resp, expected_status)
+        return IntermediateResponse(resp.status_code, {'s3VersionId': _s3_version_id(resp)})
+
+    def _abort_multipart(self, multipart_upload):
+        '''
+        Abort an abandoned multipart upload, if it can be; a failure to do so
+        mustn't hide the one that made us give up
+        '''
+        abort_url = multipart_upload.get('signedAbortUrl')
+        if abort_url is None:
+            return
+        try:
+            self.storage_session.delete(abort_url)
+        except requests.exceptions.RequestException:
+            pass
+
+    def _upload_part(self, part_url, path, offset, length, max_retries):
+        '''
+        Returns the part's ETag and the number of retries it took
+        '''
+        import time
+        from bodylabs_api.exceptions import HttpError
+
+        limit = self._rate_limit('upload')
+        attempt = 0
+        while True:
+            try:
+                with limit.inflight(), open(path, 'rb') as f:
+                    limit.wait()
+                    f.seek(offset)
+                    body = UploadBody(f, content_length=length)
+                    resp = self.storage_session.put(
+                        part_url,
+                        data=body if length else '',
+                        headers={
+                            'Content-Type': 'application/octet-stream',
+                            'Content-Length': str(length),
+                        }
+                    )
+                expect_status(resp, 200)
+                return resp.headers['ETag'], attempt
+            except (HttpError, requests.exceptions.RequestException) as e:
+                permanent = isinstance(e, HttpError) and e.actual_status < 500
+                if permanent or attempt >= max_retries:
+                    raise
+                attempt += 1
+                time.sleep(MULTIPART_RETRY_DELAY * 2 ** (attempt - 1))
 
     def verify_account(self):
         '''
         Check account credentials and return boolean success or failure
         '''
-        resp = requests.get(
+        resp = self.session.get(
             urlparse.urljoin(self.base_uri, '/accounts/me'),
             auth=(self.access_key, self.secret),
             headers=self.headers
@@ -151,5 +703,5 @@ class Client(object):
         if resp.status_code == 401:
             return False
         else:
-            expect_status(resp, 204, verbose=False)
+            expect_status(resp, 204)
             return True
@@ -0,0 +1,114 @@
+'''
+Content-Encodings for compressed transfers: gzip, built on zlib, and zstd,
+which needs the optional zstandard package (pip install zstandard).
+
+Text PLY and OBJ meshes compress to half their size or less, which pays off
+on slow links; on fast ones the CPU time spent compressing costs more than
+the transfer time saved. See benchmarks/compression.py.
+'''
+import zlib
+
+# In order of preference when negotiating
+ENCODINGS = ('zstd', 'gzip')
+
+# Compressed uploads are spooled to memory up to this size, then to disk
+SPOOL_MAX_MEMORY = 16 * 1024 * 1024
+
+
+def _zstandard():
+    try:
+        import zstandard
+    except ImportError:
+        return None
+    return zstandard
+
+
+def available(encoding):
+    '''
+    Whether encoding can be compressed and decompressed here
+    '''
+    if encoding == 'zstd':
+        return _zstandard() is not None
+    return encoding == 'gzip'
+
+
+def _check(encoding):
+    if encoding not in ENCODINGS:
+        raise ValueError('Unsupported content encoding {!r}; expected one of {}'.format(
+            encoding, ', '.join(ENCODINGS)))
+    if not available(encoding):
+        raise ValueError('{} compression requires the zstandard package'.format(encoding))
+
+
+def accept_encoding(encodings):
+    '''
+    Accept-Encoding header value asking for those of encodings that are
+    available here, in the order given, or 'identity' if there are none
+    '''
+    if isinstance(encodings, basestring):
+        encodings = [encodings]
+    for encoding in encodings:
+        if encoding != 'identity' and encoding not in ENCODINGS:
+            raise ValueError('Unsupported content encoding {!r}'.format(encoding))
+    accepted = [encoding for encoding in encodings if available(encoding)]
+    return ', '.join(accepted) if accepted else 'identity'
+
+
+def compressor(encoding, level=None):
+    '''
+    Streaming compressor for encoding, with compress(data) and flush()
+    methods. level defaults to the library's.
+    '''
+    _check(encoding)
+    if encoding == 'gzip':
+        # wbits of 16 + MAX_WBITS writes a gzip header and trailer
+        return zlib.compressobj(
+            zlib.Z_DEFAULT_COMPRESSION if level is None else level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    return _zstandard().ZstdCompressor(level=3 if level is None else level).compressobj()
+
+
+class Decoder(object):
+    '''
+    Streaming decompressor for encoding: decode each block of encoded bytes
+    in turn, then flush for whatever remains
+    '''
+    def __init__(self, encoding):
+        _check(encoding)
+        if encoding == 'gzip':
+            self._decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        else:
+            self._decompressor = _zstandard().ZstdDecompressor().decompressobj()
+
+    def decode(self, block):
+        return self._decompressor.decompress(block)
+
+    def flush(self):
+        return self._decompressor.flush()
+
+
+def compress_to_file(blocks, encoding, level=None):
+    '''
+    Compress the byte strings in blocks into a temporary file, returning it,
+    rewound, and its length. Signed S3 PUTs need a Content-Length, which
+    isn't known until the whole source has been compressed.
+    '''
+    import tempfile
+    compressed = tempfile.SpooledTemporaryFile(max_size=SPOOL_MAX_MEMORY)
+    stream = compressor(encoding, level=level)
+    for block in blocks:
+        compressed.write(stream.compress(block))
+    compressed.write(stream.flush())
+    length = compressed.tell()
+    compressed.seek(0)
+    return compressed, length
+
+
+def decode_file(encoding, encoded_path, output_path, chunk_size=1024 * 1024):
+    '''
+    Decompress the file at encoded_path to output_path
+    '''
+    decoder = Decoder(encoding)
+    with open(encoded_path, 'rb') as encoded, open(output_path, 'wb') as output:
+        for block in iter(lambda: encoded.read(chunk_size), ''):
+            output.write(decoder.decode(block))
+        output.write(decoder.flush())
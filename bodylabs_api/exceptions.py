@@ -28,3 +28,24 @@ class HttpError(Exception):
             self.json = resp.json()
         except Exception: # pylint: disable=broad-except
             self.json = {}
+
+class DownloadVerificationFailed(Exception):
+    '''
+    Raised when downloaded content doesn't match the length or checksum the
+    server announced. The partial download is discarded.
+    '''
+    pass
+
+class CircuitOpen(Exception):
+    '''
+    Raised instead of sending a request to a host that has been failing
+    consistently; see bodylabs_api.retry.
+    '''
+    pass
+
+class DependencyFailed(Exception):
+    '''
+    Raised for a pipeline node that was never started because a node it
+    depends on failed; see bodylabs_api.pipeline.
+    '''
+    pass
@@ -0,0 +1,189 @@
+'''
+Hooks observing the requests a Client makes.
+
+Attach hooks with Client(..., hooks=[...]) or client.hooks.append(hook). For
+each call of post, patch, get, download, download_to, upload or
+upload_multipart, every hook's before_request is called with a RequestEvent
+before anything is sent, and its after_response once the call has finished
+or failed, with the event completed. With no hooks attached, no events are
+built.
+
+Client(..., verbose=True) attaches a PrintHook, which prints each call.
+'''
+import logging
+import re
+import threading
+from collections import namedtuple
+
+
+def uri_template(uri):
+    '''
+    uri with resource ids replaced by {id}, so that requests for different
+    resources are grouped together
+    '''
+    import urlparse
+    return re.sub(r'/(files|artifacts)/(?!query$)[^/]+', r'/\1/{id}', urlparse.urlparse(uri).path)
+
+
+class RequestEvent(object):
+    '''
+    One instrumented call. action is the Client method's name in upper case,
+    e.g. 'GET' or 'DOWNLOAD'; template is the uri with ids collapsed (see
+    uri_template), or '{storage}' for signed S3 URLs. The remaining fields are
+    filled in before after_response: status is None when the call failed
+    without a response, latency is in seconds, retries counts attempts
+    beyond the first and result is what the call returned, e.g. the JSON
+    response. verbose is False for calls asked not to be printed.
+    '''
+    fields = ('action', 'uri', 'template', 'status', 'latency', 'bytes_sent', 'bytes_received',
+              'retries', 'error')
+    __slots__ = list(fields) + ['result', 'verbose']
+
+    def __init__(self, action, uri, template, verbose=True):
+        self.action = action
+        self.uri = uri
+        self.template = template
+        self.status = None
+        self.latency = None
+        self.bytes_sent = 0
+        self.bytes_received = 0
+        self.retries = 0
+        self.error = None
+        self.result = None
+        self.verbose = verbose
+
+    def as_dict(self):
+        return {name: getattr(self, name) for name in self.fields}
+
+    def __repr__(self):
+        return '<RequestEvent {} {} {}>'.format(self.action, self.template, self.status)
+
+
+class Hook(object):
+    '''
+    Base class for hooks; both callbacks do nothing by default. They run on
+    the thread making the request, so should be quick and thread safe.
+    '''
+    def before_request(self, event):
+        pass
+
+    def after_response(self, event):
+        pass
+
+    def retrying(self, event, delay):
+        '''
+        Called before waiting delay seconds to retry the request
+        '''
+        pass
+
+
+class PrintHook(Hook):
+    '''
+    Print each call, its response and any retries to stdout, except for
+    calls made with verbose=False
+    '''
+    def before_request(self, event):
+        if event.verbose:
+            print '{} {}'.format(event.action, event.uri)
+
+    def after_response(self, event):
+        if not event.verbose:
+            return
+        if event.error is not None:
+            print 'Got {} {}\n'.format(event.status, getattr(event.error, 'json', repr(event.error)))
+        else:
+            print 'Got {} {}\n'.format(event.status, event.result)
+
+    def retrying(self, event, delay):
+        if event.verbose:
+            print 'Retrying {} {} in {:.1f} seconds'.format(event.action, event.uri, delay)
+
+
+class LoggingHook(Hook):
+    '''
+    Log each call to logger (by default bodylabs_api.client) at level, with
+    the event's fields in the record's extra data; failures are logged at
+    WARNING.
+    '''
+    def __init__(self, logger=None, level=logging.INFO):
+        self.logger = logger or logging.getLogger('bodylabs_api.client')
+        self.level = level
+
+    def after_response(self, event):
+        level = logging.WARNING if event.error is not None else self.level
+        if not self.logger.isEnabledFor(level):
+            return
+        self.logger.log(
+            level, '%s %s -> %s in %.3fs (%d bytes sent, %d received, %d retries)',
+            event.action, event.template, event.status if event.error is None else repr(event.error),
+            event.latency, event.bytes_sent, event.bytes_received, event.retries,
+            extra={'request': event.as_dict()})
+
+
+# Upper bounds, in seconds, of the latency histogram's buckets; slower calls
+# fall in a final, unbounded bucket
+LATENCY_BUCKETS = tuple(0.005 * 2 ** i for i in range(15)) # 5 ms to 82 s
+
+EndpointMetrics = namedtuple('EndpointMetrics', [
+    'count', 'errors', 'retries', 'bytes_sent', 'bytes_received', 'latency_histogram'])
+
+
+class MetricsCollector(Hook):
+    '''
+    Aggregates calls in memory by (action, template): counts, errors,
+    retries, bytes and a histogram of latencies over LATENCY_BUCKETS.
+
+        metrics = MetricsCollector()
+        client = Client(base_uri, access_key, secret, hooks=[metrics])
+        ...
+        metrics.percentile('GET', '/artifacts/{id}', 0.99)
+    '''
+    def __init__(self):
+        self._metrics = {}
+        self._lock = threading.Lock()
+
+    def after_response(self, event):
+        import bisect
+        key = (event.action, event.template)
+        bucket = bisect.bisect_left(LATENCY_BUCKETS, event.latency)
+        with self._lock:
+            metrics = self._metrics.get(key)
+            if metrics is None:
+                metrics = self._metrics[key] = [0, 0, 0, 0, 0, [0] * (len(LATENCY_BUCKETS) + 1)]
+            metrics[0] += 1
+            metrics[1] += event.error is not None
+            metrics[2] += event.retries
+            metrics[3] += event.bytes_sent
+            metrics[4] += event.bytes_received
+            metrics[5][bucket] += 1
+
+    def snapshot(self):
+        '''
+        Dict of (action, template) to EndpointMetrics
+        '''
+        with self._lock:
+            return {
+                key: EndpointMetrics(*(values[:5] + [list(values[5])]))
+                for key, values in self._metrics.items()
+            }
+
+    def percentile(self, action, template, fraction):
+        '''
+        Upper bound of the latency bucket holding the given fraction of calls,
+        e.g. 0.5 for the median; None if there were none, or inf if it's
+        beyond the last bucket
+        '''
+        metrics = self.snapshot().get((action, template))
+        if metrics is None:
+            return None
+        rank = fraction * metrics.count
+        seen = 0
+        for bound, count in zip(LATENCY_BUCKETS + (float('inf'),), metrics.latency_histogram):
+            seen += count
+            if seen >= rank and seen > 0:
+                return bound
+        return float('inf')
+
+    def reset(self):
+        with self._lock:
+            self._metrics = {}
@@ -0,0 +1,191 @@
+'''
+A durable, append-only journal of jobs, so that a pipeline can resume after
+its worker crashes instead of starting new backend jobs.
+
+Each job is a named sequence of transitions. Models record theirs when given
+a JobJournal: create records 'creating', with the idempotency key the POST
+will carry, before sending it and 'created', with the new id, after; File
+upload and finalize record 'uploaded' and 'finalized'. Each transition keeps
+the model's JSON at the time. A job's models are told apart by label, e.g.
+the name of a dependency. Model classes are recorded by module and name, so
+a subclass defined elsewhere can be resumed as long as its module imports.
+
+A Batch with a journal records every job it runs, and Batch.resume picks up
+the unfinished jobs of an earlier run where they left off: artifacts already
+created go straight back to polling and downloading, and a create that may or
+may not have reached the API is repeated with the same idempotency key, so
+the API creates the artifact at most once.
+
+Transitions are appended to a SQLite database in WAL mode, one transaction
+each, so a crash loses at most the transition being written. With the
+default synchronous='NORMAL', they survive the process crashing but not the
+host losing power; pass 'FULL' for that, at the cost of an fsync per
+transition.
+'''
+import json
+import time
+from collections import namedtuple
+
+from bodylabs_api.cache import SqliteIndex
+
+def class_path(model_class):
+    '''
+    The module and name under which load_class finds model_class again
+    '''
+    return '{}.{}'.format(model_class.__module__, model_class.__name__)
+
+
+def load_class(path):
+    '''
+    The class recorded by class_path. A bare name is looked up in
+    bodylabs_api.models.
+    '''
+    import importlib
+    module_name, _, name = path.rpartition('.')
+    try:
+        return getattr(importlib.import_module(module_name or 'bodylabs_api.models'), name)
+    except (ImportError, AttributeError):
+        raise ValueError('Cannot resume a journaled {}: it is not importable as {}'.format(name, path))
+
+
+# Transitions after which a job needs nothing more
+FINAL_TRANSITIONS = ('finished',)
+
+# One transition as read back: model is a Model rebuilt from the recorded
+# JSON, or None for transitions of the job as a whole
+Transition = namedtuple('Transition', ['job', 'label', 'transition', 'model', 'details', 'recorded_at'])
+
+# An unfinished job: details are those recorded with its first transition,
+# and models maps each label to the latest Transition recorded for it
+ResumedJob = namedtuple('ResumedJob', ['name', 'details', 'models'])
+
+
+class Journal(SqliteIndex):
+    '''
+    Journal at path, shared by every thread and process using that path.
+
+        journal = Journal('/var/lib/worker/jobs.sqlite')
+        job = journal.job('scan-123')
+        artifact = Artifact(payload, client).create(journal=job)
+    '''
+    schema = [
+        '''CREATE TABLE IF NOT EXISTS transitions (
+            seq INTEGER PRIMARY KEY AUTOINCREMENT,
+            job TEXT NOT NULL,
+            label TEXT,
+            transition TEXT NOT NULL,
+            model_class TEXT,
+            state TEXT,
+            details TEXT NOT NULL,
+            recorded_at REAL NOT NULL
+        )''',
+        'CREATE INDEX IF NOT EXISTS transitions_job ON transitions (job, seq)',
+        'CREATE INDEX IF NOT EXISTS transitions_final ON transitions (transition, job)',
+    ]
+
+    def __init__(self, path, synchronous='NORMAL', **kwargs):
+        if synchronous not in ('NORMAL', 'FULL'):
+            raise ValueError('synchronous must be NORMAL or FULL')
+        self.synchronous = synchronous
+        super(Journal, self).__init__(path, **kwargs)
+
+    def _connect(self):
+        closing = super(Journal, self)._connect()
+        closing.connection.execute('PRAGMA synchronous={}'.format(self.synchronous))
+        return closing
+
+    def job(self, name, label=None):
+        return JobJournal(self, name, label)
+
+    def append(self, job, transition, label=None, model=None, **details):
+        '''
+        Record a transition of job, and of model (if given) with its current
+        JSON. details must be JSON serializable.
+        '''
+        row = (
+            job, label, transition,
+            class_path(model.__class__) if model is not None else None,
+            json.dumps(model.raw_json) if model is not None else None,
+            json.dumps(details), time.time(),
+        )
+        with self._connect() as connection:
+            connection.execute(
+                '''INSERT INTO transitions (job, label, transition, model_class, state, details, recorded_at)
+                VALUES (?, ?, ?, ?, ?, ?, ?)''', row)
+
+    def _transitions(self, connection, where, params, client):
+        rows = connection.execute(
+            '''SELECT job, label, transition, model_class, state, details, recorded_at
+            FROM transitions {} ORDER BY seq'''.format(where), params)
+        for job, label, transition, model_class, state, details, recorded_at in rows:
+            model = None
+            if model_class is not None:
+                model = load_class(model_class)(json.loads(state), client)
+            yield Transition(job, label, transition, model, json.loads(details), recorded_at)
+
+    def history(self, job, client=None):
+        '''
+        The transitions of job, oldest first
+        '''
+        with self._connect() as connection:
+            return list(self._transitions(connection, 'WHERE job = ?', (job,), client))
+
+    def finished(self):
+        '''
+        Names of the jobs with a final transition
+        '''
+        with self._connect() as connection:
+            rows = connection.execute(
+                'SELECT DISTINCT job FROM transitions WHERE transition IN ({})'.format(
+                    ', '.join('?' * len(FINAL_TRANSITIONS))), FINAL_TRANSITIONS)
+            return set(row[0] for row in rows)
+
+    def unfinished(self, client):
+        '''
+        ResumedJobs for every job without a final transition, in the order
+        they started, with models rebuilt for client
+        '''
+        jobs = {}
+        order = []
+        where = 'WHERE job NOT IN (SELECT job FROM transitions WHERE transition IN ({}))'.format(
+            ', '.join('?' * len(FINAL_TRANSITIONS)))
+        with self._connect() as connection:
+            for entry in self._transitions(connection, where, FINAL_TRANSITIONS, client):
+                if entry.job not in jobs:
+                    jobs[entry.job] = ResumedJob(entry.job, entry.details, {})
+                    order.append(entry.job)
+                if entry.model is not None:
+                    jobs[entry.job].models[entry.label] = entry
+        return [jobs[name] for name in order]
+
+    def compact(self, before=None):
+        '''
+        Delete the transitions of finished jobs (those finished before the
+        given time, if any), which resuming never needs. Runs that skip
+        finished jobs, such as bodylabs_api.runner's, will then run them again.
+        '''
+        where = 'transition IN ({})'.format(', '.join('?' * len(FINAL_TRANSITIONS)))
+        params = FINAL_TRANSITIONS
+        if before is not None:
+            where += ' AND recorded_at < ?'
+            params += (before,)
+        with self._connect() as connection:
+            connection.execute(
+                'DELETE FROM transitions WHERE job IN (SELECT job FROM transitions WHERE {})'.format(where),
+                params)
+
+
+class JobJournal(object):
+    '''
+    Records the transitions of one job's models, under label
+    '''
+    def __init__(self, journal, job, label=None):
+        self.journal = journal
+        self.job = job
+        self.label = label
+
+    def labelled(self, label):
+        return JobJournal(self.journal, self.job, label)
+
+    def record(self, transition, model=None, **details):
+        self.journal.append(self.job, transition, label=self.label, model=model, **details)
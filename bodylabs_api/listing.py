@@ -0,0 +1,68 @@
+'''
+Lazily paginated listing of files and artifacts.
+
+GET /files and GET /artifacts take filters as query parameters (status,
+serviceType, createdAfter, createdBefore...), a page size as limit and the
+cursor of the page to continue from, and respond with a page of models' JSON
+keyed by the collection name, plus the cursor of the next page, if any:
+
+    {"artifacts": [...], "nextCursor": "..."}
+
+Model.list wraps this in a generator, so only the current page (and, with
+prefetch, the next) is held in memory however many models match.
+'''
+
+
+def list_query(filters):
+    '''
+    Query parameters for filters given as keyword arguments: names are
+    camelCased, datetimes formatted as ISO 8601 UTC and lists or tuples
+    joined with commas. None values are dropped.
+    '''
+    import datetime
+    import re
+    query = {}
+    for name, value in filters.items():
+        if value is None:
+            continue
+        if isinstance(value, datetime.datetime):
+            if value.utcoffset() is not None:
+                value = value.replace(tzinfo=None) - value.utcoffset()
+            value = value.strftime('%Y-%m-%dT%H:%M:%S.%fZ')
+        elif isinstance(value, (list, tuple, set, frozenset)):
+            value = ','.join(sorted(value))
+        query[re.sub(r'_([a-z])', lambda match: match.group(1).upper(), name)] = value
+    return query
+
+
+def iter_pages(client, uri, collection, query=None, page_size=100, prefetch=True):
+    '''
+    Generate the lists of raw JSON in each page of a listing. With prefetch,
+    the next page is requested on a background thread while the caller works
+    through the current one.
+    '''
+    import urllib
+    from concurrent.futures import ThreadPoolExecutor
+
+    def fetch(cursor):
+        params = dict(query or {}, limit=page_size)
+        if cursor is not None:
+            params['cursor'] = cursor
+        # Sorted, so that the same listing always makes the same requests
+        return client.get('{}?{}'.format(uri, urllib.urlencode(sorted(params.items()))), verbose=False)
+
+    executor = ThreadPoolExecutor(max_workers=1) if prefetch else None
+    try:
+        page = fetch(None)
+        while True:
+            cursor = page.get('nextCursor')
+            following = None
+            if cursor is not None and executor is not None:
+                following = executor.submit(fetch, cursor)
+            yield page.get(collection, [])
+            if cursor is None:
+                return
+            page = following.result() if following is not None else fetch(cursor)
+    finally:
+        if executor is not None:
+            executor.shutdown(wait=False)
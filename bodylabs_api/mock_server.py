@@ -0,0 +1,647 @@
+'''
+In-process stand-ins for the services the client talks to, for tests and
+benchmarks that need real HTTP round trips rather than mocked requests calls.
+'''
+import BaseHTTPServer
+import SocketServer
+import threading
+import urlparse
+
+from bodylabs_api.instrumentation import uri_template
+
+
+class _ThreadingHTTPServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+    # Benchmarks open many parallel connections at once
+    request_queue_size = 128
+
+    def __init__(self, *args, **kwargs):
+        BaseHTTPServer.HTTPServer.__init__(self, *args, **kwargs)
+        self.open_connections = set()
+        self.connections_lock = threading.Lock()
+
+    def process_request_thread(self, request, client_address):
+        with self.connections_lock:
+            self.open_connections.add(request)
+        try:
+            SocketServer.ThreadingMixIn.process_request_thread(self, request, client_address)
+        finally:
+            with self.connections_lock:
+                self.open_connections.discard(request)
+
+    def close_open_connections(self):
+        '''
+        Unblock handlers waiting on idle keep-alive connections
+        '''
+        import socket
+        with self.connections_lock:
+            for request in self.open_connections:
+                try:
+                    request.shutdown(socket.SHUT_RDWR)
+                except socket.error:
+                    pass
+
+    def handle_error(self, request, client_address):
+        import socket
+        import sys
+        # Clients hang up mid-response when they abandon a stream, e.g. a
+        # download switching to parallel Range requests
+        if not isinstance(sys.exc_info()[1], socket.error):
+            BaseHTTPServer.HTTPServer.handle_error(self, request, client_address)
+
+
+class MockServer(object):
+    '''
+    Base class running a threaded HTTP server on localhost in a background
+    thread. Subclasses provide handler_class. Use as a context manager, or
+    call start() and stop().
+
+    latency is added, in seconds, before every response, to approximate the
+    round trip to a remote server.
+    '''
+    handler_class = None
+
+    def __init__(self, latency=0):
+        self.latency = latency
+        self._httpd = None
+        self._thread = None
+
+    @property
+    def base_uri(self):
+        return 'http://127.0.0.1:{}'.format(self._httpd.server_port)
+
+    def start(self):
+        self._httpd = _ThreadingHTTPServer(('127.0.0.1', 0), self.handler_class)
+        self._httpd.mock = self
+        self._thread = threading.Thread(target=self._httpd.serve_forever, kwargs={'poll_interval': 0.05})
+        self._thread.daemon = True
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._httpd.shutdown()
+        self._httpd.close_open_connections()
+        self._httpd.server_close()
+        self._thread.join()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *args):
+        self.stop()
+
+
+class MockHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    '''
+    Keep-alive request handler with helpers for throttled reads and simple
+    responses. self.mock is the owning MockServer.
+    '''
+    protocol_version = 'HTTP/1.1'
+    # Headers and body are written separately; without this, delayed ACKs
+    # stall each keep-alive response by tens of milliseconds
+    disable_nagle_algorithm = True
+    # Bytes moved per throttling step
+    block_size = 64 * 1024
+
+    @property
+    def mock(self):
+        return self.server.mock
+
+    @property
+    def path_only(self):
+        return urlparse.urlparse(self.path).path
+
+    @property
+    def query(self):
+        return dict(urlparse.parse_qsl(urlparse.urlparse(self.path).query))
+
+    def log_message(self, *args): # pylint: disable=arguments-differ
+        pass
+
+    def read_body(self):
+        import time
+        remaining = int(self.headers.getheader('Content-Length') or 0)
+        blocks = []
+        while remaining:
+            block = self.rfile.read(min(remaining, self.block_size))
+            if not block:
+                break
+            remaining -= len(block)
+            blocks.append(block)
+            if self.mock.bytes_per_second:
+                time.sleep(float(len(block)) / self.mock.bytes_per_second)
+        return ''.join(blocks)
+
+    def respond(self, status_code, body='', headers=None, truncate_at=None):
+        '''
+        Send a response, throttled like read_body. With truncate_at, the
+        connection is dropped after that many bytes of the body.
+        '''
+        import time
+        if self.mock.latency:
+            time.sleep(self.mock.latency)
+        self.send_response(status_code)
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        if truncate_at is not None:
+            body = body[:truncate_at]
+            self.close_connection = True
+        if not self.mock.bytes_per_second:
+            self.wfile.write(body)
+            return
+        for start in range(0, len(body), self.block_size):
+            block = body[start:start + self.block_size]
+            self.wfile.write(block)
+            time.sleep(float(len(block)) / self.mock.bytes_per_second)
+
+
+class _MockS3Handler(MockHandler):
+
+    def do_PUT(self): # pylint: disable=invalid-name
+        body = self.read_body()
+        key = self.path_only
+        if self.mock.consume_failure(key, self.query.get('partNumber')):
+            return self.respond(503, 'SlowDown')
+        if 'uploadId' in self.query:
+            try:
+                etag = self.mock.put_part(self.query['uploadId'], int(self.query['partNumber']), body)
+            except KeyError:
+                return self.respond(404, 'NoSuchUpload')
+            return self.respond(200, headers={'ETag': etag})
+        encoding = self.headers.getheader('Content-Encoding')
+        if encoding is not None:
+            from bodylabs_api import compression
+            if not compression.available(encoding):
+                return self.respond(400, 'Unsupported Content-Encoding {}'.format(encoding))
+            decoder = compression.Decoder(encoding)
+            body = decoder.decode(body) + decoder.flush()
+        version_id = self.mock.put_object(key, body, encoding=encoding)
+        self.respond(200, headers={'x-amz-version-id': version_id})
+
+    def do_POST(self): # pylint: disable=invalid-name
+        import re
+        body = self.read_body()
+        key = self.path_only
+        parts = [
+            (int(part_number), etag)
+            for part_number, etag in re.findall(
+                r'<PartNumber>(\d+)</PartNumber><ETag>([^<]+)</ETag>', body)
+        ]
+        try:
+            version_id = self.mock.complete_multipart(key, self.query['uploadId'], parts)
+        except (KeyError, ValueError) as e:
+            return self.respond(400, 'InvalidPart: {}'.format(e))
+        self.respond(200, headers={'x-amz-version-id': version_id})
+
+    def do_DELETE(self): # pylint: disable=invalid-name
+        if not self.mock.abort_multipart(self.query.get('uploadId')):
+            return self.respond(404, 'NoSuchUpload')
+        self.respond(204)
+
+
+class MockS3Server(MockServer):
+    '''
+    Minimal S3-compatible store for signed-URL uploads, including multipart
+    uploads. URLs are not actually signed. aborted_uploads lists the ids of
+    the multipart uploads aborted through their signedAbortUrl.
+
+    bytes_per_second throttles each connection's reads, which approximates the
+    per-stream throughput limit that makes multipart upload worthwhile.
+    Use fail_next to inject 503 responses.
+
+    Objects PUT with a gzip or zstd Content-Encoding are stored decoded, as
+    by a backend that accepts compressed uploads; encodings records which.
+    '''
+    handler_class = _MockS3Handler
+
+    def __init__(self, bytes_per_second=None, latency=0):
+        super(MockS3Server, self).__init__(latency=latency)
+        self.bytes_per_second = bytes_per_second
+        self.objects = {}
+        self.encodings = {}
+        self.requests_by_key = {}
+        self._uploads = {}
+        self.aborted_uploads = []
+        self._failures = {}
+        self._lock = threading.Lock()
+
+    def signed_upload_url(self, key):
+        return '{}/bucket/{}'.format(self.base_uri, key)
+
+    def create_multipart_upload(self, key, part_count):
+        '''
+        Return the multipartUpload field that POST /files would include for a
+        file created with the given partCount
+        '''
+        import uuid
+        upload_id = uuid.uuid4().hex
+        with self._lock:
+            self._uploads[upload_id] = {}
+        url = self.signed_upload_url(key)
+        return {
+            'uploadId': upload_id,
+            'signedPartUrls': [
+                '{}?partNumber={}&uploadId={}'.format(url, part_number, upload_id)
+                for part_number in range(1, part_count + 1)
+            ],
+            'signedCompleteUrl': '{}?uploadId={}'.format(url, upload_id),
+            'signedAbortUrl': '{}?uploadId={}'.format(url, upload_id),
+        }
+
+    def fail_next(self, key, times=1, part_number=None):
+        '''
+        Answer the next `times` PUTs to key (or to one part of it) with a 503
+        '''
+        if part_number is not None:
+            part_number = str(part_number)
+        with self._lock:
+            self._failures[(key, part_number)] = times
+
+    def consume_failure(self, path, part_number):
+        key = path.split('/bucket/', 1)[-1]
+        with self._lock:
+            self.requests_by_key[key] = self.requests_by_key.get(key, 0) + 1
+            for failure_key in ((key, part_number), (key, None)):
+                if self._failures.get(failure_key):
+                    self._failures[failure_key] -= 1
+                    return True
+        return False
+
+    def put_object(self, key, body, encoding=None):
+        import uuid
+        version_id = uuid.uuid4().hex
+        key = key.split('/bucket/', 1)[-1]
+        with self._lock:
+            self.objects[key] = body
+            self.encodings[key] = encoding
+        return version_id
+
+    def put_part(self, upload_id, part_number, body):
+        import hashlib
+        etag = '"{}"'.format(hashlib.md5(body).hexdigest())
+        with self._lock:
+            self._uploads[upload_id][part_number] = (etag, body)
+        return etag
+
+    def abort_multipart(self, upload_id):
+        '''
+        Discard the parts of upload_id, returning whether it was in progress
+        '''
+        with self._lock:
+            if self._uploads.pop(upload_id, None) is None:
+                return False
+            self.aborted_uploads.append(upload_id)
+        return True
+
+    def complete_multipart(self, key, upload_id, parts):
+        with self._lock:
+            uploaded = self._uploads.pop(upload_id)
+        if [part_number for part_number, _ in parts] != sorted(uploaded):
+            raise ValueError('parts {} do not match uploaded parts'.format(parts))
+        for part_number, etag in parts:
+            if uploaded[part_number][0] != etag:
+                raise ValueError('ETag mismatch for part {}'.format(part_number))
+        return self.put_object(key, ''.join(uploaded[part_number][1] for part_number, _ in parts))
+
+
+class _MockApiHandler(_MockS3Handler):
+    '''
+    Serves the Body Labs API, and S3 under /bucket/
+    '''
+    def dispatch(self, method):
+        import json
+        if self.path_only.startswith('/bucket/'):
+            return getattr(_MockS3Handler, 'do_' + method)(self)
+
+        body = self.read_body()
+        if self.path_only == '/accounts/me':
+            return self.respond(204 if self.mock.authorized(self.headers) else 401)
+        if not self.mock.authorized(self.headers):
+            return self.respond_json(401, {'code': 'UNAUTHORIZED', 'message': 'Bad credentials'})
+
+        failure = self.mock.consume_api_failure(method, self.path_only)
+        if failure is not None:
+            return self.respond_json(failure, {'code': 'SERVICE_UNAVAILABLE', 'message': 'Injected failure'})
+        try:
+            status_code, response = self.mock.handle(
+                method, self.path_only, json.loads(body) if body else None, self.query,
+                idempotency_key=self.headers.getheader('Idempotency-Key'))
+        except KeyError as e:
+            return self.respond_json(404, {'code': 'NOT_FOUND_RESOURCE', 'message': '{} not found'.format(e)})
+        if isinstance(response, basestring):
+            return self.respond_content(response)
+        if method == 'GET':
+            return self.respond_json_conditionally(response)
+        self.respond_json(status_code, response)
+
+    def respond_json_conditionally(self, payload):
+        '''
+        Serve JSON with an ETag, or a 304 if it matches If-None-Match
+        '''
+        import hashlib
+        import json
+        body = json.dumps(payload, sort_keys=True)
+        etag = '"{}"'.format(hashlib.md5(body).hexdigest())
+        if self.headers.getheader('If-None-Match') == etag:
+            self.mock.count('NOT_MODIFIED', self.path_only)
+            return self.respond(304, headers={'ETag': etag})
+        self.respond(200, body, headers={'Content-Type': 'application/json', 'ETag': etag})
+
+    def _negotiate_encoding(self):
+        from bodylabs_api import compression
+        if not self.mock.compress_downloads:
+            return None
+        accepted = [
+            encoding.split(';')[0].strip()
+            for encoding in (self.headers.getheader('Accept-Encoding') or '').split(',')
+        ]
+        for encoding in compression.ENCODINGS:
+            if encoding in accepted and compression.available(encoding):
+                return encoding
+        return None
+
+    def respond_content(self, content):
+        '''
+        Serve downloadable content, honoring If-None-Match, Range and If-Range,
+        compressed when the mock's compress_downloads is set and the client
+        accepts gzip or zstd
+        '''
+        import base64
+        import hashlib
+        import re
+        encoding = self._negotiate_encoding()
+        if encoding is not None:
+            content = self.mock.encoded_content(content, encoding)
+        digest = hashlib.md5(content).digest()
+        etag = '"{}"'.format(digest.encode('hex'))
+        if self.headers.getheader('If-None-Match') == etag:
+            return self.respond(304, headers={'ETag': etag})
+
+        headers = {'Content-Type': 'application/octet-stream', 'ETag': etag, 'Accept-Ranges': 'bytes'}
+        if encoding is not None:
+            headers['Content-Encoding'] = encoding
+        status_code = 200
+        byte_range = re.match(r'bytes=(\d+)-(\d*)$', self.headers.getheader('Range') or '')
+        if byte_range and self.headers.getheader('If-Range') in (None, etag):
+            start = int(byte_range.group(1))
+            end = int(byte_range.group(2)) if byte_range.group(2) else len(content) - 1
+            if start >= len(content):
+                self.mock.count('DOWNLOAD', '416')
+                return self.respond(416, headers={'Content-Range': 'bytes */{}'.format(len(content))})
+            headers['Content-Range'] = 'bytes {}-{}/{}'.format(start, end, len(content))
+            status_code = 206
+            content = content[start:end + 1]
+        else:
+            headers['Content-MD5'] = base64.b64encode(digest)
+        self.mock.count('DOWNLOAD', str(status_code))
+        self.respond(status_code, content, headers=headers, truncate_at=self.mock.consume_truncation(len(content)))
+
+    def respond_json(self, status_code, payload):
+        import json
+        self.respond(status_code, json.dumps(payload), headers={'Content-Type': 'application/json'})
+
+    def do_GET(self): # pylint: disable=invalid-name
+        self.dispatch('GET')
+
+    def do_POST(self): # pylint: disable=invalid-name
+        self.dispatch('POST')
+
+    def do_PATCH(self): # pylint: disable=invalid-name
+        self.dispatch('PATCH')
+
+    def do_PUT(self): # pylint: disable=invalid-name
+        self.dispatch('PUT')
+
+
+class MockApiServer(MockS3Server):
+    '''
+    Stand-in for the Body Labs API: /files (with signed upload URLs served by
+    the embedded S3 stand-in), /artifacts, their downloads and components, and
+    /accounts/me.
+
+    Artifacts turn ready processing_delay seconds after they are created.
+    GET /artifacts/query?ids=a,b looks up several artifacts at once, and GET
+    /files or /artifacts lists them a page at a time, as bodylabs_api.listing
+    describes, ordered by createdAt.
+    components maps a serviceType to the component names its artifacts have.
+    Downloads return download_size bytes (by default a short string naming the
+    artifact), with an ETag honored by If-None-Match, Content-MD5 and support
+    for Range requests. Set truncate_downloads to drop the connection halfway
+    through that many of the following downloads. With compress_downloads,
+    downloads are served gzip or zstd encoded to clients accepting either;
+    ETags, Content-MD5 and ranges are then those of the encoded content.
+
+    POSTs with an Idempotency-Key create a resource only the first time the
+    key is seen; repeats get the same resource back.
+
+    GETs of JSON carry an ETag and are answered with a 304 when it matches
+    If-None-Match, counted as NOT_MODIFIED in request_counts.
+
+    Inject API failures with fail_requests, or at random with failure_rate,
+    the probability of answering any API request with a 503 (drawn from a
+    random.Random(seed), so runs are reproducible).
+    '''
+    handler_class = _MockApiHandler
+
+    def __init__(self, access_key='access_key', secret='secret', processing_delay=0,
+                 components=None, download_size=None, bytes_per_second=None, latency=0,
+                 failure_rate=0, seed=0, compress_downloads=False):
+        import random
+        super(MockApiServer, self).__init__(bytes_per_second=bytes_per_second, latency=latency)
+        self.access_key = access_key
+        self.secret = secret
+        self.processing_delay = processing_delay
+        self.components = components or {}
+        self.download_size = download_size
+        self.truncate_downloads = 0
+        self.compress_downloads = compress_downloads
+        self._encoded = {}
+        self.failure_rate = failure_rate
+        self._random = random.Random(seed)
+        self._api_failures = {}
+        self._created_by_key = {}
+        self.files = {}
+        self.artifacts = {}
+        self.request_counts = {}
+
+    def authorized(self, headers):
+        import base64
+        expected = 'Basic ' + base64.b64encode('{}:{}'.format(self.access_key, self.secret))
+        return headers.getheader('Authorization') == expected
+
+    def fail_requests(self, method, template, times=1, status_code=503):
+        '''
+        Answer the next `times` requests matching method and template (as in
+        request_counts, e.g. '/artifacts/{id}') with status_code
+        '''
+        with self._lock:
+            self._api_failures[(method, template)] = (times, status_code)
+
+    def consume_api_failure(self, method, path):
+        '''
+        Status code to fail this request with, if any
+        '''
+        key = (method, uri_template(path))
+        with self._lock:
+            times, status_code = self._api_failures.get(key, (0, None))
+            if times:
+                self._api_failures[key] = (times - 1, status_code)
+                return status_code
+            if self.failure_rate and self._random.random() < self.failure_rate:
+                return 503
+        return None
+
+    def count(self, method, path):
+        template = uri_template(path) # counts are per endpoint
+        with self._lock:
+            key = (method, template)
+            self.request_counts[key] = self.request_counts.get(key, 0) + 1
+
+    def consume_truncation(self, length):
+        '''
+        Where to cut off the next download, if truncate_downloads says it
+        should be cut off
+        '''
+        with self._lock:
+            if not self.truncate_downloads:
+                return None
+            self.truncate_downloads -= 1
+        return length // 2
+
+    def encoded_content(self, content, encoding):
+        '''
+        content compressed with encoding, compressing each content only once
+        '''
+        import hashlib
+        from bodylabs_api import compression
+        key = (hashlib.md5(content).digest(), encoding)
+        with self._lock:
+            encoded = self._encoded.get(key)
+        if encoded is None:
+            stream = compression.compressor(encoding)
+            encoded = stream.compress(content) + stream.flush()
+            with self._lock:
+                self._encoded[key] = encoded
+        return encoded
+
+    def artifact_contents(self, artifact_id, component=None):
+        if self.download_size is not None:
+            return 'x' * self.download_size
+        return 'contents of {}{}'.format(artifact_id, '/' + component if component else '')
+
+    def _artifact_json(self, artifact_id):
+        import time
+        record = self.artifacts[artifact_id]
+        if record['status'] == 'pending' and time.time() >= record['readyAt']:
+            record['status'] = 'ready'
+        return {key: value for key, value in record.items() if key != 'readyAt'}
+
+    @staticmethod
+    def _now():
+        import datetime
+        return datetime.datetime.utcnow().strftime('%Y-%m-%dT%H:%M:%S.%fZ')
+
+    def _list(self, collection, records, id_field, as_json, query):
+        '''
+        One page of a listing of records, filtered and paginated as query says
+        '''
+        exact = {name: value.split(',') for name, value in query.items()
+                 if name not in ('limit', 'cursor', 'createdAfter', 'createdBefore')}
+        with self._lock:
+            matching = sorted(
+                (as_json(record_id) for record_id in list(records)),
+                key=lambda record: (record['createdAt'], record[id_field]))
+        matching = [
+            record for record in matching
+            if all(record.get(name) in values for name, values in exact.items())
+            and record['createdAt'] > query.get('createdAfter', '')
+            and record['createdAt'] < query.get('createdBefore', '~')
+            and '{}|{}'.format(record['createdAt'], record[id_field]) > query.get('cursor', '')
+        ]
+        limit = int(query.get('limit', 100))
+        response = {collection: matching[:limit]}
+        if len(matching) > limit:
+            last = matching[limit - 1]
+            response['nextCursor'] = '{}|{}'.format(last['createdAt'], last[id_field])
+        return 200, response
+
+    def handle(self, method, path, payload, query=None, idempotency_key=None):
+        '''
+        Return (status_code, json or raw string body) for an API request.
+        Raises KeyError for unknown resources.
+        '''
+        self.count(method, path)
+        parts = path.strip('/').split('/')
+        if method != 'POST' or len(parts) != 1 or idempotency_key is None:
+            return self._handle(method, parts, payload, query)
+
+        with self._lock:
+            created = self._created_by_key.get((parts[0], idempotency_key))
+        if created is not None:
+            # A repeat of an earlier create
+            if parts[0] == 'files':
+                return 202, dict(self.files[created], signedUploadUrl=self.signed_upload_url(created))
+            return 202, self._artifact_json(created)
+        status_code, response = self._handle(method, parts, payload, query)
+        with self._lock:
+            self._created_by_key[(parts[0], idempotency_key)] = (
+                response['fileId'] if parts[0] == 'files' else response['artifactId'])
+        return status_code, response
+
+    def _handle(self, method, parts, payload, query):
+        import time
+        import uuid
+        path = '/' + '/'.join(parts)
+
+        if parts[0] == 'files':
+            if method == 'POST' and len(parts) == 1:
+                file_id = uuid.uuid4().hex
+                record = {'fileId': file_id, 'fileType': payload['fileType'], 'status': 'pending',
+                          'createdAt': self._now()}
+                with self._lock:
+                    self.files[file_id] = record
+                response = dict(record, signedUploadUrl=self.signed_upload_url(file_id))
+                if 'multipartUpload' in payload:
+                    response['multipartUpload'] = self.create_multipart_upload(
+                        file_id, payload['multipartUpload']['partCount'])
+                return 202, response
+            if method == 'GET' and len(parts) == 1:
+                return self._list('files', self.files, 'fileId', self.files.get, query or {})
+            record = self.files[parts[1]]
+            if method == 'PATCH':
+                record.update(status='ready', s3VersionId=payload['s3VersionId'])
+                return 202, record
+            if len(parts) == 3 and parts[2] == 'download':
+                return 200, self.objects[parts[1]]
+            return 200, record
+
+        if parts[0] == 'artifacts':
+            if method == 'POST' and len(parts) == 1:
+                artifact_id = uuid.uuid4().hex
+                record = dict(payload, artifactId=artifact_id, status='pending', createdAt=self._now(),
+                              readyAt=time.time() + self.processing_delay)
+                if payload.get('serviceType') in self.components:
+                    record['components'] = self.components[payload['serviceType']]
+                with self._lock:
+                    self.artifacts[artifact_id] = record
+                return 202, self._artifact_json(artifact_id)
+            if method == 'GET' and len(parts) == 1:
+                return self._list('artifacts', self.artifacts, 'artifactId', self._artifact_json, query or {})
+            if parts[1:] == ['query']:
+                # Bulk lookup, as used by Poller's bulk_uri
+                ids = [artifact_id for artifact_id in (query or {}).get('ids', '').split(',') if artifact_id]
+                return 200, {'artifacts': [
+                    self._artifact_json(artifact_id) for artifact_id in ids if artifact_id in self.artifacts
+                ]}
+            artifact_json = self._artifact_json(parts[1])
+            if len(parts) == 3 and parts[2] == 'download':
+                return 200, self.artifact_contents(parts[1])
+            if len(parts) == 4 and parts[2] == 'components':
+                if parts[3] not in artifact_json.get('components', []):
+                    raise KeyError(path)
+                return 200, self.artifact_contents(parts[1], parts[3])
+            return 200, artifact_json
+
+        raise KeyError(path)
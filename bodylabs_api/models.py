@@ -1,6 +1,8 @@
 class Model(object):
     '''
-    Subclasses must specify id_field and base_uri as class variables
+    Subclasses must specify id_field and base_uri as class variables. To
+    keep many artifacts in memory cheaply, see
+    bodylabs_api.artifact_set.ArtifactSet.
     '''
     id_field = None
     base_uri = None
@@ -11,13 +13,29 @@ class Model(object):
         if not self.__class__.base_uri:
             raise ValueError('Cannot construct Model subclass without base_uri set')
 
+        from bodylabs_api.timeline import Timeline
+        # Phases of this resource's lifecycle; see bodylabs_api.timeline
+        self.timeline = Timeline()
         self.raw_json = raw_json
         self.client = client
         self.download_path = None
+        # Headers of the last refresh, which may carry polling hints
+        self.response_headers = {}
+        # Number of refreshes the last refresh_until_ready needed
+        self.poll_count = 0
 
     def __repr__(self):
         return '<{} {}>'.format(self.__class__.__name__, self._id)
 
+    @property
+    def raw_json(self):
+        return self._raw_json
+
+    @raw_json.setter
+    def raw_json(self, raw_json):
+        self._raw_json = raw_json
+        self.timeline.observe_status(raw_json.get('status'))
+
     @property
     def _id(self):
         return self.raw_json.get(self.id_field)
@@ -34,11 +52,57 @@ class Model(object):
     def status(self):
         return self.raw_json.get('status')
 
-    def create(self):
+    def create(self, memo=None, idempotency_key=None, journal=None):
         '''
-        Create (POST) a record of this resource.
+        Create (POST) a record of this resource. With an idempotency_key, e.g.
+        a uuid4 string, the POST is retried on transient failures, since the
+        API then creates the resource at most once.
+
+        With a bodylabs_api.cache.PayloadMemo, a resource already created
+        from an identical payload is reused (and refreshed) instead, unless it
+        has failed or no longer exists.
+
+        With a bodylabs_api.journal.JobJournal, the create is recorded before
+        the POST, with an idempotency key (generated unless given) so that it
+        can safely be repeated after a crash, and again once it succeeds.
         '''
-        self.raw_json = self.client.post(self.base_uri, self.raw_json)
+        if journal is not None:
+            import uuid
+            idempotency_key = idempotency_key or uuid.uuid4().hex
+            journal.record('creating', self, idempotency_key=idempotency_key)
+        with self.timeline.phase('create') as phase:
+            self._create(memo, idempotency_key, phase)
+        if journal is not None:
+            journal.record('created', self)
+        return self
+
+    def _create(self, memo, idempotency_key, phase):
+        from bodylabs_api.exceptions import HttpError
+
+        if memo is not None:
+            from bodylabs_api.cache import canonical_payload_hash
+            payload = self.raw_json
+            payload_hash = canonical_payload_hash(self.base_uri, payload)
+            existing_id = memo.get(payload_hash)
+            if existing_id is not None:
+                try:
+                    self.raw_json = self.client.get('{}/{}'.format(self.base_uri, existing_id))
+                except HttpError as e:
+                    if e.actual_status != 404:
+                        raise
+                else:
+                    if self.status != 'failed':
+                        memo.record(hit=True)
+                        phase.attributes['memo'] = 'hit'
+                        return self
+                memo.invalidate(payload_hash)
+                self.raw_json = payload
+            memo.record(hit=False)
+
+        self.raw_json = self.client.post(self.base_uri, self.raw_json, idempotency_key=idempotency_key)
+
+        if memo is not None:
+            memo.put(payload_hash, self._id)
         return self
 
     def refresh(self, **kwargs):
@@ -46,6 +110,7 @@ class Model(object):
         Refresh (GET) the resource's metadata.
         '''
         self.raw_json = self.client.get(self.metadata_uri, **kwargs)
+        self.response_headers = self.client.last_response_headers
         return self
 
     @classmethod
@@ -53,43 +118,262 @@ class Model(object):
         stub = cls({cls.id_field: doc_id}, client)
         return stub.refresh()
 
-    def refresh_until_ready(self, polling_interval=10, timeout=1200):
+    @classmethod
+    def list(cls, client, page_size=100, prefetch=True, **filters): # pylint: disable=redefined-builtin
+        '''
+        Generate the resources matching filters, fetched lazily a page of
+        page_size at a time (the next page in the background, if prefetch)
+        rather than with a GET per id. Filters are query parameters given in
+        snake_case, e.g.
+
+            Artifact.list(client, status=('pending', 'processing'),
+                          service_type='FootAlignment',
+                          created_after=datetime.datetime(2016, 5, 1))
+
+        See bodylabs_api.listing.
+        '''
+        from bodylabs_api.listing import iter_pages, list_query
+        pages = iter_pages(
+            client, cls.base_uri, cls.base_uri.strip('/'), query=list_query(filters),
+            page_size=page_size, prefetch=prefetch)
+        for page in pages:
+            for raw_json in page:
+                yield cls(raw_json, client)
+
+    @staticmethod
+    def _polling_strategy(polling_interval, polling):
+        from bodylabs_api.polling import FixedInterval
+        if polling is not None:
+            return polling
+        return FixedInterval(polling_interval)
+
+    def refresh_until_ready(self, polling_interval=10, timeout=1200, polling=None):
+        '''
+        Refresh until the resource is ready, waiting polling_interval seconds
+        between refreshes, or as decided by polling, a
+        bodylabs_api.polling.PollingStrategy, when given. No wait extends
+        past timeout.
+        '''
         # Timeout for 20 min because kinect/realsense are almost that slow
         import time
-        from harrison.timer import TimeoutTimer
+        from harrison.timer import TimeoutTimer, TimeoutError
         from bodylabs_api.exceptions import ProcessingFailed
 
-        # The first refresh will log a message if self.client.verbose
-        self.refresh()
+        polling = self._polling_strategy(polling_interval, polling)
+        started_at = time.time()
 
-        with TimeoutTimer(
-            desc='Polling {}'.format(self),
-            verbose=self.client.verbose,
-            timeout=timeout):
-            while self.status != 'ready':
-                self.refresh(verbose=False) # no log, just the dot below
+        with self.timeline.phase('wait') as phase:
+            # The first refresh will log a message if self.client.verbose
+            self.refresh()
+            self.poll_count = phase.attributes['polls'] = 1
+
+            with TimeoutTimer(
+                desc='Polling {}'.format(self),
+                verbose=self.client.verbose,
+                timeout=timeout):
+                while self.status != 'ready':
+                    if self.status == 'failed':
+                        raise ProcessingFailed('Artifact {} failed'.format(self))
+
+                    elapsed = time.time() - started_at
+                    if elapsed >= timeout:
+                        # The alarm only fires on the main thread
+                        raise TimeoutError('Polling {} - Timed out after {} seconds.'.format(self, timeout))
 
-                if self.status == 'pending':
                     if self.client.verbose:
                         print '.',
-                    time.sleep(polling_interval)
+                    time.sleep(min(polling.next_delay(self, self.poll_count, elapsed), timeout - elapsed))
 
-                elif self.status == 'failed':
-                    raise ProcessingFailed('Artifact {} failed'.format(self))
+                    self.refresh(verbose=False) # no log, just the dot above
+                    self.poll_count += 1
+                    phase.attributes['polls'] = self.poll_count
 
+        polling.record(self, time.time() - started_at)
         if self.client.verbose:
-            print '{} is ready'.format(self)
+            print '{} is ready after {} polls'.format(self, self.poll_count)
 
         return self
 
-    def download(self, output_path, blocking=True, **kwargs):
+    def _from_store(self, store, revalidate, output_path, component=None):
+        '''
+        Whether a copy in store, unless revalidate, was saved to output_path
+        '''
+        if store is None or revalidate or not store.get(store.key(self, component), output_path):
+            return False
+        self._download_phase(component, store='hit').end()
+        return True
+
+    def _download_through(self, store, revalidate, uri, output_path, component=None, blocking=True, ranges=1,
+                          check_store=True, **kwargs):
+        '''
+        Download uri to output_path, first waiting until ready if blocking.
+        With a bodylabs_api.cache.ArtifactStore, a stored copy is used without
+        any request unless revalidate, and new downloads are stored. ranges > 1
+        fetches that many byte ranges of large outputs in parallel. Callers
+        that have already looked in the store pass check_store=False.
+        '''
+        if check_store and self._from_store(store, revalidate, output_path, component):
+            return
+
         if blocking:
             self.refresh_until_ready(**kwargs)
 
-        self.client.download(self.download_uri, output_path)
+        phase = self._download_phase(component)
+        try:
+            if store is not None:
+                store.download(self.client, store.key(self, component), uri, output_path, ranges=ranges)
+            else:
+                self.client.download(uri, output_path, ranges=ranges)
+        except Exception as e:
+            phase.end(error=e)
+            raise
+        phase.end()
+
+    def _download_phase(self, component=None, **attributes):
+        if component is not None:
+            attributes['component'] = component
+        return self.timeline.begin('download', **attributes)
+
+    def download(self, output_path, blocking=True, store=None, revalidate=False, **kwargs):
+        self._download_through(store, revalidate, self.download_uri, output_path, blocking=blocking, **kwargs)
         self.download_path = output_path
         return self
 
+    def _stream(self, uri, blocking, consume=None, component=None, chunk_size=None, **kwargs):
+        '''
+        Start streaming uri, returning the Stream, or what consume(stream)
+        returns, in which case it's timed as a download phase
+        '''
+        from bodylabs_api.transfer import DOWNLOAD_CHUNK_SIZE
+        if blocking:
+            self.refresh_until_ready(**kwargs)
+        if consume is None:
+            return self.client.stream_download(uri, chunk_size=chunk_size or DOWNLOAD_CHUNK_SIZE)
+        phase = self._download_phase(component)
+        try:
+            result = consume(self.client.stream_download(uri, chunk_size=chunk_size or DOWNLOAD_CHUNK_SIZE))
+        except Exception as e:
+            phase.end(error=e)
+            raise
+        phase.end()
+        return result
+
+    def iter_download(self, blocking=True, **kwargs):
+        '''
+        Download without writing to disk, returning an iterator over the
+        content's chunks (a bodylabs_api.transfer.Stream) for processing it
+        as it arrives
+        '''
+        return self._stream(self.download_uri, blocking, **kwargs)
+
+    def download_to(self, target, blocking=True, **kwargs):
+        '''
+        Download into target: a file-like object with write(), such as a
+        BytesIO, or a writable byte buffer at least as large as the content,
+        such as a bytearray, a memoryview of one or a numpy uint8 array
+        '''
+        self._stream(self.download_uri, blocking, consume=lambda stream: stream.write_into(target), **kwargs)
+        return self
+
+    def download_bytes(self, blocking=True, **kwargs):
+        '''
+        Download into a new bytearray, allocated once from Content-Length;
+        numpy.frombuffer can view it without a copy
+        '''
+        return self._stream(self.download_uri, blocking, consume=lambda stream: stream.read_all(), **kwargs)
+
+    # Non-blocking counterparts of the methods above, which require an
+    # AsyncClient and return a concurrent.futures.Future resolving to self
+
+    def _async_client(self):
+        from bodylabs_api.async_client import AsyncClient
+        if not isinstance(self.client, AsyncClient):
+            raise TypeError('{} needs an AsyncClient for non-blocking calls'.format(self))
+        return self.client
+
+    def _update_raw_json(self, raw_json):
+        self.raw_json = raw_json
+        return self
+
+    def create_async(self):
+        from bodylabs_api.async_client import then
+        future = self._async_client().post_async(self.base_uri, self.raw_json)
+        return then(future, self._update_raw_json)
+
+    def refresh_async(self, **kwargs):
+        from bodylabs_api.async_client import then
+        future = self._async_client().get_async(self.metadata_uri, **kwargs)
+        return then(future, self._update_raw_json)
+
+    def refresh_until_ready_async(self, polling_interval=10, timeout=1200, polling=None):
+        '''
+        Like refresh_until_ready, but sleeps on the client's scheduler between
+        polls rather than in a thread.
+        '''
+        import time
+        from concurrent.futures import Future
+        from harrison.timer import TimeoutError
+        from bodylabs_api.exceptions import ProcessingFailed
+
+        client = self._async_client()
+        polling = self._polling_strategy(polling_interval, polling)
+        started_at = time.time()
+        ready = Future()
+        self.poll_count = 0
+        phase = self.timeline.begin('wait', polls=0)
+
+        def finish(error=None):
+            phase.attributes['polls'] = self.poll_count
+            phase.end(error=error)
+            if error is None:
+                ready.set_result(self)
+            else:
+                ready.set_exception(error)
+
+        # A flat callback loop rather than chained futures, so that long
+        # polls don't build up a chain of pending futures
+        def on_refreshed(refreshed):
+            self.poll_count += 1
+            elapsed = time.time() - started_at
+            if refreshed.exception() is not None:
+                finish(refreshed.exception())
+            elif self.status == 'ready':
+                polling.record(self, elapsed)
+                finish()
+            elif self.status == 'failed':
+                finish(ProcessingFailed('Artifact {} failed'.format(self)))
+            elif elapsed > timeout:
+                finish(TimeoutError('Polling {} - Timed out after {} seconds.'.format(self, timeout)))
+            else:
+                client.call_later(min(polling.next_delay(self, self.poll_count, elapsed), timeout - elapsed), poll)
+
+        # Refreshing on the client's worker threads, rather than with
+        # refresh_async, keeps response_headers current for polling's hints
+        def poll(verbose=False):
+            client.submit(self.refresh, verbose=verbose).add_done_callback(on_refreshed)
+
+        poll(verbose=True)
+        return ready
+
+    def download_async(self, output_path, blocking=True, **kwargs):
+        from concurrent.futures import Future
+        from bodylabs_api.async_client import then
+        client = self._async_client()
+
+        def download(_):
+            return client.download_async(self.download_uri, output_path)
+
+        def record(_):
+            self.download_path = output_path
+            return self
+
+        if blocking:
+            ready = self.refresh_until_ready_async(**kwargs)
+        else:
+            ready = Future()
+            ready.set_result(self)
+        return then(then(ready, download), record)
+
 
 class Artifact(Model):
     id_field = 'artifactId'
@@ -142,15 +426,121 @@ class MultiComponentArtifact(Artifact):
                 raise ValueError('{} has no component {}'.format(self, component))
         return uri
 
-    def download_component(self, component, output_path, blocking=True, **kwargs):
-        component_uri = self.get_component_uri(component, validate=True) # fail early
+    def download_component(self, component, output_path, blocking=True, store=None, revalidate=False, **kwargs):
+        # Look in the store before validating, which costs a request
+        if not self._from_store(store, revalidate, output_path, component):
+            component_uri = self.get_component_uri(component, validate=True) # fail early
+            self._download_through(
+                store, revalidate, component_uri, output_path, component=component, blocking=blocking,
+                check_store=False, **kwargs)
+        self.downloaded_components[component] = output_path
+        return self
+
+    def download_components(self, components=None, output_dir=None, blocking=True, store=None, revalidate=False,
+                            max_workers=4, ranges=1, **kwargs):
+        '''
+        Download several components concurrently, waiting until ready (if
+        blocking) and validating the names against a single refresh, rather
+        than once per component as download_component does.
+
+        components is a list of names, saved in output_dir under their own
+        names, or a dict of name to output path; by default, every component
+        is saved in output_dir. Named components found in store are used
+        without any request. If any download fails, the first error is raised
+        once the others have finished.
+        '''
+        import os
+        from concurrent.futures import ThreadPoolExecutor
+
+        def not_stored(components):
+            if not isinstance(components, dict):
+                if output_dir is None:
+                    raise ValueError('output_dir is required unless components maps names to paths')
+                components = {component: os.path.join(output_dir, component) for component in components}
+            pending = {}
+            for component, output_path in components.items():
+                if self._from_store(store, revalidate, output_path, component):
+                    self.downloaded_components[component] = output_path
+                else:
+                    pending[component] = output_path
+            return pending
+
+        # Only listing every component needs a refresh before the store
+        if components is not None:
+            pending = not_stored(components)
+            if not pending:
+                return self
+
         if blocking:
             self.refresh_until_ready(**kwargs)
+        else:
+            self.refresh()
+
+        if components is None:
+            pending = not_stored(self.components)
+            if not pending:
+                return self
+        missing = sorted(set(pending) - set(self.components))
+        if missing:
+            raise ValueError('{} has no component {}'.format(self, ', '.join(missing)))
+
+        def download(component):
+            self._download_through(
+                store, revalidate, self.get_component_uri(component), pending[component],
+                component=component, blocking=False, ranges=ranges, check_store=False)
+            return component
+
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            futures = [executor.submit(download, component) for component in pending]
+        errors = [future.exception() for future in futures if future.exception() is not None]
+        for future in futures:
+            if future.exception() is None:
+                component = future.result()
+                self.downloaded_components[component] = pending[component]
+        if errors:
+            raise errors[0]
+        return self
 
-        self.client.download(component_uri, output_path)
-        self.downloaded_components[component] = output_path
+    def iter_download_component(self, component, blocking=True, **kwargs):
+        '''
+        Like iter_download, for one component
+        '''
+        component_uri = self.get_component_uri(component, validate=True) # fail early
+        return self._stream(component_uri, blocking, **kwargs)
+
+    def download_component_to(self, component, target, blocking=True, **kwargs):
+        self._stream(
+            self.get_component_uri(component, validate=True), blocking,
+            consume=lambda stream: stream.write_into(target), component=component, **kwargs)
         return self
 
+    def download_component_bytes(self, component, blocking=True, **kwargs):
+        return self._stream(
+            self.get_component_uri(component, validate=True), blocking,
+            consume=lambda stream: stream.read_all(), component=component, **kwargs)
+
+    def download_component_async(self, component, output_path, blocking=True, **kwargs):
+        from bodylabs_api.async_client import then
+        client = self._async_client()
+        component_uri = self.get_component_uri(component)
+
+        def validate(_):
+            # fail early, as download_component does
+            if component not in self.components:
+                raise ValueError('{} has no component {}'.format(self, component))
+            if blocking:
+                return self.refresh_until_ready_async(**kwargs)
+            return self
+
+        def download(_):
+            return client.download_async(component_uri, output_path)
+
+        def record(_):
+            self.downloaded_components[component] = output_path
+            return self
+
+        return then(then(then(self.refresh_async(), validate), download), record)
+
 
 def _infer_file_type(filepath):
     from os.path import splitext
@@ -186,30 +576,120 @@ class File(Model):
         '''
         return self.raw_json.get('s3VersionId')
 
-    def upload(self, path):
+    @property
+    def multipart_upload(self):
         '''
-        Upload path to self.signed_upload_url and populate self.s3_version_id
+        Only exists between file.create and file.finalize calls, and only when
+        the file was created with a multipartUpload partCount; otherwise None
         '''
+        return self.raw_json.get('multipartUpload')
+
+    def upload(self, source, content_length=None, part_size=None, max_workers=4, journal=None,
+               compression=None):
+        '''
+        Upload source to self.signed_upload_url and populate
+        self.s3_version_id. source may be a path, a file-like object or an
+        iterable of byte strings, and is streamed rather than read into
+        memory; content_length is required for iterables.
+
+        Files created for multipart upload are instead uploaded in parallel
+        parts of part_size bytes on max_workers threads, in which case source
+        must be a path.
+
+        compression ('gzip' or 'zstd') sends source compressed, with a
+        Content-Encoding; see Client.upload. Multipart uploads can't be
+        compressed.
+
+        With a bodylabs_api.journal.JobJournal, the upload is recorded once
+        complete.
+        '''
+        if self.multipart_upload is not None:
+            if compression is not None:
+                raise ValueError('Multipart uploads can\'t be compressed')
+            if not isinstance(source, basestring):
+                raise ValueError('Multipart uploads require a path to read parts from')
+            with self.timeline.phase('upload', parts=len(self.multipart_upload['signedPartUrls'])):
+                s3_version_id = self.client.upload_multipart(
+                    self.multipart_upload, source, part_size=part_size,
+                    max_workers=max_workers)['s3VersionId']
+            self.raw_json['s3VersionId'] = s3_version_id
+            if journal is not None:
+                journal.record('uploaded', self)
+            return self
+
         if self.signed_upload_url is None:
             raise ValueError('Can\'t upload without signed_upload_url from create')
-        s3_version_id = self.client.upload(self.signed_upload_url, path)['s3VersionId']
+        with self.timeline.phase('upload'):
+            s3_version_id = self.client.upload(
+                self.signed_upload_url, source, content_length=content_length,
+                compression=compression)['s3VersionId']
         self.raw_json['s3VersionId'] = s3_version_id
+        if journal is not None:
+            journal.record('uploaded', self)
         return self
 
-    def finalize(self):
+    def finalize(self, journal=None):
         '''
         Finalize (PATCH) File and clear self.signed_upload_url and
         self.s3_version_id
         '''
         if self.s3_version_id is None:
             raise ValueError('Can\'t finalize without s3_version_id from upload')
-        self.raw_json = self.client.patch(self.metadata_uri, {'s3VersionId': self.s3_version_id})
+        with self.timeline.phase('finalize'):
+            self.raw_json = self.client.patch(self.metadata_uri, {'s3VersionId': self.s3_version_id})
+        if journal is not None:
+            journal.record('finalized', self)
         return self
 
     @classmethod
-    def from_local_path(cls, path, client, file_type=None):
+    def from_local_path(cls, path, client, file_type=None, multipart_part_size=None, max_workers=4,
+                        cache=None, journal=None, compression=None):
         '''
         Factory method encapsulating the whole create/upload/finalize workflow
+
+        Pass multipart_part_size (in bytes, at least 5 MB) to opt in to
+        uploading the file in parallel parts on max_workers threads, or
+        compression ('gzip' or 'zstd') to upload it compressed.
+
+        Pass a bodylabs_api.cache.UploadCache to reuse the File of an earlier
+        upload of the same contents and file type, skipping all requests.
+
+        Pass a bodylabs_api.journal.JobJournal to record each step.
         '''
+        import os
         file_type = file_type or _infer_file_type(path)
-        return cls({'fileType': file_type}, client).create().upload(path).finalize()
+
+        if cache is not None:
+            from bodylabs_api.cache import hash_file
+            content_hash = hash_file(path)
+            file_id = cache.get(content_hash, file_type)
+            if file_id is not None:
+                cached = cls({'fileId': file_id, 'fileType': file_type, 'status': 'ready'}, client)
+                if journal is not None:
+                    journal.record('finalized', cached, cached=True)
+                return cached
+
+        raw_json = {'fileType': file_type}
+        if multipart_part_size:
+            part_count = max(1, -(-os.path.getsize(path) // multipart_part_size))
+            raw_json['multipartUpload'] = {'partCount': part_count}
+        uploaded = cls(raw_json, client).create(journal=journal).upload(
+            path, part_size=multipart_part_size, max_workers=max_workers, journal=journal,
+            compression=compression).finalize(journal=journal)
+
+        if cache is not None:
+            cache.put(content_hash, file_type, uploaded.file_id)
+        return uploaded
+
+    @classmethod
+    def from_local_path_async(cls, path, client, file_type=None, multipart_part_size=None, max_workers=4,
+                              cache=None, journal=None, compression=None):
+        '''
+        Non-blocking from_local_path for an AsyncClient, returning a Future
+        resolving to the finalized File. The create/upload/finalize sequence
+        has no waits, so it runs on a single worker thread.
+        '''
+        return client.submit(
+            cls.from_local_path, path, client, file_type=file_type,
+            multipart_part_size=multipart_part_size, max_workers=max_workers, cache=cache, journal=journal,
+            compression=compression)
@@ -0,0 +1,211 @@
+'''
+Dependency-aware pipelines of uploads and artifacts.
+
+A Pipeline is a graph of file nodes, which upload (create, upload and
+finalize) a local file, and artifact nodes, which create an artifact whose
+payload's dependencies name other nodes. Every node starts as soon as all of
+its inputs are ready rather than after a whole stage has finished: an
+artifact is created the moment the last of its files is finalized, or the
+last of the artifacts it depends on is ready, while other uploads continue.
+Downloads of an artifact's output run alongside the nodes depending on it.
+
+    pipeline = Pipeline(client, max_workers=8)
+    scan = pipeline.file('scan', './foot_scan.ply')
+    alignment = pipeline.artifact('alignment', alignment_payload, {'scan': scan},
+                                  output_path='./alignment.obj')
+    pipeline.artifact('measurements', measurement_payload, {'alignment': alignment},
+                      output_path='./measurements.json')
+    for result in pipeline.run():
+        ...
+'''
+from collections import namedtuple
+
+from bodylabs_api.models import Artifact
+
+# error is None on success; a node whose inputs failed gets DependencyFailed
+PipelineResult = namedtuple('PipelineResult', ['node', 'model', 'error'])
+
+
+class PipelineNode(object):
+    '''
+    One file or artifact of a Pipeline. dependencies maps the names under
+    which the node's payload refers to its inputs to their nodes.
+    '''
+    def __init__(self, name, kind, dependencies=None, path=None, upload_options=None, payload=None,
+                 output_path=None, artifact_class=Artifact):
+        self.name = name
+        self.kind = kind
+        self.dependencies = dependencies or {}
+        self.path = path
+        self.upload_options = upload_options or {}
+        self.payload = payload
+        self.output_path = output_path
+        self.artifact_class = artifact_class
+        self.dependents = []
+        self.model = None
+        self.started_at = None
+        self.ready_at = None
+
+    def reference(self):
+        '''
+        How a payload's dependencies refer to this node's resource
+        '''
+        if self.kind == 'file':
+            return {'fileId': self.model.file_id}
+        return {'artifactId': self.model.artifact_id}
+
+    def __repr__(self):
+        return '<{} {} {}>'.format(self.__class__.__name__, self.kind, self.name)
+
+
+class Pipeline(object):
+    '''
+    Runs a graph of nodes against one Client, on a pool of max_workers
+    threads, polling pending artifacts together through a Poller every
+    polling_interval seconds. upload_cache, payload_memo and artifact_store
+    are used as by Batch.
+    '''
+    def __init__(self, client, max_workers=8, polling_interval=10, timeout=1200, bulk_uri=None,
+                 upload_cache=None, payload_memo=None, artifact_store=None):
+        self.client = client
+        self.max_workers = max_workers
+        self.polling_interval = polling_interval
+        self.timeout = timeout
+        self.bulk_uri = bulk_uri
+        self.upload_cache = upload_cache
+        self.payload_memo = payload_memo
+        self.artifact_store = artifact_store
+        self.nodes = []
+
+    def _add(self, node):
+        for dependency in node.dependencies.values():
+            if dependency not in self.nodes:
+                raise ValueError('{} depends on {}, which is not in this pipeline'.format(node, dependency))
+            dependency.dependents.append(node)
+        self.nodes.append(node)
+        return node
+
+    def file(self, name, path, **upload_options):
+        '''
+        Add a node uploading the file at path with File.from_local_path, to
+        which upload_options (e.g. file_type) are passed
+        '''
+        return self._add(PipelineNode(name, 'file', path=path, upload_options=upload_options))
+
+    def artifact(self, name, payload, dependencies=None, output_path=None, artifact_class=Artifact):
+        '''
+        Add a node creating an artifact from payload once every node in
+        dependencies is ready, with those nodes' resources set in the
+        payload's dependencies under their keys. output_path is downloaded
+        to as in Batch: a path, or for a MultiComponentArtifact a dict of
+        component name to path.
+        '''
+        return self._add(PipelineNode(
+            name, 'artifact', dependencies=dependencies, payload=payload, output_path=output_path,
+            artifact_class=artifact_class))
+
+    def _upload(self, node):
+        from bodylabs_api.models import File
+        return File.from_local_path(node.path, self.client, cache=self.upload_cache, **node.upload_options)
+
+    def _create(self, node):
+        import copy
+        payload = copy.deepcopy(node.payload)
+        for key, dependency in node.dependencies.items():
+            payload.setdefault('dependencies', {})[key] = dependency.reference()
+        return node.artifact_class(payload, self.client).create(memo=self.payload_memo)
+
+    def _download(self, node):
+        if isinstance(node.output_path, dict):
+            node.model.download_components(node.output_path, blocking=False, store=self.artifact_store)
+        else:
+            node.model.download(node.output_path, blocking=False, store=self.artifact_store)
+        return node.model
+
+    def run(self):
+        '''
+        Generator yielding a PipelineResult for each node as it finishes, in
+        completion order: files once finalized, artifacts once ready and
+        downloaded. A failed node fails its dependents, transitively, with
+        DependencyFailed; unrelated nodes carry on.
+        '''
+        import time
+        from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+        from bodylabs_api.exceptions import DependencyFailed, ProcessingFailed
+        from bodylabs_api.poller import Poller
+
+        waiting = {node: len(node.dependencies) for node in self.nodes}
+        futures = {}
+        executor = ThreadPoolExecutor(max_workers=self.max_workers)
+        poller = Poller(
+            self.client, interval=self.polling_interval, max_workers=self.max_workers,
+            bulk_uri=self.bulk_uri, timeout=self.timeout)
+
+        def submit(stage, node, fn):
+            futures[executor.submit(fn, node)] = (stage, node)
+
+        def start(node):
+            # Started nodes are out of reach of fail, e.g. when a download
+            # of one of their inputs fails
+            del waiting[node]
+            node.started_at = time.time()
+            if node.kind == 'file':
+                submit('upload', node, self._upload)
+            else:
+                submit('create', node, self._create)
+
+        def ready(node):
+            '''
+            Start the dependents whose last input this was, returning the
+            node's result unless it still has a download to do
+            '''
+            node.ready_at = time.time()
+            for dependent in node.dependents:
+                if dependent not in waiting:
+                    continue # another of its inputs failed
+                waiting[dependent] -= 1
+                if waiting[dependent] == 0:
+                    start(dependent)
+            if node.kind == 'artifact' and node.output_path is not None:
+                submit('download', node, self._download)
+                return None
+            return PipelineResult(node, node.model, None)
+
+        def fail(node, error):
+            '''
+            Results for node and, transitively, its dependents
+            '''
+            results = [PipelineResult(node, node.model, error)]
+            for dependent in node.dependents:
+                if waiting.pop(dependent, None) is not None:
+                    results.extend(fail(dependent, DependencyFailed(
+                        '{} failed: {!r}'.format(node, error))))
+            return results
+
+        try:
+            for node in self.nodes:
+                if not node.dependencies:
+                    start(node)
+            while futures:
+                done, _ = wait(futures.keys(), return_when=FIRST_COMPLETED)
+                for future in done:
+                    stage, node = futures.pop(future)
+                    if future.exception() is not None:
+                        for result in fail(node, future.exception()):
+                            yield result
+                        continue
+                    node.model = future.result()
+                    if stage == 'download':
+                        yield PipelineResult(node, node.model, None)
+                    elif node.kind == 'file' or node.model.status == 'ready':
+                        result = ready(node)
+                        if result is not None:
+                            yield result
+                    elif node.model.status == 'failed':
+                        for result in fail(node, ProcessingFailed('Artifact {} failed'.format(node.model))):
+                            yield result
+                    else:
+                        futures[poller.register(node.model)] = ('poll', node)
+        finally:
+            poller.stop()
+            executor.shutdown(wait=False)
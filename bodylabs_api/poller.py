@@ -0,0 +1,191 @@
+import threading
+import time
+
+
+def fetch_bulk(client, bulk_uri, model_class, ids):
+    '''
+    Fetch the JSON of the model_class resources with the given ids in one
+    request to bulk_uri, as described for Poller, returning a dict of id to
+    JSON for those the response covered
+    '''
+    import urllib
+    uri = '{}?{}'.format(
+        bulk_uri.format(base_uri=model_class.base_uri), urllib.urlencode({'ids': ','.join(ids)}))
+    response = client.get(uri, verbose=False)
+    return {
+        raw_json.get(model_class.id_field): raw_json
+        for raw_json in response.get(model_class.base_uri.strip('/'), [])
+    }
+
+
+class Poller(object):
+    '''
+    Refresh many registered models together, once every interval seconds,
+    instead of each one polling on its own timer.
+
+    Each tick refreshes every registered model, either with one request per
+    bulk_size models to a bulk query endpoint, or when none is configured with
+    individual GETs on a pool of max_workers threads sharing the client's
+    keep-alive connections. register returns a Future resolving to the model
+    once it is ready, or failing with ProcessingFailed, HttpError or
+    harrison.timer.TimeoutError. Futures still pending when the Poller stops
+    are cancelled. A model's poll_count counts its successful refreshes.
+
+    bulk_uri is formatted with the model class's base_uri, e.g.
+    '{base_uri}/query', and is requested with an ids query parameter listing
+    comma-separated ids. It should respond with the models' JSON in a list
+    keyed by the collection name, e.g. {'artifacts': [...]}; models missing
+    from the response are refreshed individually.
+
+        with Poller(client, interval=5) as poller:
+            futures = [poller.register(artifact) for artifact in artifacts]
+            for future in as_completed(futures):
+                ...
+    '''
+    def __init__(self, client, interval=10, max_workers=8, bulk_uri=None, bulk_size=100, timeout=1200):
+        from concurrent.futures import ThreadPoolExecutor
+        self.client = client
+        self.interval = interval
+        self.bulk_uri = bulk_uri
+        self.bulk_size = bulk_size
+        self.timeout = timeout
+        self.tick_count = 0
+        self.request_count = 0
+        self._executor = ThreadPoolExecutor(max_workers=max_workers)
+        self._registered = {}
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.stop()
+
+    def register(self, model):
+        from concurrent.futures import Future
+        future = Future()
+        with self._lock:
+            self._registered[id(model)] = (model, future, time.time())
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run)
+                self._thread.daemon = True
+                self._thread.start()
+        return future
+
+    def unregister(self, model):
+        with self._lock:
+            entry = self._registered.pop(id(model), None)
+        if entry is not None:
+            entry[1].cancel()
+
+    def stop(self):
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join()
+        self._executor.shutdown(wait=True)
+        with self._lock:
+            entries = self._registered.values()
+            self._registered.clear()
+        for _, future, _ in entries:
+            future.cancel()
+
+    def _run(self):
+        import logging
+        while not self._stopped.wait(self.interval):
+            with self._lock:
+                entries = self._registered.values()
+            try:
+                self.tick()
+            except Exception as e: # pylint: disable=broad-except
+                # Rather than leave the futures to wait on a dead thread
+                logging.getLogger('bodylabs_api.poller').exception('Polling failed')
+                with self._lock:
+                    for model, _, _ in entries:
+                        self._registered.pop(id(model), None)
+                for _, future, _ in entries:
+                    if not future.done():
+                        future.set_exception(e)
+
+    def tick(self):
+        '''
+        Refresh every registered model once and resolve the futures of those
+        that are no longer pending
+        '''
+        with self._lock:
+            entries = self._registered.values()
+        if not entries:
+            return
+        self.tick_count += 1
+
+        errors = self._refresh([model for model, _, _ in entries])
+        for model, future, registered_at in entries:
+            if id(model) not in errors:
+                model.poll_count += 1
+            outcome = self._outcome(model, errors.get(id(model)), registered_at)
+            if outcome is None:
+                continue
+            with self._lock:
+                self._registered.pop(id(model), None)
+            if isinstance(outcome, Exception):
+                future.set_exception(outcome)
+            else:
+                future.set_result(outcome)
+
+    def _outcome(self, model, error, registered_at):
+        from harrison.timer import TimeoutError
+        from bodylabs_api.exceptions import ProcessingFailed
+        if error is not None:
+            return error
+        elif model.status == 'ready':
+            return model
+        elif model.status == 'failed':
+            return ProcessingFailed('Artifact {} failed'.format(model))
+        elif time.time() - registered_at > self.timeout:
+            return TimeoutError('Polling {} - Timed out after {} seconds.'.format(model, self.timeout))
+        return None
+
+    def _refresh(self, models):
+        '''
+        Refresh models, returning a dict of id(model) to the exception raised
+        while refreshing it
+        '''
+        individual = models
+        if self.bulk_uri is not None:
+            individual = []
+            by_class = {}
+            for model in models:
+                by_class.setdefault(model.__class__, []).append(model)
+            for model_class, class_models in by_class.items():
+                for start in range(0, len(class_models), self.bulk_size):
+                    chunk = class_models[start:start + self.bulk_size]
+                    try:
+                        individual.extend(self._refresh_bulk(model_class, chunk))
+                    except Exception: # pylint: disable=broad-except
+                        individual.extend(chunk) # fall back to individual GETs
+
+        errors = {}
+        def refresh_one(model):
+            try:
+                model.refresh(verbose=False)
+            except Exception as e: # pylint: disable=broad-except
+                errors[id(model)] = e
+        self.request_count += len(individual)
+        list(self._executor.map(refresh_one, individual))
+        return errors
+
+    def _refresh_bulk(self, model_class, models):
+        '''
+        Refresh models with one bulk request, returning those it didn't cover
+        '''
+        ids = [model._id for model in models] # pylint: disable=protected-access
+        self.request_count += 1
+        by_id = fetch_bulk(self.client, self.bulk_uri, model_class, ids)
+        missing = []
+        for model in models:
+            if model._id in by_id: # pylint: disable=protected-access
+                model.raw_json = by_id[model._id] # pylint: disable=protected-access
+            else:
+                missing.append(model)
+        return missing
@@ -0,0 +1,137 @@
+'''
+Strategies deciding how long Model.refresh_until_ready waits between polls.
+
+A strategy's next_delay(model, poll_count, elapsed) returns the seconds to
+sleep after the poll_count-th refresh, elapsed seconds after polling began.
+Hints from the server take precedence over the strategy's own schedule: a
+Retry-After header on the last refresh, or an estimatedSecondsRemaining field
+in the model's JSON. Hints are capped at the strategy's maximum.
+'''
+import random
+import threading
+from collections import deque
+
+from bodylabs_api.retry import retry_after_seconds
+
+
+def server_hint(model):
+    '''
+    Seconds the server suggests waiting before polling model again, or None
+    '''
+    retry_after = model.response_headers.get('Retry-After')
+    if retry_after is not None:
+        seconds = retry_after_seconds(retry_after)
+        if seconds is not None:
+            return seconds
+    remaining = model.raw_json.get('estimatedSecondsRemaining')
+    if isinstance(remaining, (int, float)):
+        return max(0.0, float(remaining))
+    return None
+
+
+class PollingStrategy(object):
+    '''
+    Subclasses implement base_delay, the delay used when the server gives no
+    hint. maximum, when set, caps server hints.
+    '''
+    maximum = None
+
+    def base_delay(self, model, poll_count, elapsed):
+        raise NotImplementedError()
+
+    def next_delay(self, model, poll_count, elapsed):
+        hint = server_hint(model)
+        if hint is None:
+            return self.base_delay(model, poll_count, elapsed)
+        return hint if self.maximum is None else min(hint, self.maximum)
+
+    def record(self, model, elapsed):
+        '''
+        Called once model is ready, elapsed seconds after polling began
+        '''
+        pass
+
+
+class FixedInterval(PollingStrategy):
+    '''
+    Poll every interval seconds, as refresh_until_ready always used to, or
+    as the server hints, up to maximum seconds
+    '''
+    def __init__(self, interval=10, maximum=300.0):
+        self.interval = interval
+        self.maximum = maximum
+
+    def base_delay(self, model, poll_count, elapsed):
+        return self.interval
+
+
+class ExponentialBackoff(PollingStrategy):
+    '''
+    Wait initial seconds after the first poll, growing by multiplier after
+    each one up to maximum. Each delay is randomly scaled by up to +/- jitter
+    (a fraction) so that jobs submitted together don't poll in lockstep.
+    '''
+    def __init__(self, initial=1.0, maximum=30.0, multiplier=1.5, jitter=0.1):
+        self.initial = initial
+        self.maximum = maximum
+        self.multiplier = multiplier
+        self.jitter = jitter
+
+    def _jittered(self, delay):
+        return min(self.maximum, delay) * random.uniform(1 - self.jitter, 1 + self.jitter)
+
+    def _backoff(self, poll_count):
+        return self._jittered(self.initial * self.multiplier ** max(0, poll_count - 1))
+
+    def base_delay(self, model, poll_count, elapsed):
+        return self._backoff(poll_count)
+
+
+class AdaptivePolling(ExponentialBackoff):
+    '''
+    ExponentialBackoff that learns how long each (serviceType, serviceVersion)
+    takes. Once it has seen jobs of a kind complete, it sleeps until shortly
+    before the quickest typical completion time (the given percentile of the
+    last `history` observations) and only then starts backing off from
+    initial, so long jobs need only a handful of polls. No single such sleep
+    exceeds maximum_wait, which bounds how late an early failure is noticed.
+
+    profiles may seed expected durations in seconds, keyed like the learned
+    ones, e.g. {('KinectAlignment', 'v1'): 900}. Share one instance between
+    the jobs that should learn from each other.
+    '''
+    def __init__(self, profiles=None, history=50, percentile=0.1, maximum_wait=300.0, **kwargs):
+        super(AdaptivePolling, self).__init__(**kwargs)
+        self.maximum_wait = maximum_wait
+        self.history = history
+        self.percentile = percentile
+        self._observed = {}
+        self._lock = threading.Lock()
+        for key, seconds in (profiles or {}).items():
+            self._observed[key] = deque([seconds], maxlen=history)
+
+    @staticmethod
+    def profile_key(model):
+        return (model.raw_json.get('serviceType'), model.raw_json.get('serviceVersion'))
+
+    def expected_duration(self, model):
+        with self._lock:
+            observed = sorted(self._observed.get(self.profile_key(model), []))
+        if not observed:
+            return None
+        return observed[int(self.percentile * (len(observed) - 1))]
+
+    def base_delay(self, model, poll_count, elapsed):
+        expected = self.expected_duration(model)
+        if expected is None:
+            return self._backoff(poll_count)
+        if elapsed + self.initial < expected:
+            return min(expected - elapsed, self.maximum_wait)
+        # Past the expected time, grow the delay geometrically with the
+        # overrun, which matches multiplying it after every poll
+        return self._jittered(max(self.initial, (elapsed - expected) * (self.multiplier - 1)))
+
+    def record(self, model, elapsed):
+        with self._lock:
+            self._observed.setdefault(
+                self.profile_key(model), deque(maxlen=self.history)).append(elapsed)
@@ -0,0 +1,138 @@
+'''
+Client-side limits on request rate and concurrency, so that many threads or
+worker processes together stay under the API's quota rather than bursting
+into 429s.
+
+A Client applies the RateLimit for each class of request from its
+rate_limits: 'metadata' for API calls such as create and refresh, 'upload'
+for PUTs to S3 and 'download' for downloads. Every HTTP request, including
+retries and each range of a ranged download, takes a token; max_inflight
+bounds the operations in progress at once, a download counting as one
+operation for its whole transfer.
+
+A RateLimit with a path is shared by every process using the same path on
+this host. Its state lives in files locked with flock, which the OS releases
+if a process dies, so a crashed worker never holds on to a slot.
+'''
+import threading
+import time
+
+
+class RateLimit(object):
+    '''
+    Token bucket allowing rate requests per second on average, in bursts of
+    up to burst (by default, one second's worth), and at most max_inflight
+    operations at once. Either limit may be None.
+    '''
+    # Seconds between attempts to take a slot held by another process
+    slot_poll_interval = 0.01
+
+    def __init__(self, rate=None, burst=None, max_inflight=None, path=None):
+        self.rate = rate
+        self.burst = burst if burst is not None else max(1.0, rate or 0)
+        self.max_inflight = max_inflight
+        self.path = path
+        self._lock = threading.Lock()
+        self._tokens = self.burst
+        self._updated_at = time.time()
+        self._slots = None
+        if max_inflight is not None and path is None:
+            self._slots = threading.BoundedSemaphore(max_inflight)
+
+    def _refill(self, tokens, updated_at, now):
+        '''
+        Take a token from a bucket holding tokens at updated_at, returning the
+        new number of tokens and the seconds to wait before the token may be
+        used
+        '''
+        tokens = min(self.burst, tokens + (now - updated_at) * self.rate) - 1
+        return tokens, max(0.0, -tokens / self.rate)
+
+    def wait(self):
+        '''
+        Block until a request may be sent
+        '''
+        if self.rate is None:
+            return
+        now = time.time()
+        if self.path is None:
+            with self._lock:
+                self._tokens, delay = self._refill(self._tokens, self._updated_at, now)
+                self._updated_at = now
+        else:
+            delay = self._wait_shared(now)
+        # Tokens are taken on credit, so waiters are served in order without
+        # polling the bucket
+        if delay > 0:
+            time.sleep(delay)
+
+    def _wait_shared(self, now):
+        import fcntl
+        import os
+        fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            state = os.read(fd, 64).split()
+            if len(state) == 2:
+                tokens, delay = self._refill(float(state[0]), float(state[1]), now)
+            else:
+                tokens, delay = self._refill(self.burst, now, now)
+            os.lseek(fd, 0, os.SEEK_SET)
+            os.ftruncate(fd, 0)
+            os.write(fd, '{!r} {!r}'.format(tokens, now))
+        finally:
+            os.close(fd) # releases the lock
+        return delay
+
+    def inflight(self):
+        '''
+        Context manager holding one of max_inflight slots
+        '''
+        return _Slot(self)
+
+    def _acquire_slot(self):
+        '''
+        Returns a token to pass to _release_slot
+        '''
+        if self.max_inflight is None:
+            return None
+        if self._slots is not None:
+            self._slots.acquire()
+            return None
+
+        import fcntl
+        import os
+        while True:
+            for index in range(self.max_inflight):
+                fd = os.open('{}.slot{}'.format(self.path, index), os.O_RDWR | os.O_CREAT, 0o644)
+                try:
+                    fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                    return fd
+                except IOError:
+                    os.close(fd)
+            time.sleep(self.slot_poll_interval)
+
+    def _release_slot(self, fd):
+        import os
+        if self._slots is not None:
+            self._slots.release()
+        elif fd is not None:
+            os.close(fd)
+
+
+class _Slot(object):
+
+    def __init__(self, limit):
+        self.limit = limit
+        self.fd = None
+
+    def __enter__(self):
+        self.fd = self.limit._acquire_slot() # pylint: disable=protected-access
+        return self
+
+    def __exit__(self, *args):
+        self.limit._release_slot(self.fd) # pylint: disable=protected-access
+
+
+# Stands in for the classes a Client has no RateLimit for
+UNLIMITED = RateLimit()
@@ -0,0 +1,138 @@
+'''
+Retrying transient HTTP failures, and circuit breakers that stop sending
+requests to a host while it keeps failing.
+
+Client retries a request when it fails with a connection error or one of a
+RetryPolicy's statuses (by default 429 and 5xx), if it is safe to repeat:
+GETs, downloads and PUTs always are, while POSTs and PATCHes only are when
+sent with an idempotency key. Each client has a CircuitBreaker per host, from
+its own CircuitBreakers unless one is passed to several clients as
+circuit_breakers, which then back off a failing host together. Once
+failure_threshold consecutive requests to a host have failed, further
+requests raise CircuitOpen without being sent until reset_timeout seconds
+have passed, when one trial request is let through.
+'''
+import random
+import threading
+import time
+import urlparse
+
+import requests
+
+# Errors raised before any response, after which a request may be retried
+RETRYABLE_ERRORS = (
+    requests.exceptions.ConnectionError,
+    requests.exceptions.Timeout,
+)
+
+
+def retry_after_seconds(value):
+    '''
+    Parse a Retry-After header, either seconds or an HTTP date, into seconds
+    from now, or None if it can't be parsed
+    '''
+    from email.utils import parsedate_tz, mktime_tz
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        parsed = parsedate_tz(value)
+        return max(0.0, mktime_tz(parsed) - time.time()) if parsed else None
+
+
+class RetryPolicy(object):
+    '''
+    Make up to max_attempts attempts at each request that is safe to repeat,
+    waiting initial seconds after the first failure and multiplier times
+    longer after each further one, up to maximum, randomly scaled by up to
+    +/- jitter. A Retry-After header on the failed response takes precedence,
+    also capped at maximum.
+
+    methods are the verbs retried without an idempotency key.
+    '''
+    def __init__(self, max_attempts=4, initial=0.5, maximum=30.0, multiplier=2.0, jitter=0.1,
+                 statuses=(429, 500, 502, 503, 504), methods=('GET', 'PUT')):
+        self.max_attempts = max_attempts
+        self.initial = initial
+        self.maximum = maximum
+        self.multiplier = multiplier
+        self.jitter = jitter
+        self.statuses = frozenset(statuses)
+        self.methods = frozenset(methods)
+
+    def is_idempotent(self, method, idempotency_key=None):
+        return method.upper() in self.methods or idempotency_key is not None
+
+    def delay(self, attempt, resp=None):
+        '''
+        Seconds to wait after the attempt-th attempt failed, with resp if it
+        got a response
+        '''
+        if resp is not None and resp.headers.get('Retry-After') is not None:
+            hint = retry_after_seconds(resp.headers['Retry-After'])
+            if hint is not None:
+                return min(hint, self.maximum)
+        delay = min(self.maximum, self.initial * self.multiplier ** (attempt - 1))
+        return delay * random.uniform(1 - self.jitter, 1 + self.jitter)
+
+
+# Makes every request exactly once
+NO_RETRY = RetryPolicy(max_attempts=1)
+
+
+class CircuitBreaker(object):
+    '''
+    Tracks consecutive failures of requests to one host. A failure_threshold
+    of None never opens the circuit.
+    '''
+    def __init__(self, failure_threshold=5, reset_timeout=30.0):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at = None
+        self._lock = threading.Lock()
+
+    @property
+    def is_open(self):
+        return self.opened_at is not None
+
+    def before_request(self, url):
+        '''
+        Raise CircuitOpen unless a request may be sent now
+        '''
+        from bodylabs_api.exceptions import CircuitOpen
+        with self._lock:
+            if self.opened_at is None:
+                return
+            if time.time() - self.opened_at < self.reset_timeout:
+                raise CircuitOpen('Not requesting {} after {} consecutive failures'.format(url, self.failures))
+            # Let this request through as a trial, and refuse others until it
+            # has succeeded or another reset_timeout has passed
+            self.opened_at = time.time()
+
+    def record(self, success):
+        with self._lock:
+            if success:
+                self.failures = 0
+                self.opened_at = None
+            else:
+                self.failures += 1
+                if self.failure_threshold is not None and self.failures >= self.failure_threshold:
+                    self.opened_at = time.time()
+
+
+class CircuitBreakers(object):
+    '''
+    One CircuitBreaker per host, created on demand with the given settings
+    '''
+    def __init__(self, failure_threshold=5, reset_timeout=30.0):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self._breakers = {}
+        self._lock = threading.Lock()
+
+    def for_url(self, url):
+        host = urlparse.urlparse(url).netloc
+        with self._lock:
+            if host not in self._breakers:
+                self._breakers[host] = CircuitBreaker(self.failure_threshold, self.reset_timeout)
+            return self._breakers[host]
@@ -0,0 +1,339 @@
+'''
+Run a manifest of jobs across a pool of processes: the bodylabs-api command.
+
+A manifest lists one job per row, as JSON lines or CSV. Each job's payload is
+either given whole or built from a named template (a payload JSON file) with
+parameters merged into the template's:
+
+    {"name": "scan-001", "template": "alignment", "parameters": {"side": "left"},
+     "files": {"scan": "scans/001.ply"}, "output_path": "out/001.obj"}
+
+CSV manifests have name, template and output_path columns, a file:<name>
+column per dependency and a param:<name> column per parameter (values are
+parsed as JSON where they can be). A dict output_path maps component names
+to paths for a MultiComponentArtifact. Jobs without a name are named after a
+hash of their row and its position, so that the same manifest always names
+them alike; names must be unique.
+
+Jobs are sharded across processes, each running a Batch on its own Client.
+Results stream back as they finish, one JSON line per job, and with a journal
+a rerun skips the jobs that finished and resumes those that were in flight.
+
+    bodylabs-api run manifest.jsonl --template alignment=alignment.json \\
+        --output results.jsonl --journal jobs.sqlite --processes 4 --max-inflight 200
+'''
+import json
+import os
+import sys
+import time
+
+
+def _parse_value(value):
+    try:
+        return json.loads(value)
+    except ValueError:
+        return value
+
+
+def _manifest_rows(path):
+    import csv
+    with open(path, 'rb') as f:
+        if os.path.splitext(path)[1].lower() == '.csv':
+            for row in csv.DictReader(f):
+                yield {
+                    'name': row.get('name') or None,
+                    'template': row.get('template') or None,
+                    'output_path': row.get('output_path') or None,
+                    'files': {
+                        column[len('file:'):]: value for column, value in row.items()
+                        if column.startswith('file:') and value
+                    },
+                    'parameters': {
+                        column[len('param:'):]: _parse_value(value) for column, value in row.items()
+                        if column.startswith('param:') and value != ''
+                    },
+                }
+        else:
+            for line in f:
+                if line.strip():
+                    yield json.loads(line)
+
+
+def read_manifest(path, templates=None):
+    '''
+    List the jobs in the manifest at path as dicts of name, payload, files and
+    output_path. templates maps template names to payloads; the template
+    named None, if any, is used by rows naming none. Raises ValueError for
+    rows without a payload or known template, and for duplicate names.
+    '''
+    import copy
+    from bodylabs_api.cache import canonical_payload_hash
+
+    templates = templates or {}
+    jobs = []
+    names = set()
+    for index, row in enumerate(_manifest_rows(path)):
+        if row.get('payload') is not None:
+            payload = copy.deepcopy(row['payload'])
+        else:
+            template = row.get('template')
+            if template not in templates:
+                raise ValueError('Row {} of {} needs a payload or a known template, not {!r}'.format(
+                    index + 1, path, template))
+            payload = copy.deepcopy(templates[template])
+        if row.get('parameters'):
+            payload.setdefault('parameters', {}).update(row['parameters'])
+        job = {
+            'payload': payload,
+            'files': row.get('files') or {},
+            'output_path': row.get('output_path'),
+        }
+        # Identical rows still get names, and journal histories, of their own
+        job['name'] = row.get('name') or canonical_payload_hash('manifest', dict(job, row=index))[:16]
+        if job['name'] in names:
+            raise ValueError('Row {} of {} repeats the name {!r}'.format(index + 1, path, job['name']))
+        names.add(job['name'])
+        jobs.append(job)
+    return jobs
+
+
+def _run_shard(shard, jobs, results, credentials, batch_options, journal_path):
+    '''
+    Run jobs in a Batch in this (child) process, putting a result dict on
+    the results queue for each, then (shard, error) once done, where error
+    describes why the shard stopped early, or is None
+    '''
+    from bodylabs_api.batch import Batch
+    from bodylabs_api.client import Client
+    from bodylabs_api.journal import Journal
+    from bodylabs_api.models import Artifact, MultiComponentArtifact
+
+    error = None
+    try:
+        client = Client(
+            *credentials, verbose=False, pool_maxsize=batch_options['max_workers'],
+            storage_pool_maxsize=batch_options['max_workers'])
+        journal = Journal(journal_path) if journal_path is not None else None
+        batch = Batch(client, journal=journal, **batch_options)
+        resumed = set()
+        if journal is not None:
+            resumed = set(job.name for job in batch.resume(names=set(job['name'] for job in jobs)))
+        for job in jobs:
+            if job['name'] not in resumed:
+                batch.add(
+                    job['payload'], output_path=job['output_path'], files=job['files'], name=job['name'],
+                    artifact_class=MultiComponentArtifact if isinstance(job['output_path'], dict) else Artifact)
+
+        for result in batch.run():
+            artifact = result.artifact
+            results.put({
+                'name': result.job.name,
+                'ok': result.error is None,
+                'error': repr(result.error) if result.error is not None else None,
+                'artifactId': artifact.artifact_id if artifact is not None else None,
+                'status': artifact.status if artifact is not None else None,
+                'output_path': result.job.output_path,
+                'resumed': result.job.resumed is not None,
+                'seconds': time.time() - result.job.created_at if result.job.created_at else None,
+                'durations': artifact.timeline.durations() if artifact is not None else {},
+            })
+        client.close()
+    except Exception as e: # pylint: disable=broad-except
+        error = 'shard {} crashed: {!r}'.format(shard, e)
+    finally:
+        results.put((shard, error))
+
+
+class Runner(object):
+    '''
+    Runs lists of jobs (as read_manifest returns them) on processes worker
+    processes, each with its own Client and a Batch of max_workers threads.
+    max_inflight bounds the jobs in progress across all processes. The jobs
+    of a worker that crashes or dies without reporting them, e.g. when it's
+    killed, are reported as failed.
+
+    With a journal_path, jobs that finished in an earlier run with the same
+    journal are skipped and those it left unfinished are resumed; see
+    bodylabs_api.journal.
+    '''
+    # Seconds between checks on the workers while no results arrive
+    liveness_interval = 1
+
+    def __init__(self, base_uri, access_key, secret, processes=4, max_workers=8, max_inflight=None,
+                 polling_interval=10, timeout=1200, bulk_uri=None, journal_path=None):
+        self.credentials = (base_uri, access_key, secret)
+        self.processes = processes
+        self.batch_options = {
+            'max_workers': max_workers,
+            'max_inflight': -(-max_inflight // processes) if max_inflight else None,
+            'polling_interval': polling_interval,
+            'timeout': timeout,
+            'bulk_uri': bulk_uri,
+        }
+        self.journal_path = journal_path
+        self.skipped = 0
+
+    def run(self, jobs):
+        '''
+        Generator yielding a result dict for each job as it finishes: name,
+        ok, error, artifactId, status, output_path, resumed, seconds since
+        the job started and the artifact's timeline durations
+        '''
+        import multiprocessing
+        import Queue
+
+        if self.journal_path is not None:
+            from bodylabs_api.journal import Journal
+            finished = Journal(self.journal_path).finished()
+            self.skipped = sum(1 for job in jobs if job['name'] in finished)
+            jobs = [job for job in jobs if job['name'] not in finished]
+
+        results = multiprocessing.Queue()
+        workers = []
+        # The names of each running shard's jobs that haven't been reported
+        unreported = {}
+        for shard in range(min(self.processes, len(jobs))):
+            shard_jobs = jobs[shard::self.processes]
+            worker = multiprocessing.Process(target=_run_shard, args=(
+                shard, shard_jobs, results, self.credentials, self.batch_options, self.journal_path))
+            worker.daemon = True
+            worker.start()
+            workers.append(worker)
+            unreported[shard] = set(job['name'] for job in shard_jobs)
+
+        def failed(shard, error):
+            return [{'name': name, 'ok': False, 'error': error} for name in sorted(unreported.pop(shard, ()))]
+
+        def received(message):
+            '''
+            The results to yield for a message from a worker
+            '''
+            if isinstance(message, tuple):
+                shard, error = message
+                return failed(shard, error or 'shard {} stopped without reporting it'.format(shard))
+            for names in unreported.values():
+                names.discard(message['name'])
+            return [message]
+
+        try:
+            while unreported:
+                try:
+                    message = results.get(timeout=self.liveness_interval)
+                except Queue.Empty:
+                    exited = [shard for shard in unreported if not workers[shard].is_alive()]
+                    # A worker flushes its results before exiting, so once
+                    # they're drained, those of the exited shards are final
+                    while True:
+                        try:
+                            message = results.get_nowait()
+                        except Queue.Empty:
+                            break
+                        for result in received(message):
+                            yield result
+                    for shard in exited:
+                        for result in failed(shard, 'shard {} died with exit code {}'.format(
+                                shard, workers[shard].exitcode)):
+                            yield result
+                    continue
+                for result in received(message):
+                    yield result
+        finally:
+            for worker in workers:
+                if worker.is_alive():
+                    worker.terminate()
+                worker.join()
+
+
+def summarize(results, elapsed):
+    '''
+    Throughput and latency statistics of a run's results
+    '''
+    def percentile(values, fraction):
+        return values[int(fraction * (len(values) - 1))] if values else None
+
+    seconds = sorted(result['seconds'] for result in results if result.get('seconds') is not None)
+    backend = [result['durations']['backend'] for result in results if 'backend' in result.get('durations', {})]
+    return {
+        'jobs': len(results),
+        'succeeded': sum(1 for result in results if result['ok']),
+        'failed': sum(1 for result in results if not result['ok']),
+        'resumed': sum(1 for result in results if result.get('resumed')),
+        'elapsed': elapsed,
+        'jobs_per_second': len(results) / elapsed if elapsed else None,
+        'latency': {
+            'p50': percentile(seconds, 0.5),
+            'p90': percentile(seconds, 0.9),
+            'p99': percentile(seconds, 0.99),
+            'max': seconds[-1] if seconds else None,
+        },
+        'mean_backend_seconds': sum(backend) / len(backend) if backend else None,
+    }
+
+
+def _templates(specs):
+    templates = {}
+    for spec in specs or []:
+        name, _, path = spec.rpartition('=')
+        with open(path, 'r') as f:
+            templates[name or None] = json.load(f)
+    return templates
+
+
+def main(argv=None):
+    import argparse
+    parser = argparse.ArgumentParser(prog='bodylabs-api', description='Body Labs API client')
+    subparsers = parser.add_subparsers(dest='command')
+    run = subparsers.add_parser('run', help='run the jobs in a manifest',
+                                description=__doc__.strip().splitlines()[0])
+    run.add_argument('manifest', help='.jsonl or .csv manifest of jobs')
+    run.add_argument('--template', action='append', metavar='[NAME=]PATH',
+                     help='payload template; without a name, the default for rows naming none')
+    run.add_argument('--output', default='-', help='file to append JSON line results to; - for stdout')
+    run.add_argument('--journal', help='SQLite journal to skip finished jobs and resume unfinished ones')
+    run.add_argument('--processes', type=int, default=4)
+    run.add_argument('--workers', type=int, default=8, help='threads per process')
+    run.add_argument('--max-inflight', type=int, help='jobs in progress at once, across all processes')
+    run.add_argument('--polling-interval', type=float, default=10)
+    run.add_argument('--timeout', type=float, default=1200, help='seconds to wait for each artifact')
+    run.add_argument('--bulk-uri', help="bulk query endpoint for polling, e.g. '{base_uri}/query'")
+    run.add_argument('--base-uri', default=os.environ.get('BODYLABS_API_BASE_URI'))
+    run.add_argument('--access-key', default=os.environ.get('BODYLABS_API_ACCESS_KEY'))
+    run.add_argument('--secret', default=os.environ.get('BODYLABS_API_SECRET'))
+    run.add_argument('--quiet', action='store_true', help="don't report progress on stderr")
+    args = parser.parse_args(argv)
+
+    if not (args.base_uri and args.access_key and args.secret):
+        parser.error('--base-uri, --access-key and --secret (or BODYLABS_API_BASE_URI, '
+                     'BODYLABS_API_ACCESS_KEY and BODYLABS_API_SECRET) are required')
+
+    jobs = read_manifest(args.manifest, _templates(args.template))
+    runner = Runner(
+        args.base_uri, args.access_key, args.secret, processes=args.processes, max_workers=args.workers,
+        max_inflight=args.max_inflight, polling_interval=args.polling_interval, timeout=args.timeout,
+        bulk_uri=args.bulk_uri, journal_path=args.journal)
+
+    output = sys.stdout if args.output == '-' else open(args.output, 'a')
+    results = []
+    started_at = time.time()
+    try:
+        for result in runner.run(jobs):
+            results.append(result)
+            output.write(json.dumps(result) + '\n')
+            output.flush()
+            if not args.quiet:
+                sys.stderr.write('\r{} of {} jobs done, {} failed'.format(
+                    len(results), len(jobs) - runner.skipped, sum(1 for r in results if not r['ok'])))
+    finally:
+        if output is not sys.stdout:
+            output.close()
+
+    summary = summarize(results, time.time() - started_at)
+    summary['skipped'] = runner.skipped
+    if not args.quiet:
+        sys.stderr.write('\n')
+    sys.stderr.write(json.dumps(summary, indent=2, sort_keys=True) + '\n')
+    return 1 if summary['failed'] else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,3 +1,4 @@
+import os
 import unittest
 import mock
 
@@ -20,6 +21,8 @@ class MockResponse(object):
         self.status_code = status_code
         self.raw_json = raw_json
         self.headers = headers or {}
+        self.request = None
+        self.closed = False
 
     def json(self):
         return self.raw_json
@@ -29,14 +32,43 @@ class MockResponse(object):
         import json
         return json.dumps(self.raw_json)
 
+    @property
+    def content(self):
+        return self.text
+
     def iter_content(self, _):
         yield 'fake '
         yield 'contents'
 
+    def close(self):
+        self.closed = True
+
+
+class MockApiTestCase(ScratchDirMixin, unittest.TestCase):
+    '''
+    Runs a MockApiServer, with server_options, and a client of it for each
+    test
+    '''
+    server_options = {}
+
+    def setUp(self):
+        from bodylabs_api.mock_server import MockApiServer
+        super(MockApiTestCase, self).setUp()
+        self.server = MockApiServer(**self.server_options).start()
+        self.client = self.make_client()
+
+    def tearDown(self):
+        self.client.close()
+        self.server.stop()
+        super(MockApiTestCase, self).tearDown()
+
+    def make_client(self):
+        return Client(self.server.base_uri, 'access_key', 'secret', verbose=False)
+
 
 class TestFile(ScratchDirMixin, unittest.TestCase):
 
-    @mock.patch('requests.post')
+    @mock.patch('requests.Session.post')
     def test_file_create(self, mock_post):
         payload = {'format': 'is only validated by actual API'}
         mock_post.return_value = MockResponse(202, {'fileId': '123abc', 'fileType': 'ply'})
@@ -46,7 +78,7 @@ class TestFile(ScratchDirMixin, unittest.TestCase):
         self.assertEqual(f.file_type, 'ply')
         mock_post.assert_called_once_with('http://base_uri/files', json=payload, **v1_auth)
 
-    @mock.patch('requests.get')
+    @mock.patch('requests.Session.get')
     def test_file_find_by_id(self, mock_get):
         mock_get.return_value = MockResponse(200, {'fileId': 'response_file_id', 'fileType': 'ply'})
 
@@ -57,7 +89,7 @@ class TestFile(ScratchDirMixin, unittest.TestCase):
         self.assertEqual(f.file_type, 'ply')
         mock_get.assert_called_once_with('http://base_uri/files/request_file_id', **v1_auth)
 
-    @mock.patch('requests.get')
+    @mock.patch('requests.Session.get')
     def test_file_download(self, mock_get):
         response_sequence = [
             # refreshes until ready
@@ -76,6 +108,7 @@ class TestFile(ScratchDirMixin, unittest.TestCase):
         with open(download_path, 'r') as open_file:
             self.assertEqual(open_file.read(), 'fake contents')
 
+        self.assertEqual(f.poll_count, 2)
         self.assertEqual(mock_get.call_count, 4)
         # polling calls
         self.assertEqual(mock_get.call_args_list[0], (('http://base_uri/files/123abc',), v1_auth))
@@ -86,25 +119,127 @@ class TestFile(ScratchDirMixin, unittest.TestCase):
         exp_kwargs.update(v1_auth)
         self.assertEqual(mock_get.call_args_list[3], (('http://base_uri/files/123abc/download',), exp_kwargs))
 
-    @mock.patch('requests.put')
+    @mock.patch('requests.Session.put')
     def test_file_upload(self, mock_put):
         local_path = self.get_tmp_path('test_file_upload.ply')
         with open(local_path, 'w') as open_file:
             open_file.write('this is a file') # just so that it exists
 
-        mock_put.return_value = MockResponse(200, {}, headers={'x-amz-version-id': 'this-is-the-s3-version-id'})
+        uploaded = []
+        def consume_body(_, data, headers):
+            uploaded.append(''.join(data))
+            return MockResponse(200, {}, headers={'x-amz-version-id': 'this-is-the-s3-version-id'})
+        mock_put.side_effect = consume_body
 
         f = File({'fileId': '123abc', 'signedUploadUrl': 'https://signed_upload_url'}, client)
         f.upload(local_path)
 
         self.assertEqual(f.s3_version_id, 'this-is-the-s3-version-id')
-        mock_put.assert_called_once_with(
-            'https://signed_upload_url',
-            data='this is a file',
-            headers={'Content-Type': 'application/octet-stream'}
+        self.assertEqual(uploaded, ['this is a file'])
+        self.assertEqual(mock_put.call_args[0], ('https://signed_upload_url',))
+        self.assertEqual(
+            mock_put.call_args[1]['headers'],
+            {'Content-Type': 'application/octet-stream', 'Content-Length': '14'}
         )
 
-    @mock.patch('requests.patch')
+    @mock.patch('requests.Session.put')
+    def test_file_upload_from_iterator(self, mock_put):
+        uploaded = []
+        def consume_body(_, data, headers):
+            uploaded.append(''.join(data))
+            return MockResponse(200, {}, headers={'x-amz-version-id': 'this-is-the-s3-version-id'})
+        mock_put.side_effect = consume_body
+
+        f = File({'fileId': '123abc', 'signedUploadUrl': 'https://signed_upload_url'}, client)
+        f.upload(iter(['this ', 'is ', 'a file']), content_length=14)
+
+        self.assertEqual(uploaded, ['this is a file'])
+        self.assertEqual(mock_put.call_args[1]['headers']['Content-Length'], '14')
+
+        with self.assertRaises(ValueError):
+            f.upload(iter(['no length']))
+
+    @mock.patch('requests.Session.put')
+    def test_file_upload_memory_is_bounded(self, mock_put):
+        import resource
+        from bodylabs_api.client import UPLOAD_CHUNK_SIZE
+
+        file_size = 64 * 1024 * 1024
+        local_path = self.get_tmp_path('test_file_upload_large.ply')
+        with open(local_path, 'wb') as open_file:
+            block = 'x' * UPLOAD_CHUNK_SIZE
+            for _ in range(file_size / UPLOAD_CHUNK_SIZE):
+                open_file.write(block)
+
+        largest_read = [0]
+        total_read = [0]
+        def consume_body(_, data, headers):
+            # Read the way httplib does when sending a file-like body
+            block = data.read(8192 * 1024)
+            while block:
+                largest_read[0] = max(largest_read[0], len(block))
+                total_read[0] += len(block)
+                block = data.read(8192 * 1024)
+            return MockResponse(200, {}, headers={'x-amz-version-id': 'this-is-the-s3-version-id'})
+        mock_put.side_effect = consume_body
+
+        peak_before_kb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        f = File({'fileId': '123abc', 'signedUploadUrl': 'https://signed_upload_url'}, client)
+        f.upload(local_path)
+        peak_after_kb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+        self.assertEqual(total_read[0], file_size)
+        self.assertLessEqual(largest_read[0], UPLOAD_CHUNK_SIZE)
+        # The whole file would be 64 MB; allow generous slack for the runtime
+        self.assertLess((peak_after_kb - peak_before_kb) * 1024, file_size / 4)
+
+    def test_file_upload_multipart(self):
+        import os
+        from bodylabs_api import client as client_module
+        from bodylabs_api.mock_server import MockS3Server
+
+        part_size = client_module.MULTIPART_MIN_PART_SIZE
+        contents = os.urandom(2 * part_size + 1024)
+        local_path = self.get_tmp_path('test_file_upload_multipart.ply')
+        with open(local_path, 'wb') as open_file:
+            open_file.write(contents)
+
+        with MockS3Server() as s3, mock.patch.object(client_module, 'MULTIPART_RETRY_DELAY', 0):
+            s3.fail_next('scan.ply', times=2, part_number=2)
+            f = File({
+                'fileId': '123abc',
+                'multipartUpload': s3.create_multipart_upload('scan.ply', part_count=3),
+            }, client)
+            f.upload(local_path, part_size=part_size, max_workers=3)
+
+            self.assertIsNotNone(f.s3_version_id)
+            self.assertEqual(s3.objects['scan.ply'], contents)
+            # three parts, of which the second one was retried twice
+            self.assertEqual(s3.requests_by_key['scan.ply'], 5)
+
+    def test_failed_multipart_upload_is_aborted(self):
+        from bodylabs_api import client as client_module
+        from bodylabs_api.mock_server import MockS3Server
+
+        part_size = client_module.MULTIPART_MIN_PART_SIZE
+        local_path = self.get_tmp_path('test_failed_multipart_upload.ply')
+        with open(local_path, 'wb') as open_file:
+            open_file.write(os.urandom(3 * part_size))
+
+        # Slow responses, so the last part is still queued when the first fails
+        with MockS3Server(latency=0.2) as s3:
+            s3.fail_next('scan.ply', times=1, part_number=1)
+            multipart_upload = s3.create_multipart_upload('scan.ply', part_count=3)
+            with self.assertRaises(HttpError):
+                client.upload_multipart(
+                    multipart_upload, local_path, part_size=part_size, max_workers=1, max_part_retries=0)
+
+            # The second part may have started by then, but the last was never sent
+            self.assertLessEqual(s3.requests_by_key['scan.ply'], 2)
+            self.assertEqual(s3.aborted_uploads, [multipart_upload['uploadId']])
+            self.assertNotIn('scan.ply', s3.objects)
+
+    @mock.patch('requests.Session.patch')
     def test_file_finalize(self, mock_patch):
         mock_patch.return_value = MockResponse(202, {'fileId': '123abc', 'status': 'ready'})
 
@@ -118,7 +253,7 @@ class TestFile(ScratchDirMixin, unittest.TestCase):
             **v1_auth
         )
 
-    @mock.patch('requests.patch')
+    @mock.patch('requests.Session.patch')
     def test_file_error_propagated(self, mock_patch):
         error_json = {'code': 'NOT_FOUND_RESOURCE', 'message': 'File 123abc not found'}
         mock_patch.return_value = MockResponse(404, error_json)
@@ -139,9 +274,203 @@ class TestFile(ScratchDirMixin, unittest.TestCase):
         self.assertTrue(error_thrown)
 
 
+class TestUploadCache(MockApiTestCase):
+
+    def test_repeat_uploads_are_skipped(self):
+        from bodylabs_api.cache import UploadCache, hash_file
+        cache = UploadCache(self.get_tmp_path('uploads.sqlite'))
+        local_path = self.get_tmp_path('scan.ply')
+        with open(local_path, 'w') as open_file:
+            open_file.write('this is a file')
+
+        first = File.from_local_path(local_path, self.client, cache=cache)
+        second = File.from_local_path(local_path, self.client, cache=cache)
+        other_type = File.from_local_path(local_path, self.client, file_type='obj', cache=cache)
+
+        self.assertEqual(second.file_id, first.file_id)
+        self.assertEqual(second.status, 'ready')
+        self.assertNotEqual(other_type.file_id, first.file_id)
+        self.assertEqual(self.server.request_counts[('POST', '/files')], 2)
+        self.assertEqual(cache.stats, {'hits': 1, 'misses': 2})
+
+        # Another process sees the same entries
+        self.assertEqual(
+            UploadCache(self.get_tmp_path('uploads.sqlite')).get(hash_file(local_path), 'ply'),
+            first.file_id
+        )
+
+    def test_entries_expire_and_are_evicted(self):
+        from bodylabs_api.cache import UploadCache
+        cache = UploadCache(self.get_tmp_path('uploads.sqlite'), max_entries=2)
+        # Distinct timestamps, so that the least recently used is well defined
+        with mock.patch('time.time') as mock_time:
+            for index in range(3):
+                mock_time.return_value = 1000.0 + index
+                cache.put('hash{}'.format(index), 'ply', 'file{}'.format(index))
+            mock_time.return_value = 1003.0
+            self.assertIsNone(cache.get('hash0', 'ply'))
+            self.assertEqual(cache.get('hash2', 'ply'), 'file2')
+
+        cache.ttl = -1
+        self.assertIsNone(cache.get('hash2', 'ply'))
+
+
+class TestArtifactStore(MockApiTestCase):
+    server_options = {'components': {'Mocap': ['outputOne']}}
+
+    def setUp(self):
+        from bodylabs_api.cache import ArtifactStore
+        super(TestArtifactStore, self).setUp()
+        self.store = ArtifactStore(self.get_tmp_path('store'))
+
+    def _read(self, path):
+        with open(path, 'r') as open_file:
+            return open_file.read()
+
+    def test_stored_downloads_skip_the_network(self):
+        artifact = Artifact({'serviceType': 'FootAlignment', 'serviceVersion': 'v1'}, self.client).create()
+        expected = 'contents of {}'.format(artifact.artifact_id)
+
+        artifact.download(self.get_tmp_path('first.obj'), store=self.store, polling_interval=0)
+        counts_after_first = dict(self.server.request_counts)
+        artifact.download(self.get_tmp_path('second.obj'), store=self.store, polling_interval=0)
+
+        self.assertEqual(self._read(self.get_tmp_path('second.obj')), expected)
+        self.assertEqual(self.server.request_counts, counts_after_first)
+        self.assertEqual(self.store.stats, {'hits': 1, 'misses': 1})
+
+        artifact.download(self.get_tmp_path('third.obj'), store=self.store, revalidate=True, polling_interval=0)
+        self.assertEqual(self._read(self.get_tmp_path('third.obj')), expected)
+        self.assertEqual(self.store.revalidated, 1)
+
+    def test_stored_components(self):
+        artifact = MultiComponentArtifact({'serviceType': 'Mocap', 'serviceVersion': 'v1'}, self.client).create()
+        for name in ['first', 'second']:
+            artifact.download_component(
+                'outputOne', self.get_tmp_path(name), store=self.store, polling_interval=0)
+        self.assertEqual(
+            self._read(self.get_tmp_path('second')), 'contents of {}/outputOne'.format(artifact.artifact_id))
+        self.assertEqual(self.server.request_counts[('GET', '/artifacts/{id}/components/outputOne')], 1)
+
+        # Named components found in the store need no refresh either
+        counts = dict(self.server.request_counts)
+        artifact.download_components(['outputOne'], self.get_tmp_path(''), store=self.store, polling_interval=0)
+        self.assertEqual(self.server.request_counts, counts)
+        self.assertEqual(artifact.downloaded_components['outputOne'], self.get_tmp_path('outputOne'))
+
+    def test_interrupted_download_is_resumed(self):
+        import requests
+        artifact = Artifact({'serviceType': 'FootAlignment', 'serviceVersion': 'v1'}, self.client).create()
+        self.server.truncate_downloads = 4 # the first request and all three resumes
+        with self.assertRaises(requests.exceptions.ChunkedEncodingError):
+            artifact.download(self.get_tmp_path('first.obj'), store=self.store, polling_interval=0)
+
+        artifact.download(self.get_tmp_path('second.obj'), store=self.store, polling_interval=0)
+        self.assertEqual(
+            self._read(self.get_tmp_path('second.obj')), 'contents of {}'.format(artifact.artifact_id))
+        self.assertEqual(self.server.request_counts[('DOWNLOAD', '200')], 1)
+        self.assertEqual(len(os.listdir(self.get_tmp_path('store'))), 2) # the index and the output
+
+        # Forgetting everything also discards partial downloads
+        other = Artifact({'serviceType': 'FootAlignment', 'serviceVersion': 'v1'}, self.client).create()
+        self.server.truncate_downloads = 4
+        with self.assertRaises(requests.exceptions.ChunkedEncodingError):
+            other.download(self.get_tmp_path('other.obj'), store=self.store, polling_interval=0)
+        self.store.invalidate()
+        self.assertEqual(os.listdir(self.get_tmp_path('store')), ['index.sqlite'])
+
+    def test_least_recently_used_outputs_are_evicted(self):
+        self.store.max_bytes = 2 * len('contents of ') + 64 # room for two outputs
+        artifacts = [Artifact({'serviceType': 'FootAlignment'}, self.client).create() for _ in range(3)]
+        for artifact in artifacts:
+            artifact.download(self.get_tmp_path(artifact.artifact_id), store=self.store, polling_interval=0)
+
+        self.assertFalse(self.store.get(self.store.key(artifacts[0]), self.get_tmp_path('evicted')))
+        self.assertTrue(self.store.get(self.store.key(artifacts[2]), self.get_tmp_path('kept')))
+
+
+class TestPayloadMemo(MockApiTestCase):
+
+    def setUp(self):
+        from bodylabs_api.cache import PayloadMemo
+        super(TestPayloadMemo, self).setUp()
+        self.memo = PayloadMemo(self.get_tmp_path('payloads.sqlite'))
+
+    def test_identical_payloads_reuse_artifacts(self):
+        first = Artifact({'serviceType': 'FootAlignment', 'parameters': {'side': 'left', 'scanUnits': 'cm'}},
+                         self.client).create(memo=self.memo)
+        # Same payload, different key order
+        second = Artifact({'parameters': {'scanUnits': 'cm', 'side': 'left'}, 'serviceType': 'FootAlignment'},
+                          self.client).create(memo=self.memo)
+        other = Artifact({'serviceType': 'FootAlignment', 'parameters': {'side': 'right', 'scanUnits': 'cm'}},
+                         self.client).create(memo=self.memo)
+
+        self.assertEqual(second.artifact_id, first.artifact_id)
+        self.assertNotEqual(other.artifact_id, first.artifact_id)
+        self.assertEqual(self.server.request_counts[('POST', '/artifacts')], 2)
+        self.assertEqual(self.memo.stats, {'hits': 1, 'misses': 2})
+
+    def test_failed_artifacts_are_recreated(self):
+        payload = {'serviceType': 'FootAlignment', 'parameters': {'side': 'left'}}
+        first = Artifact(dict(payload), self.client).create(memo=self.memo)
+        self.server.artifacts[first.artifact_id]['status'] = 'failed'
+
+        second = Artifact(dict(payload), self.client).create(memo=self.memo)
+        self.assertNotEqual(second.artifact_id, first.artifact_id)
+        self.assertEqual(second.service_type, 'FootAlignment')
+
+        self.memo.invalidate()
+        third = Artifact(dict(payload), self.client).create(memo=self.memo)
+        self.assertNotEqual(third.artifact_id, second.artifact_id)
+
+
+class TestMetadataCache(unittest.TestCase):
+
+    def test_ttls_by_status_and_lru_eviction(self):
+        import json
+        from bodylabs_api.cache import MetadataCache
+        cache = MetadataCache(max_entries=2, ttls={'pending': 60})
+
+        def put(url, raw_json):
+            cache.put(url, json.dumps(raw_json), raw_json, {'ETag': '"etag"'})
+        put('/artifacts/a', {'status': 'ready'})
+        put('/artifacts/b', {'status': 'pending'})
+        put('/artifacts/query', {'artifacts': []})
+        self.assertIsNone(cache.lookup('/artifacts/a')) # least recently used
+        self.assertTrue(cache.lookup('/artifacts/b').fresh)
+        stale = cache.lookup('/artifacts/query')
+        self.assertFalse(stale.fresh)
+        self.assertEqual(stale.conditions(), {'If-None-Match': '"etag"'})
+        self.assertEqual(cache.stats, {'hits': 1, 'misses': 3, 'revalidations': 0, 'evictions': 1, 'entries': 2})
+
+    def test_client_skips_and_revalidates_requests(self):
+        from bodylabs_api.cache import MetadataCache
+        from bodylabs_api.mock_server import MockApiServer
+        cache = MetadataCache(ttls={'pending': 0})
+        with MockApiServer(processing_delay=0.2, components={'Mocap': ['a.fbx']}) as server:
+            local_client = Client(server.base_uri, 'access_key', 'secret', verbose=False, metadata_cache=cache)
+            artifact = MultiComponentArtifact({'serviceType': 'Mocap'}, local_client).create()
+            artifact.refresh()
+            artifact.refresh()
+            self.assertEqual(artifact.status, 'pending')
+            self.assertEqual(server.request_counts[('NOT_MODIFIED', '/artifacts/{id}')], 1)
+
+            artifact.refresh_until_ready(polling_interval=0.05)
+            gets = server.request_counts[('GET', '/artifacts/{id}')]
+            found = MultiComponentArtifact.find_by_id(artifact.artifact_id, local_client)
+            found.get_component_uri('a.fbx', validate=True)
+            self.assertEqual(found.raw_json, artifact.raw_json)
+            self.assertEqual(server.request_counts[('GET', '/artifacts/{id}')], gets)
+            self.assertEqual(cache.stats['hits'], 2)
+            # Cached JSON is copied, so models can't change the cache
+            found.raw_json['status'] = 'changed'
+            self.assertEqual(artifact.refresh().status, 'ready')
+            local_client.close()
+
+
 class TestArtifact(unittest.TestCase):
 
-    @mock.patch('requests.post')
+    @mock.patch('requests.Session.post')
     def test_artifact_create(self, mock_post):
         payload = {'format': 'is only validated by actual API'}
         mock_post.return_value = MockResponse(202, {
@@ -161,7 +490,7 @@ class TestArtifact(unittest.TestCase):
 
 class TestMultiComponentArtifact(ScratchDirMixin, unittest.TestCase):
 
-    @mock.patch('requests.post')
+    @mock.patch('requests.Session.post')
     def test_multi_component_artifact_create(self, mock_post):
         payload = {'format': 'is only validated by actual API'}
         mock_post.return_value = MockResponse(202, {
@@ -178,7 +507,7 @@ class TestMultiComponentArtifact(ScratchDirMixin, unittest.TestCase):
         self.assertEqual(artifact.components, ['outputOne', 'outputTwo'])
         mock_post.assert_called_once_with('http://base_uri/artifacts', json=payload, **v1_auth)
 
-    @mock.patch('requests.get')
+    @mock.patch('requests.Session.get')
     def test_multi_component_artifact_download(self, mock_get):
         response_sequence = [
             # refreshes until ready
@@ -211,5 +540,1012 @@ class TestMultiComponentArtifact(ScratchDirMixin, unittest.TestCase):
             (('http://base_uri/artifacts/123abc/components/outputOne',), exp_kwargs)
         )
 
+    def test_download_components(self):
+        from bodylabs_api.mock_server import MockApiServer
+        names = ['outputOne', 'outputTwo', 'outputThree']
+        with MockApiServer(components={'Mocap': names}) as server:
+            with Client(server.base_uri, 'access_key', 'secret', verbose=False) as local_client:
+                artifact = MultiComponentArtifact({'serviceType': 'Mocap'}, local_client).create()
+                artifact.download_components(output_dir=self.scratch_dir, polling_interval=0)
+
+                with self.assertRaises(ValueError):
+                    artifact.download_components(['outputOne', 'outputFour'], output_dir=self.scratch_dir)
+
+        self.assertEqual(sorted(artifact.downloaded_components), sorted(names))
+        for name in names:
+            with open(artifact.downloaded_components[name], 'r') as open_file:
+                self.assertEqual(open_file.read(), 'contents of {}/{}'.format(artifact.artifact_id, name))
+            self.assertEqual(server.request_counts[('GET', '/artifacts/{id}/components/' + name)], 1)
+        # One refresh each, rather than two per component
+        self.assertEqual(server.request_counts[('GET', '/artifacts/{id}')], 2)
+
+
+class TestPolling(unittest.TestCase):
+
+    def test_exponential_backoff_is_capped_and_jittered(self):
+        from bodylabs_api.polling import ExponentialBackoff
+        artifact = Artifact({'artifactId': '123abc'}, client)
+        polling = ExponentialBackoff(initial=1, maximum=8, multiplier=2, jitter=0.1)
+
+        delays = [polling.next_delay(artifact, poll_count, 0) for poll_count in range(1, 7)]
+        for delay, expected in zip(delays, [1, 2, 4, 8, 8, 8]):
+            self.assertGreaterEqual(delay, expected * 0.9)
+            self.assertLessEqual(delay, expected * 1.1)
+
+    def test_server_hints_take_precedence(self):
+        from bodylabs_api.polling import ExponentialBackoff, FixedInterval
+        polling = ExponentialBackoff(initial=1, maximum=30, jitter=0)
+        artifact = Artifact({'artifactId': '123abc', 'estimatedSecondsRemaining': 12}, client)
+        self.assertEqual(polling.next_delay(artifact, 1, 0), 12)
+
+        artifact.response_headers = {'Retry-After': '5'}
+        self.assertEqual(polling.next_delay(artifact, 1, 0), 5)
+
+        artifact.response_headers = {'Retry-After': '3600'}
+        self.assertEqual(polling.next_delay(artifact, 1, 0), 30)
+        self.assertEqual(FixedInterval().next_delay(artifact, 1, 0), 300)
+
+    def test_adaptive_polling_learns_per_service(self):
+        from bodylabs_api.polling import AdaptivePolling
+        polling = AdaptivePolling(initial=1, maximum=30, jitter=0)
+        kinect = Artifact({'serviceType': 'KinectAlignment', 'serviceVersion': 'v1'}, client)
+        foot = Artifact({'serviceType': 'FootAlignment', 'serviceVersion': 'v1'}, client)
+
+        self.assertEqual(polling.next_delay(kinect, 1, 0), 1)
+        polling.record(kinect, 600)
+        polling.record(kinect, 700)
+        # sleep until the quickest typical completion, then back off again
+        self.assertEqual(polling.next_delay(kinect, 1, 0), 300)
+        self.assertEqual(polling.next_delay(kinect, 2, 500), 100)
+        self.assertEqual(polling.next_delay(kinect, 3, 610), 5)
+        self.assertEqual(polling.next_delay(foot, 1, 0), 1)
+
+    @mock.patch('time.sleep')
+    @mock.patch('requests.Session.get')
+    def test_refresh_until_ready_uses_strategy(self, mock_get, mock_sleep):
+        from bodylabs_api.polling import FixedInterval
+        mock_get.side_effect = [
+            MockResponse(200, {'artifactId': '123abc', 'status': 'pending'}, headers={'Retry-After': '2'}),
+            MockResponse(200, {'artifactId': '123abc', 'status': 'pending'}),
+            MockResponse(200, {'artifactId': '123abc', 'status': 'ready'}),
+        ]
+
+        artifact = Artifact({'artifactId': '123abc'}, client)
+        artifact.refresh_until_ready(polling=FixedInterval(7), timeout=60)
+
+        self.assertEqual(artifact.poll_count, 3)
+        self.assertEqual([args[0] for args, _ in mock_sleep.call_args_list], [2.0, 7])
+
+    @mock.patch('time.sleep')
+    @mock.patch('requests.Session.get')
+    def test_waits_end_at_the_timeout(self, mock_get, mock_sleep):
+        from harrison.timer import TimeoutError
+        mock_get.return_value = MockResponse(
+            200, {'artifactId': '123abc', 'status': 'pending'}, headers={'Retry-After': '120'})
+        now = [1000.0]
+        mock_sleep.side_effect = lambda seconds: now.__setitem__(0, now[0] + seconds)
+
+        with mock.patch('time.time', lambda: now[0]):
+            with self.assertRaises(TimeoutError):
+                Artifact({'artifactId': '123abc'}, client).refresh_until_ready(timeout=30)
+        self.assertEqual([args[0] for args, _ in mock_sleep.call_args_list], [30.0])
+
+
+class TestBatch(ScratchDirMixin, unittest.TestCase):
+
+    @mock.patch('requests.Session.get')
+    @mock.patch('requests.Session.post')
+    def test_batch_reports_results_and_failures(self, mock_post, mock_get):
+        import threading
+        from bodylabs_api.batch import Batch
+        from bodylabs_api.exceptions import ProcessingFailed
+
+        statuses = {
+            'good': ['pending', 'pending', 'ready'],
+            'bad': ['pending', 'failed'],
+            'missing': [],
+        }
+        lock = threading.Lock()
+
+        def post(_, json, **kwargs):
+            if json['parameters']['name'] == 'missing':
+                return MockResponse(404, {'code': 'NOT_FOUND_RESOURCE'})
+            return MockResponse(202, {'artifactId': json['parameters']['name'], 'status': 'pending'})
+
+        def get(uri, **kwargs):
+            if uri.endswith('/download'):
+                return MockResponse(200, {})
+            artifact_id = uri.rsplit('/', 1)[-1]
+            with lock:
+                status = statuses[artifact_id].pop(0)
+            return MockResponse(200, {'artifactId': artifact_id, 'status': status})
+
+        mock_post.side_effect = post
+        mock_get.side_effect = get
+
+        batch = Batch(client, max_workers=4, max_inflight=2, polling_interval=0)
+        for name in ['good', 'bad', 'missing']:
+            batch.add(
+                {'serviceType': 'FootAlignment', 'parameters': {'name': name}},
+                output_path=self.get_tmp_path('{}.obj'.format(name))
+            )
+        results = {result.job.payload['parameters']['name']: result for result in batch.run()}
+
+        self.assertIsNone(results['good'].error)
+        self.assertEqual(results['good'].artifact.download_path, self.get_tmp_path('good.obj'))
+        with open(self.get_tmp_path('good.obj'), 'r') as open_file:
+            self.assertEqual(open_file.read(), 'fake contents')
+        self.assertIsInstance(results['bad'].error, ProcessingFailed)
+        self.assertIsInstance(results['missing'].error, HttpError)
+        self.assertEqual(mock_post.call_count, 3)
+
+
+class _JournaledArtifact(Artifact):
+    pass
+
+
+class TestJournal(ScratchDirMixin, unittest.TestCase):
+
+    def test_records_transitions_and_compacts(self):
+        from bodylabs_api.journal import Journal
+        journal = Journal(self.get_tmp_path('journal.sqlite'))
+        job = journal.job('scan-1', 'file:scan')
+        job.record('created', File({'fileId': 'f', 'status': 'pending'}, client))
+        job.record('finalized', File({'fileId': 'f', 'status': 'ready'}, client))
+        journal.append('scan-2', 'submitted', payload={})
+        journal.append('scan-2', 'finished', error=None)
+
+        history = journal.history('scan-1', client)
+        self.assertEqual([entry.transition for entry in history], ['created', 'finalized'])
+        self.assertIsInstance(history[-1].model, File)
+        unfinished = journal.unfinished(client)
+        self.assertEqual([job.name for job in unfinished], ['scan-1'])
+        self.assertEqual(unfinished[0].models['file:scan'].model.status, 'ready')
+
+        journal.compact()
+        self.assertEqual(journal.history('scan-2'), [])
+        self.assertEqual(len(journal.history('scan-1')), 2)
+
+    def test_model_classes_from_other_modules(self):
+        from bodylabs_api.journal import Journal
+        journal = Journal(self.get_tmp_path('journal.sqlite'))
+        journal.job('scan', 'artifact').record('created', _JournaledArtifact({'artifactId': 'a'}, client))
+        self.assertIsInstance(journal.history('scan', client)[0].model, _JournaledArtifact)
+
+        with journal._connect() as connection: # pylint: disable=protected-access
+            connection.execute("UPDATE transitions SET model_class = 'missing_module.Artifact'")
+        with self.assertRaises(ValueError):
+            journal.history('scan', client)
+
+    def test_batch_resumes_without_creating_again(self):
+        from bodylabs_api.batch import Batch
+        from bodylabs_api.journal import Journal
+        from bodylabs_api.mock_server import MockApiServer
+
+        journal = Journal(self.get_tmp_path('journal.sqlite'))
+        with MockApiServer() as server:
+            local_client = Client(server.base_uri, 'access_key', 'secret', verbose=False)
+
+            def submit(name):
+                journal.append(
+                    name, 'submitted', payload={'serviceType': 'FootAlignment'},
+                    output_path=self.get_tmp_path(name + '.obj'), files={}, artifact_class='Artifact')
+                return journal.job(name, 'artifact')
+
+            # The state crashed workers leave behind: one job crashed while
+            # polling, one after its POST was sent but before it was recorded
+            Artifact({'serviceType': 'FootAlignment'}, local_client).create(journal=submit('polling'))
+            submit('creating').record(
+                'creating', Artifact({'serviceType': 'FootAlignment'}, local_client), idempotency_key='key')
+            Artifact({'serviceType': 'FootAlignment'}, local_client).create(idempotency_key='key')
+            submit('done')
+            journal.append('done', 'finished', error=None)
+
+            batch = Batch(local_client, polling_interval=0.01, journal=journal)
+            self.assertEqual([job.name for job in batch.resume()], ['polling', 'creating'])
+            results = list(batch.run())
+            local_client.close()
+
+        self.assertEqual([result.error for result in results], [None, None])
+        self.assertEqual(server.request_counts[('POST', '/artifacts')], 3)
+        self.assertEqual(len(server.artifacts), 2)
+        for name in ('polling', 'creating'):
+            self.assertTrue(os.path.exists(self.get_tmp_path(name + '.obj')))
+        self.assertEqual(journal.unfinished(client), [])
+
+
+def _killed_shard(*_):
+    import signal
+    os.kill(os.getpid(), signal.SIGKILL)
+
+
+class TestRunner(ScratchDirMixin, unittest.TestCase):
+
+    def test_reads_csv_and_jsonl_manifests(self):
+        import json
+        from bodylabs_api.runner import read_manifest
+        templates = {'alignment': {'serviceType': 'FootAlignment', 'parameters': {'side': 'right', 'up': 1}}}
+        csv_path = self.get_tmp_path('manifest.csv')
+        with open(csv_path, 'w') as f:
+            f.write('name,template,output_path,file:scan,param:side,param:up\n')
+            f.write('a,alignment,a.obj,a.ply,left,\n')
+            f.write(',alignment,b.obj,b.ply,,2\n')
+        jsonl_path = self.get_tmp_path('manifest.jsonl')
+        with open(jsonl_path, 'w') as f:
+            f.write(json.dumps({'name': 'a', 'template': 'alignment', 'parameters': {'side': 'left'},
+                                'files': {'scan': 'a.ply'}, 'output_path': 'a.obj'}) + '\n')
+
+        jobs = read_manifest(csv_path, templates)
+        self.assertEqual(jobs[0], read_manifest(jsonl_path, templates)[0])
+        self.assertEqual(jobs[0]['payload']['parameters'], {'side': 'left', 'up': 1})
+        self.assertEqual(jobs[1]['payload']['parameters'], {'side': 'right', 'up': 2})
+        self.assertEqual(jobs[1]['name'], read_manifest(csv_path, templates)[1]['name'])
+        self.assertEqual(templates['alignment']['parameters'], {'side': 'right', 'up': 1})
+        with self.assertRaises(ValueError):
+            read_manifest(csv_path)
+
+        with open(csv_path, 'a') as f:
+            f.write(',alignment,b.obj,b.ply,,2\n')
+        self.assertEqual(len(set(job['name'] for job in read_manifest(csv_path, templates))), 3)
+        with open(csv_path, 'a') as f:
+            f.write('a,alignment,c.obj,c.ply,,\n')
+        with self.assertRaises(ValueError):
+            read_manifest(csv_path, templates)
+
+    def test_killed_workers_jobs_fail(self):
+        from bodylabs_api.runner import Runner
+        jobs = [{'name': str(index), 'payload': {}, 'files': {}, 'output_path': None} for index in range(3)]
+        runner = Runner('http://base_uri', 'access_key', 'secret', processes=2)
+        runner.liveness_interval = 0.05
+        with mock.patch('bodylabs_api.runner._run_shard', _killed_shard):
+            results = list(runner.run(jobs))
+        self.assertEqual(sorted(result['name'] for result in results), ['0', '1', '2'])
+        self.assertFalse(any(result['ok'] for result in results))
+        self.assertIn('died with exit code -9', results[0]['error'])
+
+    def test_crashed_workers_jobs_fail(self):
+        from bodylabs_api.runner import Runner
+        jobs = [{'name': str(index), 'payload': {}, 'files': {}, 'output_path': None} for index in range(3)]
+        runner = Runner('http://base_uri', 'access_key', 'secret', processes=2)
+        with mock.patch('bodylabs_api.batch.Batch.run', side_effect=RuntimeError('boom')):
+            results = list(runner.run(jobs))
+        self.assertEqual(sorted(result['name'] for result in results), ['0', '1', '2'])
+        self.assertFalse(any(result['ok'] for result in results))
+        self.assertIn("crashed: RuntimeError('boom',)", results[0]['error'])
+
+    def test_runs_sharded_and_skips_finished_jobs(self):
+        import json
+        from bodylabs_api.mock_server import MockApiServer
+        from bodylabs_api.runner import main
+
+        with open(self.get_tmp_path('scan.ply'), 'w') as f:
+            f.write('scan')
+        with open(self.get_tmp_path('template.json'), 'w') as f:
+            json.dump({'serviceType': 'FootAlignment'}, f)
+        with open(self.get_tmp_path('manifest.jsonl'), 'w') as f:
+            for index in range(5):
+                f.write(json.dumps({
+                    'files': {'scan': self.get_tmp_path('scan.ply')},
+                    'output_path': self.get_tmp_path('{}.obj'.format(index)),
+                }) + '\n')
+
+        argv = [
+            'run', self.get_tmp_path('manifest.jsonl'), '--template', self.get_tmp_path('template.json'),
+            '--output', self.get_tmp_path('results.jsonl'), '--journal', self.get_tmp_path('journal.sqlite'),
+            '--processes', '2', '--polling-interval', '0.01', '--quiet',
+            '--access-key', 'access_key', '--secret', 'secret',
+        ]
+        with MockApiServer() as server, mock.patch('sys.stderr'):
+            self.assertEqual(main(argv + ['--base-uri', server.base_uri]), 0)
+            self.assertEqual(main(argv + ['--base-uri', server.base_uri]), 0)
+        with open(self.get_tmp_path('results.jsonl'), 'r') as f:
+            results = [json.loads(line) for line in f]
+        self.assertEqual(len(results), 5)
+        self.assertTrue(all(result['ok'] for result in results))
+        self.assertEqual(server.request_counts[('POST', '/artifacts')], 5)
+        for index in range(5):
+            self.assertTrue(os.path.exists(self.get_tmp_path('{}.obj'.format(index))))
+
+
+class TestPipeline(ScratchDirMixin, unittest.TestCase):
+
+    def test_nodes_start_when_their_inputs_are_ready(self):
+        from bodylabs_api.exceptions import DependencyFailed
+        from bodylabs_api.mock_server import MockApiServer
+        from bodylabs_api.pipeline import Pipeline
+
+        with open(self.get_tmp_path('scan.ply'), 'w') as f:
+            f.write('scan')
+        with MockApiServer(processing_delay=0.05) as server:
+            local_client = Client(server.base_uri, 'access_key', 'secret', verbose=False)
+            pipeline = Pipeline(local_client, polling_interval=0.01)
+            scan = pipeline.file('scan', self.get_tmp_path('scan.ply'))
+            alignment = pipeline.artifact(
+                'alignment', {'serviceType': 'FootAlignment'}, {'scan': scan},
+                output_path=self.get_tmp_path('alignment.obj'))
+            measurements = pipeline.artifact('measurements', {'serviceType': 'Measurement'}, {'alignment': alignment})
+            missing = pipeline.file('missing', self.get_tmp_path('missing.ply'))
+            orphan = pipeline.artifact('orphan', {'serviceType': 'FootAlignment'}, {'scan': scan, 'other': missing})
+            never = pipeline.artifact('never', {'serviceType': 'Measurement'}, {'orphan': orphan})
+
+            results = {result.node.name: result for result in pipeline.run()}
+            local_client.close()
+
+        self.assertEqual(set(results), set(['scan', 'alignment', 'measurements', 'missing', 'orphan', 'never']))
+        for name in ('scan', 'alignment', 'measurements'):
+            self.assertIsNone(results[name].error)
+        self.assertIsInstance(results['missing'].error, IOError)
+        self.assertIsInstance(results['orphan'].error, DependencyFailed)
+        self.assertIsInstance(results['never'].error, DependencyFailed)
+        self.assertIsNone(orphan.model)
+        self.assertEqual(server.request_counts[('POST', '/artifacts')], 2)
+
+        self.assertEqual(alignment.model.dependencies, {'scan': {'fileId': scan.model.file_id}})
+        self.assertEqual(measurements.model.dependencies, {'alignment': {'artifactId': alignment.model.artifact_id}})
+        self.assertGreaterEqual(measurements.started_at, alignment.ready_at)
+        self.assertTrue(os.path.exists(self.get_tmp_path('alignment.obj')))
+        with self.assertRaises(ValueError):
+            Pipeline(client).artifact('stray', {}, {'scan': never})
+
+
+class TestAsyncClient(MockApiTestCase):
+    server_options = {'processing_delay': 0.2, 'components': {'Mocap': ['outputOne']}}
+
+    def make_client(self):
+        from bodylabs_api.async_client import AsyncClient
+        return AsyncClient(self.server.base_uri, 'access_key', 'secret', verbose=False, max_workers=4)
+
+    def test_many_artifacts_share_few_workers(self):
+        futures = [
+            Artifact({'serviceType': 'FootAlignment'}, self.client).create_async()
+            for _ in range(20)
+        ]
+        artifacts = [future.result(timeout=5) for future in futures]
+        downloads = [
+            artifact.download_async(
+                self.get_tmp_path(artifact.artifact_id), polling_interval=0.05, timeout=5)
+            for artifact in artifacts
+        ]
+
+        for future in downloads:
+            artifact = future.result(timeout=5)
+            self.assertEqual(artifact.status, 'ready')
+            with open(artifact.download_path, 'r') as open_file:
+                self.assertEqual(open_file.read(), 'contents of {}'.format(artifact.artifact_id))
+
+    def test_download_component_async(self):
+        artifact = MultiComponentArtifact({'serviceType': 'Mocap'}, self.client).create_async().result()
+        download_path = self.get_tmp_path('outputOne')
+
+        artifact.download_component_async('outputOne', download_path, polling_interval=0.05).result(timeout=5)
+        self.assertEqual(artifact.downloaded_components['outputOne'], download_path)
+
+        with self.assertRaises(ValueError):
+            artifact.download_component_async('outputTwo', download_path).result(timeout=5)
+
+    def test_from_local_path_async(self):
+        local_path = self.get_tmp_path('scan.ply')
+        with open(local_path, 'w') as open_file:
+            open_file.write('this is a file')
+
+        f = File.from_local_path_async(local_path, self.client).result(timeout=5)
+        self.assertEqual(f.status, 'ready')
+        self.assertEqual(self.server.objects[f.file_id], 'this is a file')
+        self.assertTrue(self.client.verify_account_async().result(timeout=5))
+
+    def test_async_methods_require_async_client(self):
+        with self.assertRaises(TypeError):
+            Artifact({}, client).create_async()
+
+
+class TestPoller(MockApiTestCase):
+    server_options = {'processing_delay': 0.2}
+
+    def _poll_artifacts(self, **poller_kwargs):
+        from bodylabs_api.poller import Poller
+        artifacts = [Artifact({'serviceType': 'FootAlignment'}, self.client).create() for _ in range(10)]
+        with Poller(self.client, interval=0.05, **poller_kwargs) as poller:
+            futures = [poller.register(artifact) for artifact in artifacts]
+            for future in futures:
+                self.assertEqual(future.result(timeout=5).status, 'ready')
+        return poller, artifacts
+
+    def test_poller_refreshes_individually(self):
+        poller, artifacts = self._poll_artifacts(max_workers=4)
+        polls = sum(artifact.poll_count for artifact in artifacts)
+        self.assertEqual(self.server.request_counts[('GET', '/artifacts/{id}')], polls)
+        self.assertEqual(poller.request_count, polls)
+
+    def test_poller_uses_bulk_endpoint(self):
+        poller, _ = self._poll_artifacts(bulk_uri='{base_uri}/query', bulk_size=4)
+        self.assertNotIn(('GET', '/artifacts/{id}'), self.server.request_counts)
+        # At most 10 artifacts per tick, in chunks of 4
+        self.assertLessEqual(self.server.request_counts[('GET', '/artifacts/query')], 3 * poller.tick_count)
+        self.assertEqual(poller.request_count, self.server.request_counts[('GET', '/artifacts/query')])
+
+    def test_poller_reports_failures(self):
+        from bodylabs_api.poller import Poller
+        artifact = Artifact({'artifactId': 'missing'}, self.client)
+        with Poller(self.client, interval=0.01) as poller:
+            with self.assertRaises(HttpError):
+                poller.register(artifact).result(timeout=5)
+        self.assertEqual(artifact.poll_count, 0)
+
+    def test_stopping_cancels_pending_futures(self):
+        from concurrent.futures import CancelledError
+        from bodylabs_api.poller import Poller
+        artifact = Artifact({'serviceType': 'FootAlignment'}, self.client).create()
+        with Poller(self.client, interval=60) as poller:
+            future = poller.register(artifact)
+        with self.assertRaises(CancelledError):
+            future.result(timeout=5)
+
+    def test_unexpected_errors_fail_the_futures(self):
+        from bodylabs_api.poller import Poller
+        artifact = Artifact({'serviceType': 'FootAlignment'}, self.client).create()
+        with Poller(self.client, interval=0.01) as poller, mock.patch('logging.Logger.exception'):
+            with mock.patch.object(poller, '_refresh', side_effect=RuntimeError('boom')):
+                with self.assertRaises(RuntimeError):
+                    poller.register(artifact).result(timeout=5)
+
+
+class TestArtifactSet(unittest.TestCase):
+
+    def test_filter_count_and_update(self):
+        from bodylabs_api.artifact_set import ArtifactSet
+        artifacts = ArtifactSet(client, [
+            {'artifactId': 'a', 'status': 'pending', 'serviceType': 'FootAlignment'},
+            {'artifactId': 'b', 'status': 'ready', 'serviceType': 'FootAlignment'},
+            {'artifactId': 'c', 'status': 'pending', 'serviceType': 'Measurement'},
+        ])
+        self.assertEqual(artifacts.ids(status='pending'), ['a', 'c'])
+        self.assertEqual(artifacts.ids(status=('pending', 'ready'), service_type='FootAlignment'), ['a', 'b'])
+        self.assertEqual(artifacts.ids(status='unknown'), [])
+        self.assertEqual(artifacts.counts(), {'pending': 2, 'ready': 1})
+
+        changed = artifacts.update([
+            {'artifactId': 'a', 'status': 'ready', 'serviceType': 'FootAlignment'},
+            {'artifactId': 'c', 'status': 'pending', 'serviceType': 'Measurement', 'progress': 50},
+        ])
+        self.assertEqual(changed, ['a'])
+        self.assertEqual(artifacts.raw_json('c')['progress'], 50)
+
+        artifacts.discard('a')
+        self.assertNotIn('a', artifacts)
+        self.assertEqual(artifacts.ids(), ['c', 'b'])
+        artifact = artifacts.artifact('b')
+        self.assertIsInstance(artifact, Artifact)
+        self.assertEqual(artifact.status, 'ready')
+
+    def test_refresh_only_pending(self):
+        from bodylabs_api.artifact_set import ArtifactSet
+        from bodylabs_api.mock_server import MockApiServer
+        with MockApiServer(processing_delay=0.05) as server:
+            local_client = Client(server.base_uri, 'access_key', 'secret', verbose=False)
+            created = [Artifact({'serviceType': 'FootAlignment'}, local_client).create() for _ in range(5)]
+            artifacts = ArtifactSet(local_client, [artifact.raw_json for artifact in created])
+            while artifacts.ids(status='pending'):
+                artifacts.refresh(bulk_uri='{base_uri}/query', bulk_size=2)
+            self.assertEqual(artifacts.counts(), {'ready': 5})
+            requests = dict(server.request_counts)
+            self.assertEqual(artifacts.refresh(), [])
+            local_client.close()
+        self.assertEqual(server.request_counts, requests)
+        self.assertNotIn(('GET', '/artifacts/{id}'), requests)
+
+
+class TestListing(unittest.TestCase):
+
+    def test_list_query(self):
+        import datetime
+        from bodylabs_api.listing import list_query
+        self.assertEqual(list_query({
+            'status': ('processing', 'pending'),
+            'service_type': 'FootAlignment',
+            'created_after': datetime.datetime(2016, 5, 1, 12),
+            'created_before': None,
+        }), {
+            'status': 'pending,processing',
+            'serviceType': 'FootAlignment',
+            'createdAfter': '2016-05-01T12:00:00.000000Z',
+        })
+
+    def test_list_pages_lazily_with_filters(self):
+        from bodylabs_api.mock_server import MockApiServer
+        with MockApiServer() as server:
+            local_client = Client(server.base_uri, 'access_key', 'secret', verbose=False)
+            created = [
+                Artifact({'serviceType': 'FootAlignment' if index % 2 else 'Measurement'}, local_client).create()
+                for index in range(7)
+            ]
+            listed = Artifact.list(local_client, page_size=2, service_type='FootAlignment')
+            first = next(listed)
+            self.assertIsInstance(first, Artifact)
+            # The first page, and perhaps already the prefetched second
+            self.assertLessEqual(server.request_counts[('GET', '/artifacts')], 2)
+            ids = [first.artifact_id] + [artifact.artifact_id for artifact in listed]
+            self.assertEqual(ids, [artifact.artifact_id for artifact in created[1::2]])
+            self.assertEqual(server.request_counts[('GET', '/artifacts')], 2)
+
+            ids = [artifact.artifact_id for artifact in Artifact.list(
+                local_client, page_size=3, prefetch=False, created_after=created[4].raw_json['createdAt'])]
+            self.assertEqual(ids, [artifact.artifact_id for artifact in created[5:]])
+            self.assertEqual(list(File.list(local_client)), [])
+            local_client.close()
+
+
+class TestMockServer(unittest.TestCase):
+
+    def test_injected_failures_are_not_served(self):
+        from bodylabs_api.mock_server import MockApiServer
+        from bodylabs_api.retry import RetryPolicy
+        with MockApiServer(latency=0.01) as server:
+            local_client = Client(server.base_uri, 'access_key', 'secret', verbose=False,
+                                  retry_policy=RetryPolicy(initial=0))
+            artifact = Artifact({'serviceType': 'FootAlignment'}, local_client).create()
+            server.fail_requests('GET', '/artifacts/{id}', times=2)
+            self.assertEqual(artifact.refresh().status, 'ready')
+            local_client.close()
+        # Injected failures aren't served, so aren't counted
+        self.assertEqual(server.request_counts[('GET', '/artifacts/{id}')], 1)
+
+
+class TestDownload(MockApiTestCase):
+    server_options = {'download_size': 3 * 1024 * 1024}
+
+    def setUp(self):
+        super(TestDownload, self).setUp()
+        self.artifact = Artifact({'serviceType': 'FootAlignment'}, self.client).create()
+        self.expected = self.server.artifact_contents(self.artifact.artifact_id)
+
+    def _read(self, path):
+        with open(path, 'rb') as open_file:
+            return open_file.read()
+
+    def test_parallel_ranges(self):
+        from bodylabs_api import transfer
+        download_path = self.get_tmp_path('ranges.obj')
+        with mock.patch.object(transfer, 'MIN_RANGE_SIZE', 512 * 1024):
+            self.client.download(self.artifact.download_uri, download_path, ranges=4)
+
+        self.assertEqual(self._read(download_path), self.expected)
+        self.assertEqual(self.server.request_counts[('DOWNLOAD', '206')], 4)
+        self.assertEqual(os.listdir(self.get_tmp_path('')), ['ranges.obj'])
+
+    def test_dropped_connection_is_resumed(self):
+        download_path = self.get_tmp_path('resumed.obj')
+        self.server.truncate_downloads = 1
+        self.client.download(self.artifact.download_uri, download_path)
+
+        self.assertEqual(self._read(download_path), self.expected)
+        self.assertEqual(self.server.request_counts[('DOWNLOAD', '200')], 1)
+        self.assertEqual(self.server.request_counts[('DOWNLOAD', '206')], 1)
+
+    def test_interrupted_download_resumes_from_part_file(self):
+        import requests
+        download_path = self.get_tmp_path('interrupted.obj')
+        self.server.truncate_downloads = 1
+        with self.assertRaises(requests.exceptions.ChunkedEncodingError):
+            self.client.download(self.artifact.download_uri, download_path, max_resumes=0)
+        self.assertFalse(os.path.exists(download_path))
+        self.assertEqual(os.path.getsize(download_path + '.part'), len(self.expected) // 2)
+
+        self.client.download(self.artifact.download_uri, download_path)
+        self.assertEqual(self._read(download_path), self.expected)
+        self.assertEqual(self.server.request_counts[('DOWNLOAD', '206')], 1)
+
+    def test_complete_part_file_is_finished_without_requests(self):
+        import json
+        download_path = self.get_tmp_path('complete.obj')
+        with open(download_path + '.part', 'wb') as open_file:
+            open_file.write(self.expected)
+        with open(download_path + '.part.json', 'w') as open_file:
+            json.dump({'etag': '"stale"', 'md5': None, 'size': len(self.expected)}, open_file)
+
+        # A Range request from the end would get a 416
+        self.client.download(self.artifact.download_uri, download_path)
+        self.assertEqual(self._read(download_path), self.expected)
+        self.assertNotIn(('GET', '/artifacts/{id}/download'), self.server.request_counts)
+        self.assertEqual(os.listdir(self.get_tmp_path('')), ['complete.obj'])
+
+    def test_part_file_of_unknown_size_is_finished_or_restarted(self):
+        import json
+        download_path = self.get_tmp_path('unknown.obj')
+        for contents in (self.expected, self.expected + 'stale'):
+            with open(download_path + '.part', 'wb') as open_file:
+                open_file.write(contents)
+            with open(download_path + '.part.json', 'w') as open_file:
+                json.dump({'etag': None, 'md5': None, 'size': None}, open_file)
+            # The Range request from the end of the part file gets a 416
+            self.client.download(self.artifact.download_uri, download_path)
+            self.assertEqual(self._read(download_path), self.expected)
+        self.assertEqual(self.server.request_counts[('DOWNLOAD', '416')], 2)
+        self.assertEqual(self.server.request_counts[('DOWNLOAD', '200')], 1) # only the stale one restarted
+        self.assertEqual(os.listdir(self.get_tmp_path('')), ['unknown.obj'])
+
+    def test_failed_resume_is_not_written(self):
+        import requests
+        from bodylabs_api.client import expect_status
+        from bodylabs_api.transfer import Download
+
+        class DroppedResponse(MockResponse):
+            def iter_content(self, _):
+                yield 'fake '
+                raise requests.exceptions.ConnectionError('dropped')
+
+        responses = [
+            DroppedResponse(200, {}, headers={'ETag': '"abc"', 'Content-Length': '13'}),
+            MockResponse(412, {'message': 'Precondition Failed'}),
+        ]
+        download_path = self.get_tmp_path('failed.obj')
+        download = Download(lambda _: responses.pop(0), download_path)
+        with self.assertRaises(HttpError):
+            download.run(lambda resp: expect_status(resp, 200))
+        self.assertEqual(self._read(download_path + '.part'), 'fake ')
+
+    def test_in_memory_targets(self):
+        import io
+        self.assertEqual(self.artifact.download_bytes(polling_interval=0), self.expected)
+
+        sink = io.BytesIO()
+        self.artifact.download_to(sink, blocking=False)
+        self.assertEqual(sink.getvalue(), self.expected)
+
+        buf = bytearray(len(self.expected) + 10)
+        self.artifact.download_to(memoryview(buf)[5:], blocking=False)
+        self.assertEqual(buf[5:-5], self.expected)
+
+        with self.assertRaises(ValueError):
+            self.artifact.download_to(bytearray(10), blocking=False)
+        with self.assertRaises(TypeError):
+            self.artifact.download_to(self.expected, blocking=False)
+
+    def test_abandoned_stream_releases_connection(self):
+        stream = self.client.stream_download(self.artifact.download_uri)
+        with mock.patch.object(stream.response, 'close', wraps=stream.response.close) as close:
+            with self.assertRaises(ValueError):
+                stream.write_into(bytearray(10))
+        self.assertTrue(close.called)
+
+        with self.client.stream_download(self.artifact.download_uri) as stream:
+            with mock.patch.object(stream.response, 'close', wraps=stream.response.close) as close:
+                next(iter(stream))
+        self.assertTrue(close.called)
+
+    def test_iter_download_resumes(self):
+        self.server.truncate_downloads = 1
+        stream = self.artifact.iter_download(blocking=False, chunk_size=64 * 1024)
+
+        self.assertEqual(stream.size, len(self.expected))
+        self.assertEqual(''.join(stream), self.expected)
+        self.assertEqual(self.server.request_counts[('DOWNLOAD', '206')], 1)
+
+    @mock.patch('requests.Session.get')
+    def test_corrupt_download_is_rejected(self, mock_get):
+        import base64
+        import hashlib
+        from bodylabs_api.exceptions import DownloadVerificationFailed
+        mock_get.return_value = MockResponse(200, {}, headers={
+            'Content-Length': '13',
+            'Content-MD5': base64.b64encode(hashlib.md5('other contents').digest()),
+        })
+        download_path = self.get_tmp_path('corrupt.obj')
+
+        with self.assertRaises(DownloadVerificationFailed):
+            client.download('/artifacts/123abc/download', download_path)
+        self.assertEqual(os.listdir(self.get_tmp_path('')), [])
+
+
+class TestCompression(MockApiTestCase):
+    server_options = {'compress_downloads': True}
+
+    def setUp(self):
+        super(TestCompression, self).setUp()
+        self.contents = ''.join('v {} {} {}\n'.format(i * 0.5, i * 0.25, -i) for i in range(50000))
+        self.path = self.get_tmp_path('scan.obj')
+        with open(self.path, 'wb') as open_file:
+            open_file.write(self.contents)
+
+    def make_client(self):
+        return Client(
+            self.server.base_uri, 'access_key', 'secret', verbose=False, accept_encoding=('zstd', 'gzip'))
+
+    def test_compressed_upload(self):
+        from bodylabs_api.instrumentation import MetricsCollector
+        metrics = MetricsCollector()
+        self.client.hooks.append(metrics)
+        uploaded = File.from_local_path(self.path, self.client, compression='gzip')
+
+        self.assertEqual(self.server.encodings[uploaded.file_id], 'gzip')
+        self.assertEqual(self.server.objects[uploaded.file_id], self.contents)
+        bytes_sent = sum(endpoint.bytes_sent for endpoint in metrics.snapshot().values())
+        self.assertLess(bytes_sent, len(self.contents) / 2)
+
+    def test_zstd_needs_zstandard(self):
+        from bodylabs_api import compression
+        with mock.patch.object(compression, '_zstandard', return_value=None):
+            self.assertEqual(compression.accept_encoding(('zstd', 'gzip')), 'gzip')
+            with self.assertRaises(ValueError):
+                File.from_local_path(self.path, self.client, compression='zstd')
+
+    def test_encoded_download_is_resumed_and_decoded(self):
+        uploaded = File.from_local_path(self.path, self.client)
+        download_path = self.get_tmp_path('download.obj')
+        self.server.truncate_downloads = 2
+        self.client.download(uploaded.download_uri, download_path)
+        stream = self.client.stream_download(uploaded.download_uri)
+
+        self.assertIn(stream.encoding, ('zstd', 'gzip'))
+        self.assertIsNone(stream.size)
+        self.assertEqual(str(stream.read_all()), self.contents)
+        with open(download_path, 'rb') as open_file:
+            self.assertEqual(open_file.read(), self.contents)
+        self.assertEqual(sorted(os.listdir(self.get_tmp_path(''))), ['download.obj', 'scan.obj'])
+        self.assertEqual(self.server.request_counts[('DOWNLOAD', '206')], 2)
+
+
+class TestClient(unittest.TestCase):
+
+    def test_client_pools_api_and_storage_separately(self):
+        pooled_client = Client('http://base_uri', 'access_key', 'secret', verbose=False,
+                               pool_maxsize=7, storage_pool_maxsize=3)
+        api_adapter = pooled_client.session.get_adapter('http://base_uri/files')
+        storage_adapter = pooled_client.storage_session.get_adapter('https://signed_upload_url')
+
+        self.assertIsNot(pooled_client.session, pooled_client.storage_session)
+        self.assertEqual(api_adapter._pool_maxsize, 7) # pylint: disable=protected-access
+        self.assertEqual(storage_adapter._pool_maxsize, 3) # pylint: disable=protected-access
+
+    def test_client_reuses_session(self):
+        import requests
+        from bodylabs_api.mock_server import MockApiServer
+        sessions = []
+        send = requests.Session.request
+
+        def request(session, *args, **kwargs):
+            sessions.append(session)
+            return send(session, *args, **kwargs)
+
+        with MockApiServer() as server, mock.patch('requests.Session.request', request):
+            local_client = Client(server.base_uri, 'access_key', 'secret', verbose=False)
+            artifact = Artifact({'serviceType': 'FootAlignment'}, local_client).create()
+            artifact.refresh()
+            local_client.close()
+        self.assertEqual(len(sessions), 2)
+        self.assertIs(sessions[0], sessions[1])
+
+
+class TestRetry(unittest.TestCase):
+
+    def setUp(self):
+        from bodylabs_api.retry import RetryPolicy, CircuitBreakers
+        self.breakers = CircuitBreakers(failure_threshold=4, reset_timeout=60)
+        self.client = Client('http://base_uri', 'access_key', 'secret', verbose=False,
+                             retry_policy=RetryPolicy(initial=0), circuit_breakers=self.breakers)
+
+    @mock.patch('requests.Session.get')
+    def test_get_is_retried_honoring_retry_after(self, mock_get):
+        import requests
+        unavailable = MockResponse(503, {}, headers={'Retry-After': '0'})
+        mock_get.side_effect = [
+            requests.exceptions.ConnectionError('reset'),
+            unavailable,
+            MockResponse(200, {'fileId': '123abc'}),
+        ]
+        self.assertEqual(self.client.get('/files/123abc'), {'fileId': '123abc'})
+        self.assertEqual(mock_get.call_count, 3)
+        self.assertFalse(self.breakers.for_url('http://base_uri/').is_open)
+        # Released before retrying, rather than holding its connection
+        self.assertTrue(unavailable.closed)
+
+    def test_clients_have_their_own_circuit_breakers(self):
+        first = Client('http://base_uri', 'access_key', 'secret', verbose=False)
+        second = Client('http://base_uri', 'access_key', 'secret', verbose=False)
+        self.assertIsNot(first.circuit_breakers, second.circuit_breakers)
+
+    @mock.patch('requests.Session.post')
+    def test_post_is_only_retried_with_idempotency_key(self, mock_post):
+        mock_post.side_effect = [MockResponse(502, {}), MockResponse(502, {}), MockResponse(202, {'fileId': 'a'})]
+        with self.assertRaises(HttpError):
+            File({}, self.client).create()
+        self.assertEqual(mock_post.call_count, 1)
+
+        f = File({}, self.client).create(idempotency_key='key')
+        self.assertEqual(f.file_id, 'a')
+        self.assertEqual(mock_post.call_count, 3)
+        self.assertEqual(mock_post.call_args[1]['headers']['Idempotency-Key'], 'key')
+
+    @mock.patch('requests.Session.get')
+    def test_circuit_opens_after_consecutive_failures(self, mock_get):
+        from bodylabs_api.exceptions import CircuitOpen
+        mock_get.return_value = MockResponse(500, {})
+        with self.assertRaises(HttpError):
+            self.client.get('/files/123abc') # four failed attempts
+
+        with self.assertRaises(CircuitOpen):
+            self.client.get('/files/123abc')
+        self.assertEqual(mock_get.call_count, 4)
+
+        # After reset_timeout, a trial request is let through and closes it
+        self.breakers.for_url('http://base_uri/').opened_at -= 60
+        mock_get.return_value = MockResponse(200, {'fileId': '123abc'})
+        self.client.get('/files/123abc')
+        self.assertFalse(self.breakers.for_url('http://base_uri/').is_open)
+
+
+class TestRateLimit(ScratchDirMixin, unittest.TestCase):
+
+    def test_token_bucket_spaces_requests(self):
+        import time
+        from bodylabs_api.ratelimit import RateLimit
+        limit = RateLimit(rate=20, burst=2)
+        started_at = time.time()
+        for _ in range(6):
+            limit.wait()
+        # Two from the burst, then one every 50 ms
+        self.assertGreaterEqual(time.time() - started_at, 0.19)
+
+    def test_limits_are_shared_through_path(self):
+        import threading
+        import time
+        from bodylabs_api.ratelimit import RateLimit
+        path = self.get_tmp_path('limit')
+        # As if in two processes
+        limits = [RateLimit(rate=20, burst=1, max_inflight=1, path=path) for _ in range(2)]
+
+        started_at = time.time()
+        for limit in limits * 3:
+            limit.wait()
+        self.assertGreaterEqual(time.time() - started_at, 0.24)
+
+        acquired = threading.Event()
+        def take_slot():
+            with limits[1].inflight():
+                acquired.set()
+        with limits[0].inflight():
+            thread = threading.Thread(target=take_slot)
+            thread.start()
+            self.assertFalse(acquired.wait(0.1))
+        self.assertTrue(acquired.wait(1))
+        thread.join()
+
+    @mock.patch('requests.Session.get')
+    def test_client_caps_requests_in_flight(self, mock_get):
+        import threading
+        import time
+        from concurrent.futures import ThreadPoolExecutor
+        from bodylabs_api.ratelimit import RateLimit
+
+        in_flight = [0, 0] # current, peak
+        lock = threading.Lock()
+        def slow_get(*args, **kwargs):
+            with lock:
+                in_flight[0] += 1
+                in_flight[1] = max(in_flight)
+            time.sleep(0.02)
+            with lock:
+                in_flight[0] -= 1
+            return MockResponse(200, {'fileId': '123abc'})
+        mock_get.side_effect = slow_get
+
+        limited_client = Client('http://base_uri', 'access_key', 'secret', verbose=False,
+                                rate_limits={'metadata': RateLimit(max_inflight=2)})
+        with ThreadPoolExecutor(max_workers=6) as executor:
+            list(executor.map(lambda _: limited_client.get('/files/123abc'), range(12)))
+        self.assertEqual(in_flight[1], 2)
+
+
+class TestInstrumentation(ScratchDirMixin, unittest.TestCase):
+
+    def test_metrics_collector(self):
+        from bodylabs_api.instrumentation import MetricsCollector
+        from bodylabs_api.mock_server import MockApiServer
+        metrics = MetricsCollector()
+        with MockApiServer() as server:
+            with Client(server.base_uri, 'access_key', 'secret', verbose=False, hooks=[metrics]) as local_client:
+                artifact = Artifact({'serviceType': 'FootAlignment'}, local_client).create()
+                artifact.download(self.get_tmp_path('output.obj'), polling_interval=0)
+
+        snapshot = metrics.snapshot()
+        self.assertEqual(snapshot[('POST', '/artifacts')].count, 1)
+        self.assertGreater(snapshot[('POST', '/artifacts')].bytes_sent, 0)
+        self.assertEqual(snapshot[('GET', '/artifacts/{id}')].errors, 0)
+        download = snapshot[('DOWNLOAD', '/artifacts/{id}/download')]
+        self.assertEqual(download.bytes_received, len('contents of {}'.format(artifact.artifact_id)))
+        self.assertEqual(sum(download.latency_histogram), 1)
+        self.assertGreater(metrics.percentile('DOWNLOAD', '/artifacts/{id}/download', 0.5), 0)
+
+    @mock.patch('requests.Session.get')
+    def test_verbose_prints_through_hook(self, mock_get):
+        import sys
+        from StringIO import StringIO
+        from bodylabs_api.instrumentation import PrintHook
+        from bodylabs_api.retry import RetryPolicy
+        ready = MockResponse(200, {'status': 'ready'})
+        mock_get.side_effect = [ready, MockResponse(503, {}), ready]
+        self.assertEqual(Client('http://base_uri', 'access_key', 'secret').hooks, [])
+
+        verbose_client = Client(
+            'http://base_uri', 'access_key', 'secret', verbose=True, retry_policy=RetryPolicy(initial=0))
+        self.assertIsInstance(verbose_client.hooks[0], PrintHook)
+        with mock.patch.object(sys, 'stdout', StringIO()) as stdout:
+            verbose_client.get('/artifacts/123abc')
+            verbose_client.get('/artifacts/123abc', verbose=False) # retried, quietly
+        self.assertEqual(stdout.getvalue(), "GET /artifacts/123abc\nGot 200 {'status': 'ready'}\n\n")
+
+    @mock.patch('requests.Session.get')
+    def test_hooks_see_retries_and_errors(self, mock_get):
+        import logging
+        from bodylabs_api.instrumentation import Hook, LoggingHook
+        from bodylabs_api.retry import RetryPolicy, CircuitBreakers
+
+        calls = []
+        class Recorder(Hook):
+            def before_request(self, event):
+                calls.append(('before', event.action, event.template))
+            def after_response(self, event):
+                calls.append(('after', event.status, event.retries, type(event.error)))
+
+        records = []
+        logger = logging.getLogger('bodylabs_api.tests.instrumentation')
+        handler = logging.Handler()
+        handler.emit = records.append
+        logger.addHandler(handler)
+        logger.propagate = False
+
+        mock_get.side_effect = [MockResponse(503, {}), MockResponse(404, {'code': 'NOT_FOUND_RESOURCE'})]
+        hooked_client = Client(
+            'http://base_uri', 'access_key', 'secret', verbose=False,
+            retry_policy=RetryPolicy(initial=0), circuit_breakers=CircuitBreakers(),
+            hooks=[Recorder(), LoggingHook(logger)])
+        with self.assertRaises(HttpError):
+            hooked_client.get('/artifacts/123abc')
+
+        self.assertEqual(calls, [('before', 'GET', '/artifacts/{id}'), ('after', 404, 1, HttpError)])
+        self.assertEqual(len(records), 1)
+        self.assertEqual(records[0].levelno, logging.WARNING)
+        self.assertEqual(records[0].request['retries'], 1)
+
+
+class TestTimeline(ScratchDirMixin, unittest.TestCase):
+
+    def test_lifecycle_phases_spans_and_report(self):
+        import json
+        from bodylabs_api.mock_server import MockApiServer
+        from bodylabs_api.timeline import TimelineReport
+
+        local_path = self.get_tmp_path('scan.ply')
+        with open(local_path, 'w') as open_file:
+            open_file.write('this is a file')
+
+        with MockApiServer(processing_delay=0.1) as server:
+            with Client(server.base_uri, 'access_key', 'secret', verbose=False) as local_client:
+                f = File.from_local_path(local_path, local_client)
+                artifact = Artifact({'serviceType': 'FootAlignment', 'serviceVersion': 'v1'}, local_client)
+                artifact.create().download(self.get_tmp_path('output.obj'), polling_interval=0.02)
+
+        self.assertEqual([phase.name for phase in f.timeline.phases], ['create', 'pending', 'upload', 'finalize'])
+        self.assertEqual(
+            [phase.name for phase in artifact.timeline.phases], ['create', 'pending', 'wait', 'download'])
+        wait = artifact.timeline.phases[2]
+        self.assertEqual(wait.attributes['polls'], artifact.poll_count)
+        durations = artifact.timeline.durations()
+        self.assertGreaterEqual(durations['pending'], 0.05)
+        self.assertEqual(durations['backend'], durations['pending'])
+        json.dumps(artifact.timeline.as_dict())
+
+        spans = artifact.timeline.to_spans('artifact', {'artifactId': artifact.artifact_id})
+        self.assertEqual(len(spans), 5)
+        self.assertEqual(len(set(span['traceId'] for span in spans)), 1)
+        self.assertTrue(all(span['parentSpanId'] == spans[0]['spanId'] for span in spans[1:]))
+        self.assertEqual(spans[0]['attributes']['status'], 'ready')
+
+        report = TimelineReport()
+        report.add(artifact)
+        report.add(artifact)
+        summary = report.summary()['FootAlignment/v1']
+        self.assertEqual(summary['download']['count'], 2)
+        self.assertEqual(summary['pending']['max'], durations['pending'])
+
 if __name__ == '__main__':
     unittest.main()
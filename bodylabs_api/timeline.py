@@ -0,0 +1,217 @@
+'''
+Where the wall-clock time of each File and Artifact goes.
+
+Every model keeps a Timeline of phases. Client-side phases are recorded as
+they run: create, upload, finalize, wait (refresh_until_ready, with its poll
+count) and download. Backend phases are named after the statuses the model
+was seen in, e.g. pending (queued) or processing, and span from the refresh
+that first saw a status to the one that saw the next, so they are only as
+precise as the polling interval.
+
+Timelines export as JSON-ready dicts or as OpenTelemetry-style spans, and a
+TimelineReport aggregates many of them by (serviceType, serviceVersion).
+'''
+import threading
+import time
+from contextlib import contextmanager
+
+# Statuses after which the backend has nothing left to do
+TERMINAL_STATUSES = ('ready', 'failed')
+# Phases the client spends its own time in; the rest belong to the backend
+CLIENT_PHASES = ('create', 'upload', 'finalize', 'download')
+
+
+class Phase(object):
+    __slots__ = ['name', 'started_at', 'ended_at', 'attributes']
+
+    def __init__(self, name, started_at, ended_at=None, attributes=None):
+        self.name = name
+        self.started_at = started_at
+        self.ended_at = ended_at
+        self.attributes = attributes or {}
+
+    @property
+    def duration(self):
+        return None if self.ended_at is None else self.ended_at - self.started_at
+
+    def end(self, error=None):
+        if error is not None:
+            self.attributes['error'] = repr(error)
+        self.ended_at = time.time()
+
+    def as_dict(self):
+        return {
+            'name': self.name,
+            'startedAt': self.started_at,
+            'endedAt': self.ended_at,
+            'duration': self.duration,
+            'attributes': self.attributes,
+        }
+
+    def __repr__(self):
+        return '<Phase {} {}>'.format(self.name, self.duration)
+
+
+class Timeline(object):
+    '''
+    Phases of one model, in the order they started
+    '''
+    __slots__ = ['phases', 'status', '_status_phase', '_lock']
+
+    def __init__(self):
+        self.phases = []
+        self.status = None
+        self._status_phase = None
+        self._lock = threading.Lock()
+
+    def begin(self, name, **attributes):
+        '''
+        Start a phase, returning the Phase to end() once it's over
+        '''
+        phase = Phase(name, time.time(), attributes=attributes)
+        with self._lock:
+            self.phases.append(phase)
+        return phase
+
+    @contextmanager
+    def phase(self, name, **attributes):
+        '''
+        Record the enclosed block as a phase; attributes may be added to the
+        yielded Phase while it runs. A failing block's phase gets an error
+        attribute.
+        '''
+        phase = self.begin(name, **attributes)
+        try:
+            yield phase
+        except Exception as e:
+            phase.end(error=e)
+            raise
+        phase.end()
+
+    def observe_status(self, status):
+        '''
+        Note that the model was just seen with status
+        '''
+        if status is None or status == self.status:
+            return
+        now = time.time()
+        with self._lock:
+            if self._status_phase is not None:
+                self._status_phase.ended_at = now
+                self._status_phase = None
+            if status not in TERMINAL_STATUSES:
+                self._status_phase = Phase(status, now, attributes={'backend': True})
+                self.phases.append(self._status_phase)
+            self.status = status
+
+    @property
+    def started_at(self):
+        return self.phases[0].started_at if self.phases else None
+
+    @property
+    def ended_at(self):
+        ended = [phase.ended_at for phase in self.phases if phase.ended_at is not None]
+        return max(ended) if ended else None
+
+    def durations(self):
+        '''
+        Dict of phase name to total seconds spent in finished phases by that
+        name, plus 'backend' and 'client' totals
+        '''
+        totals = {}
+        for phase in list(self.phases):
+            if phase.duration is not None:
+                totals[phase.name] = totals.get(phase.name, 0.0) + phase.duration
+                if phase.attributes.get('backend'):
+                    totals['backend'] = totals.get('backend', 0.0) + phase.duration
+                elif phase.name in CLIENT_PHASES:
+                    totals['client'] = totals.get('client', 0.0) + phase.duration
+        return totals
+
+    def as_dict(self):
+        return {
+            'startedAt': self.started_at,
+            'endedAt': self.ended_at,
+            'status': self.status,
+            'phases': [phase.as_dict() for phase in list(self.phases)],
+        }
+
+    def to_spans(self, name, attributes=None, trace_id=None):
+        '''
+        OpenTelemetry-style span dicts: a root span called name covering the
+        whole timeline, with a child for each phase. trace_id (32 hex
+        digits) defaults to a new random one.
+        '''
+        import os
+
+        def span_id():
+            return os.urandom(8).encode('hex')
+
+        def nanos(seconds):
+            return None if seconds is None else int(seconds * 1e9)
+
+        trace_id = trace_id or os.urandom(16).encode('hex')
+        root = {
+            'traceId': trace_id,
+            'spanId': span_id(),
+            'parentSpanId': None,
+            'name': name,
+            'startTimeUnixNano': nanos(self.started_at),
+            'endTimeUnixNano': nanos(self.ended_at),
+            'attributes': dict(attributes or {}, status=self.status),
+        }
+        return [root] + [
+            {
+                'traceId': trace_id,
+                'spanId': span_id(),
+                'parentSpanId': root['spanId'],
+                'name': phase.name,
+                'startTimeUnixNano': nanos(phase.started_at),
+                'endTimeUnixNano': nanos(phase.ended_at),
+                'attributes': phase.attributes,
+            }
+            for phase in list(self.phases)
+        ]
+
+
+class TimelineReport(object):
+    '''
+    Aggregates the timelines of many models by (serviceType, serviceVersion)
+    ((None, None) for Files), to compare backend latency with the client's
+    own overhead across runs.
+
+        report = TimelineReport()
+        for artifact in artifacts:
+            report.add(artifact)
+        print json.dumps(report.summary(), indent=2)
+    '''
+    def __init__(self):
+        self._durations = {}
+        self._lock = threading.Lock()
+
+    def add(self, model):
+        key = (model.raw_json.get('serviceType'), model.raw_json.get('serviceVersion'))
+        with self._lock:
+            by_phase = self._durations.setdefault(key, {})
+            for name, seconds in model.timeline.durations().items():
+                by_phase.setdefault(name, []).append(seconds)
+
+    def summary(self):
+        '''
+        Dict of 'serviceType/serviceVersion' to phase name to count, mean,
+        p50, p90 and max seconds
+        '''
+        def stats(values):
+            values = sorted(values)
+            return {
+                'count': len(values),
+                'mean': sum(values) / len(values),
+                'p50': values[int(0.5 * (len(values) - 1))],
+                'p90': values[int(0.9 * (len(values) - 1))],
+                'max': values[-1],
+            }
+        with self._lock:
+            return {
+                '{}/{}'.format(*key): {name: stats(values) for name, values in by_phase.items()}
+                for key, by_phase in self._durations.items()
+            }
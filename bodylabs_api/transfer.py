@@ -0,0 +1,499 @@
+'''
+Resumable, optionally parallel downloads to a file, and verified downloads
+streamed to memory.
+
+A Download writes content to output_path + '.part', which is only renamed to
+output_path once its length, and its MD5 when the server sends Content-MD5, have been
+verified. Progress is recorded next to it in output_path + '.part.json', so
+that a download interrupted by a dropped connection or a crash resumes where
+it stopped, using HTTP Range requests, rather than starting over.
+
+Responses with a gzip or zstd Content-Encoding (see bodylabs_api.compression)
+are read as the encoded bytes the server sent, so that lengths, MD5s and
+Range offsets all refer to those, and decompressed as they're streamed, or
+for a Download once the encoded content has been verified.
+'''
+import json
+import os
+import threading
+
+import requests
+
+# Bytes read from the response and written per iteration
+DOWNLOAD_CHUNK_SIZE = 1024 * 1024
+# Parallel ranged downloads are only used for files of at least two ranges of
+# this size; smaller files aren't worth the extra requests
+MIN_RANGE_SIZE = 8 * 1024 * 1024
+
+# Errors after which a download is resumed rather than abandoned
+_RESUMABLE_ERRORS = (
+    requests.exceptions.ConnectionError,
+    requests.exceptions.ChunkedEncodingError,
+    requests.exceptions.Timeout,
+)
+
+
+def _decoded_encoding(resp):
+    '''
+    The response's Content-Encoding, if it's one we decode ourselves rather
+    than leaving to requests
+    '''
+    from bodylabs_api import compression
+    encoding = resp.headers.get('Content-Encoding')
+    return encoding if encoding and compression.available(encoding) else None
+
+
+def _blocks(resp, chunk_size):
+    '''
+    The response body as iter_content would give it, but still encoded if
+    it has a Content-Encoding we decode ourselves
+    '''
+    if _decoded_encoding(resp) is None:
+        for block in resp.iter_content(chunk_size):
+            yield block
+        return
+    from requests.packages.urllib3.exceptions import ProtocolError, ReadTimeoutError
+    try:
+        for block in resp.raw.stream(chunk_size, decode_content=False):
+            yield block
+    except ProtocolError as e:
+        raise requests.exceptions.ChunkedEncodingError(e)
+    except ReadTimeoutError as e:
+        raise requests.exceptions.ConnectionError(e)
+
+
+def _check_content_range(resp, offset, size):
+    '''
+    Raise DownloadVerificationFailed unless the 206 resp starts at offset of
+    an entity of size bytes (when known)
+    '''
+    import re
+    from bodylabs_api.exceptions import DownloadVerificationFailed
+    # Content-Range: bytes 100-199/1000
+    content_range = re.match(r'bytes (\d+)-\d+/(\d+|\*)$', resp.headers.get('Content-Range', ''))
+    if (content_range is None or int(content_range.group(1)) != offset or
+            (size is not None and content_range.group(2) not in ('*', str(size)))):
+        resp.close()
+        raise DownloadVerificationFailed('Expected bytes from {} of {}, got Content-Range {!r}'.format(
+            offset, size, resp.headers.get('Content-Range')))
+
+
+def _unsatisfiable_length(resp):
+    '''
+    The entity length a 416 resp reports, or None
+    '''
+    import re
+    # Content-Range: bytes */1000
+    content_range = re.match(r'bytes \*/(\d+)$', resp.headers.get('Content-Range', ''))
+    return int(content_range.group(1)) if content_range is not None else None
+
+
+class Download(object):
+    '''
+    One download of a URL to output_path. request(extra_headers) performs the
+    streaming GET, adding extra_headers (e.g. Range) to the usual ones.
+
+    ranges is the number of concurrent Range requests used when the server
+    accepts ranges and the file is large enough; max_resumes bounds how often
+    a dropped transfer is resumed within one run.
+    '''
+    def __init__(self, request, output_path, chunk_size=DOWNLOAD_CHUNK_SIZE, ranges=1,
+                 min_range_size=None, max_resumes=3):
+        self.request = request
+        self.output_path = output_path
+        self.part_path = output_path + '.part'
+        self.state_path = self.part_path + '.json'
+        self.chunk_size = chunk_size
+        self.ranges = ranges
+        self.min_range_size = min_range_size or MIN_RANGE_SIZE
+        self.max_resumes = max_resumes
+        self.state = {}
+        self._state_lock = threading.Lock()
+
+    def _load_state(self):
+        if not os.path.exists(self.part_path):
+            return {}
+        try:
+            with open(self.state_path, 'r') as f:
+                return json.load(f)
+        except (IOError, ValueError):
+            return {}
+
+    def _save_state(self):
+        with self._state_lock:
+            temp_path = self.state_path + '.tmp'
+            with open(temp_path, 'w') as f:
+                json.dump(self.state, f)
+            os.rename(temp_path, self.state_path)
+
+    def _discard(self):
+        for path in (self.part_path, self.state_path):
+            if os.path.exists(path):
+                os.remove(path)
+
+    def run(self, check_status):
+        '''
+        Download, resuming any earlier partial download of output_path.
+        check_status(resp) raises on an unexpected response. Returns the
+        response that started the download, which for conditional requests
+        may be a 304 with nothing downloaded.
+        '''
+        self.state = self._load_state()
+        if self.state.get('done') is not None:
+            # An interrupted parallel download; its size and ranges are known
+            self._download_ranges(self.state['size'])
+            self._finish()
+            return _StateResponse(self.state)
+
+        offset = os.path.getsize(self.part_path) if self.state else 0
+        if offset and offset == self.state.get('size'):
+            # Downloaded in full, but not yet verified and renamed
+            self._finish()
+            return _StateResponse(self.state)
+        resp = self.request(self._resume_headers(offset) if offset else {})
+        if resp.status_code == 416 and offset:
+            # Nothing past offset: the part file is complete, or the entity
+            # is shorter than it, so start over
+            resp.close()
+            if _unsatisfiable_length(resp) == offset:
+                self.state['size'] = offset
+                self._finish()
+                return _StateResponse(self.state)
+            self._discard()
+            offset = 0
+            resp = self.request({})
+        if resp.status_code == 304:
+            return resp
+        if resp.status_code == 206:
+            self._check_partial(resp, offset)
+        else:
+            check_status(resp)
+            offset = 0
+            self.state = {
+                'etag': resp.headers.get('ETag'),
+                'md5': resp.headers.get('Content-MD5'),
+                'size': self._entity_length(resp),
+                'encoding': _decoded_encoding(resp),
+            }
+            self._save_state()
+
+        size = self.state.get('size')
+        if (resp.status_code == 200 and self.ranges > 1 and size is not None and
+                resp.headers.get('Accept-Ranges') == 'bytes' and size >= 2 * self.min_range_size):
+            resp.close()
+            self._download_ranges(size)
+        else:
+            self._stream(resp, offset, check_status)
+        self._finish()
+        return resp
+
+    def _check_partial(self, resp, offset):
+        from bodylabs_api.exceptions import DownloadVerificationFailed
+        try:
+            _check_content_range(resp, offset, self.state.get('size'))
+        except DownloadVerificationFailed:
+            self._discard() # start over on the next run
+            raise
+
+    @staticmethod
+    def _entity_length(resp):
+        # Content-Length counts encoded bytes, which is only of use when we
+        # read those rather than letting requests decode them
+        if 'Content-Length' not in resp.headers:
+            return None
+        if resp.headers.get('Content-Encoding') and _decoded_encoding(resp) is None:
+            return None
+        return int(resp.headers['Content-Length'])
+
+    def _resume_headers(self, offset, end=None):
+        headers = {'Range': 'bytes={}-{}'.format(offset, '' if end is None else end)}
+        if self.state.get('etag'):
+            # Get the whole entity instead if it has changed since
+            headers['If-Range'] = self.state['etag']
+        return headers
+
+    def _stream(self, resp, offset, check_status):
+        '''
+        Write resp to the part file from offset, re-requesting the remainder
+        if the connection drops
+        '''
+        from bodylabs_api.exceptions import DownloadVerificationFailed
+        resumes = 0
+        while True:
+            try:
+                with open(self.part_path, 'r+b' if offset else 'wb') as f:
+                    f.truncate(offset)
+                    f.seek(offset)
+                    for block in _blocks(resp, self.chunk_size):
+                        f.write(block)
+                        offset += len(block)
+                # Older urllib3 versions end a truncated body silently
+                if self.state.get('size') is not None and offset < self.state['size']:
+                    raise requests.exceptions.ChunkedEncodingError(
+                        'Connection closed after {} of {} bytes'.format(offset, self.state['size']))
+                return
+            except _RESUMABLE_ERRORS:
+                if resumes >= self.max_resumes or self.state.get('etag') is None:
+                    raise
+                resumes += 1
+                resp = self.request(self._resume_headers(offset))
+                if resp.status_code == 206:
+                    self._check_partial(resp, offset)
+                    continue
+                if resp.status_code == 416 and _unsatisfiable_length(resp) == offset:
+                    resp.close()
+                    return # the connection dropped after the last byte
+                check_status(resp)
+                if resp.status_code != 200:
+                    resp.close()
+                    raise DownloadVerificationFailed(
+                        'Expected 200 or 206 resuming the download, got {}'.format(resp.status_code))
+                offset = 0 # the server sent the whole entity again
+
+    def _download_ranges(self, size):
+        from concurrent.futures import ThreadPoolExecutor
+        range_size = max(self.min_range_size, -(-size // self.ranges))
+        if self.state.get('done') is None:
+            self.state['done'] = []
+            with open(self.part_path, 'wb') as f:
+                f.truncate(size) # preallocate; ranges are written in place
+            self._save_state()
+
+        from bodylabs_api.exceptions import DownloadVerificationFailed
+        starts = [start for start in range(0, size, range_size) if start not in self.state['done']]
+        executor = ThreadPoolExecutor(max_workers=self.ranges)
+        try:
+            for future in [executor.submit(self._download_range, start, min(start + range_size, size) - 1)
+                           for start in starts]:
+                future.result()
+        except DownloadVerificationFailed:
+            self._discard() # the ranges done so far belong to a stale entity
+            raise
+        finally:
+            executor.shutdown(wait=True)
+
+    def _download_range(self, start, end):
+        from bodylabs_api.exceptions import DownloadVerificationFailed
+        resumes = 0
+        offset = start
+        while True:
+            try:
+                resp = self.request(self._resume_headers(offset, end))
+                try:
+                    if resp.status_code != 206:
+                        raise DownloadVerificationFailed(
+                            'Expected 206 for bytes {}-{}, got {}'.format(offset, end, resp.status_code))
+                    _check_content_range(resp, offset, self.state['size'])
+                    with open(self.part_path, 'r+b') as f:
+                        f.seek(offset)
+                        for block in _blocks(resp, self.chunk_size):
+                            f.write(block)
+                            offset += len(block)
+                finally:
+                    resp.close()
+                if offset != end + 1:
+                    raise requests.exceptions.ChunkedEncodingError(
+                        'Range {}-{} ended at {}'.format(start, end, offset))
+                break
+            except _RESUMABLE_ERRORS:
+                if resumes >= self.max_resumes:
+                    raise
+                resumes += 1
+        with self._state_lock:
+            self.state['done'].append(start)
+        self._save_state()
+
+    def _finish(self):
+        import base64
+        import hashlib
+        from bodylabs_api.exceptions import DownloadVerificationFailed
+
+        size = self.state.get('size')
+        actual_size = os.path.getsize(self.part_path)
+        if size is not None and actual_size != size:
+            self._discard()
+            raise DownloadVerificationFailed('Expected {} bytes, got {}'.format(size, actual_size))
+
+        if self.state.get('md5'):
+            digest = hashlib.md5()
+            with open(self.part_path, 'rb') as f:
+                for block in iter(lambda: f.read(self.chunk_size), ''):
+                    digest.update(block)
+            if base64.b64encode(digest.digest()) != self.state['md5']:
+                self._discard()
+                raise DownloadVerificationFailed('Content-MD5 mismatch for {}'.format(self.output_path))
+
+        if self.state.get('encoding'):
+            from bodylabs_api.compression import decode_file
+            decoded_path = self.part_path + '.decoded'
+            decode_file(self.state['encoding'], self.part_path, decoded_path, chunk_size=self.chunk_size)
+            os.rename(decoded_path, self.output_path)
+            os.remove(self.part_path)
+        else:
+            os.rename(self.part_path, self.output_path)
+        if os.path.exists(self.state_path):
+            os.remove(self.state_path)
+
+
+class _StateResponse(object):
+    '''
+    Stands in for the response that started a resumed parallel download
+    '''
+    status_code = 200
+
+    def __init__(self, state):
+        self.headers = {'ETag': state.get('etag')} if state.get('etag') else {}
+
+
+class Stream(object):
+    '''
+    One download consumed as an iterator of byte strings instead of being
+    written to a file. request(extra_headers) is as for Download, and is
+    called, and the response checked, on construction; size is then the
+    content length, when the server sent one and the content isn't encoded.
+
+    A dropped connection is resumed with a Range request when the server
+    sent an ETag. Once the last chunk has been read, the length, and the MD5
+    when the server sent Content-MD5, are verified, raising
+    DownloadVerificationFailed after the bad content has been consumed. For
+    encoded content, these are the length and MD5 of the encoded bytes.
+
+    The connection is released once the content has been consumed or
+    iteration fails; close() it, or use the Stream as a context manager,
+    when abandoning it before then.
+    '''
+    def __init__(self, request, check_status, chunk_size=DOWNLOAD_CHUNK_SIZE, max_resumes=3):
+        self.request = request
+        self.chunk_size = chunk_size
+        self.max_resumes = max_resumes
+        self.response = request({})
+        self._current = self.response
+        try:
+            check_status(self.response)
+        except Exception:
+            self.response.close()
+            raise
+        self.etag = self.response.headers.get('ETag')
+        self.md5 = self.response.headers.get('Content-MD5')
+        self.encoding = _decoded_encoding(self.response)
+        # Bytes on the wire, which with an encoding isn't the content's size
+        self._length = Download._entity_length(self.response) # pylint: disable=protected-access
+        self.size = self._length if self.encoding is None else None
+        self.bytes_read = 0
+
+    def close(self):
+        '''
+        Release the connection, abandoning any content not yet read
+        '''
+        self._current.close()
+        if self._current is not self.response:
+            self.response.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def __iter__(self):
+        try:
+            for block in self._iter_verified():
+                yield block
+        finally:
+            self.close()
+
+    def _iter_verified(self):
+        import base64
+        import hashlib
+        from bodylabs_api.exceptions import DownloadVerificationFailed
+
+        digest = hashlib.md5() if self.md5 else None
+        decoder = None
+        if self.encoding is not None:
+            from bodylabs_api.compression import Decoder
+            decoder = Decoder(self.encoding)
+        resp = self.response
+        received = 0
+        resumes = 0
+        while True:
+            try:
+                for block in _blocks(resp, self.chunk_size):
+                    if digest is not None:
+                        digest.update(block)
+                    received += len(block)
+                    if decoder is not None:
+                        block = decoder.decode(block)
+                        if not block:
+                            continue
+                    self.bytes_read += len(block)
+                    yield block
+                if self._length is not None and received < self._length:
+                    raise requests.exceptions.ChunkedEncodingError(
+                        'Connection closed after {} of {} bytes'.format(received, self._length))
+                break
+            except _RESUMABLE_ERRORS:
+                if resumes >= self.max_resumes or self.etag is None:
+                    raise
+                resumes += 1
+                resp = self._current = self.request(
+                    {'Range': 'bytes={}-'.format(received), 'If-Range': self.etag})
+                if resp.status_code != 206:
+                    # What was already yielded can't be taken back
+                    raise DownloadVerificationFailed('Content changed while resuming the download')
+                _check_content_range(resp, received, self._length)
+
+        if decoder is not None:
+            block = decoder.flush()
+            if block:
+                self.bytes_read += len(block)
+                yield block
+        if self._length is not None and received != self._length:
+            raise DownloadVerificationFailed('Expected {} bytes, got {}'.format(self._length, received))
+        if digest is not None and base64.b64encode(digest.digest()) != self.md5:
+            raise DownloadVerificationFailed('Content-MD5 mismatch')
+
+    def write_into(self, target):
+        '''
+        Consume the download into target, returning the number of bytes
+        written: either a file-like object with write(), such as a BytesIO, or
+        a writable buffer of bytes, such as a bytearray, a memoryview of one
+        or a numpy uint8 array, which must be large enough for the content.
+        '''
+        try:
+            return self._write_into(target)
+        finally:
+            self.close()
+
+    def _write_into(self, target):
+        if hasattr(target, 'write'):
+            for block in self:
+                target.write(block)
+            return self.bytes_read
+
+        view = memoryview(target)
+        if view.readonly or view.ndim != 1 or view.itemsize != 1:
+            raise TypeError('Cannot download into {}; expected a writable, one-dimensional byte buffer'.format(
+                type(target).__name__))
+        if self.size is not None and self.size > len(view):
+            raise ValueError('{} bytes do not fit in a buffer of {}'.format(self.size, len(view)))
+        offset = 0
+        for block in self:
+            if offset + len(block) > len(view):
+                raise ValueError('Content does not fit in a buffer of {} bytes'.format(len(view)))
+            view[offset:offset + len(block)] = block
+            offset += len(block)
+        return offset
+
+    def read_all(self):
+        '''
+        Consume the download into a new bytearray, allocated once up front
+        when the size is known, e.g. for numpy.frombuffer
+        '''
+        if self.size is None:
+            content = bytearray()
+            for block in self:
+                content.extend(block)
+            return content
+        content = bytearray(self.size)
+        self.write_into(content)
+        return content
@@ -29,6 +29,11 @@ setup(
         'bodylabs_api',
     ],
     install_requires=install_requires,
+    entry_points={
+        'console_scripts': [
+            'bodylabs-api = bodylabs_api.runner:main',
+        ],
+    },
     # See https://pypi.python.org/pypi?%3Aaction=list_classifiers
     classifiers=[
         'Development Status :: 3 - Alpha',